@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+Benchmark the API against a farm of local mock devices.
+
+    python benchmark.py --devices 20 --requests 500 --concurrency 20
+
+Starts the mock devices in this process and the API in a uvicorn
+subprocess with a throwaway database, registers the devices through
+POST /connections/ and then drives /connections/command,
+/connections/mdcommand and the health checker. Latency percentiles,
+throughput, memory and thread count of the API process are printed and
+saved as JSON; pass --compare with an earlier result to see the change.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import mock_device
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_METRIC_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$")
+
+
+class _Farm:
+    """
+    Mock devices served from an event loop in a background thread
+    """
+
+    def __init__(self, count, base_address, port, **device_options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="mock-farm", daemon=True)
+        self.thread.start()
+        self.servers = asyncio.run_coroutine_threadsafe(
+            mock_device.start_farm(count, base_address, port, **device_options),
+            self.loop
+        ).result()
+
+    @property
+    def addresses(self):
+        return [address for address, _ in self.servers]
+
+    def stop(self):
+        async def close():
+            for _, server in self.servers:
+                server.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(base_url, method, path, body=None, timeout=120):
+    """
+    Send a JSON request to the API
+
+    :return: (status code, response body bytes)
+    """
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(
+        base_url + path,
+        data=data,
+        method=method,
+        headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def _start_server(port, environment, timeout=60):
+    """
+    Start the API in a uvicorn subprocess and wait until it answers
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=REPO_DIR,
+        env=dict(os.environ, **environment),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API server exited with code {process.returncode}")
+        try:
+            if _request(base_url, "GET", "/ready", timeout=2)[0] == 200:
+                return process, base_url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"API server did not start within {timeout}s")
+
+
+def process_stats(pid):
+    """
+    Resident memory and thread count of a process, from /proc (Linux only)
+
+    :return: Dictionary, empty if the information is not available
+    """
+    stats = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                key, _, value = line.partition(":")
+                if key == "VmRSS":
+                    stats["rss_bytes"] = int(value.split()[0]) * 1024
+                elif key == "VmHWM":
+                    stats["peak_rss_bytes"] = int(value.split()[0]) * 1024
+                elif key == "Threads":
+                    stats["threads"] = int(value)
+    except OSError:
+        pass
+    return stats
+
+
+class _Sampler:
+    """
+    Record the peak memory and thread count of a process while a scenario runs
+    """
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.max_rss_bytes = 0
+        self.max_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            stats = process_stats(self.pid)
+            self.max_rss_bytes = max(self.max_rss_bytes, stats.get("rss_bytes", 0))
+            self.max_threads = max(self.max_threads, stats.get("threads", 0))
+            if self._stop.wait(self.interval):
+                break
+
+    def result(self):
+        return {"max_rss_bytes": self.max_rss_bytes, "max_threads": self.max_threads}
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, errors, duration):
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "duration_seconds": round(duration, 3),
+        "throughput_per_second": round(total / duration, 2) if duration else None,
+        "latency_seconds": {
+            "min": latencies[0] if latencies else None,
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None
+        }
+    }
+
+
+def run_load(pid, count, concurrency, send):
+    """
+    Call send(index) count times from concurrency threads and time every call
+
+    :param send: Callable returning True on success
+    """
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run(index):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            ok = send(index)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    with _Sampler(pid) as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(run, range(count)))
+        duration = time.perf_counter() - start
+
+    result = summarize(latencies, errors, duration)
+    result["server"] = sampler.result()
+    return result
+
+
+def scrape_metrics(base_url):
+    """
+    Read /metrics into {(name, labels): value}
+    """
+    status, body = _request(base_url, "GET", "/metrics")
+    values = {}
+    if status != 200:
+        return values
+    for line in body.decode("utf-8").splitlines():
+        match = _METRIC_LINE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            try:
+                values[(name, labels or "")] = float(value)
+            except ValueError:
+                pass
+    return values
+
+
+def _metric_total(values, name):
+    return sum(value for (metric, _), value in values.items() if metric == name)
+
+
+def histogram_summary(before, after, name):
+    """
+    Count and mean of a histogram between two scrapes, summed over labels
+    """
+    count = _metric_total(after, f"{name}_count") - _metric_total(before, f"{name}_count")
+    total = _metric_total(after, f"{name}_sum") - _metric_total(before, f"{name}_sum")
+    return {"count": int(count), "mean_seconds": total / count if count else None}
+
+
+def run_health_check(pid, base_url, duration):
+    """
+    Let the health checker run on its own and measure what it did
+    """
+    before = scrape_metrics(base_url)
+    with _Sampler(pid) as sampler:
+        time.sleep(duration)
+    after = scrape_metrics(base_url)
+
+    result = {
+        "duration_seconds": duration,
+        "checks": histogram_summary(before, after, "health_check_seconds"),
+        "lag": histogram_summary(before, after, "health_check_lag_seconds"),
+        "reconnects": histogram_summary(before, after, "ssh_reconnect_seconds"),
+    }
+    checks = result["checks"]["count"]
+    result["checks_per_second"] = round(checks / duration, 2) if duration else None
+    result["server"] = sampler.result()
+    return result
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="ssh-benchmark-")
+    ssh_port = args.ssh_port or _free_port()
+    api_port = args.api_port or _free_port()
+
+    farm = _Farm(
+        args.devices,
+        args.base_address,
+        ssh_port,
+        enable_secret="",
+        latency=args.latency,
+        output_lines=args.output_lines
+    )
+    server = None
+    try:
+        environment = {
+            "SSH_PORT": str(ssh_port),
+            "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'benchmark.db')}",
+            "HEALTH_CHECK_INTERVAL": str(args.health_interval),
+            # Registered devices are only checked once the inventory has been re-read
+            "HEALTH_CHECK_INVENTORY_REFRESH": str(args.health_interval),
+            "HEALTH_CHECK_WORKERS": str(args.health_workers),
+        }
+        server, base_url = _start_server(api_port, environment)
+        hostnames = farm.addresses
+        results = {"idle": {"server": process_stats(server.pid)}}
+
+        def register(index):
+            status, _ = _request(base_url, "POST", "/connections/", {
+                "hostname": hostnames[index],
+                "username": "benchmark",
+                "password": "benchmark",
+                "device_type": "cisco_ios"
+            })
+            return status == 200
+
+        print(f"Registering {len(hostnames)} devices", flush=True)
+        results["register"] = run_load(server.pid, len(hostnames), args.concurrency, register)
+
+        def command(index):
+            status, _ = _request(base_url, "POST", "/connections/command", {
+                "hostname": hostnames[index % len(hostnames)],
+                "command": args.command,
+                "enable_mode": args.enable,
+                "use_cache": args.use_cache
+            })
+            return status == 200
+
+        print(f"Running {args.requests} x /connections/command", flush=True)
+        results["command"] = run_load(server.pid, args.requests, args.concurrency, command)
+
+        pattern = args.md_pattern or os.path.commonprefix(hostnames)
+
+        def mdcommand(index):
+            status, body = _request(base_url, "POST", "/connections/mdcommand", {
+                "hostname": pattern,
+                "command": args.command,
+                "enable_mode": args.enable,
+                "use_cache": args.use_cache
+            })
+            return status == 200 and not any("error" in result for result in json.loads(body))
+
+        print(f"Running {args.md_requests} x /connections/mdcommand on {pattern!r}", flush=True)
+        results["mdcommand"] = run_load(server.pid, args.md_requests, args.md_concurrency, mdcommand)
+        results["mdcommand"]["devices_per_request"] = len([h for h in hostnames if pattern in h])
+
+        print(f"Watching the health checker for {args.health_duration}s", flush=True)
+        results["health_check"] = run_health_check(server.pid, base_url, args.health_duration)
+
+        final = scrape_metrics(base_url)
+        results["connections"] = {
+            "session_open": histogram_summary({}, final, "ssh_session_open_seconds"),
+            "connect": histogram_summary({}, final, "ssh_connect_seconds"),
+            "reconnect": histogram_summary({}, final, "ssh_reconnect_seconds"),
+        }
+        results["final"] = {"server": process_stats(server.pid)}
+        return results
+
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        farm.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_seconds(value):
+    return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+
+def print_report(report, previous=None):
+    for name in ("register", "command", "mdcommand"):
+        result = report["scenarios"][name]
+        latency = result["latency_seconds"]
+        line = (
+            f"{name:<10} {result['requests']:>6} req  {result['errors']:>4} err  "
+            f"{result['throughput_per_second'] or 0:>8.1f} req/s  "
+            f"p50 {_format_seconds(latency['p50']):>9}  p99 {_format_seconds(latency['p99']):>9}  "
+            f"threads {result['server'].get('max_threads', '-')}  "
+            f"rss {result['server'].get('max_rss_bytes', 0) / 2 ** 20:.0f}MiB"
+        )
+        if previous and name in previous.get("scenarios", {}):
+            old = previous["scenarios"][name]
+            changes = []
+            for label, new_value, old_value in (
+                ("req/s", result["throughput_per_second"], old["throughput_per_second"]),
+                ("p50", latency["p50"], old["latency_seconds"]["p50"]),
+                ("p99", latency["p99"], old["latency_seconds"]["p99"]),
+            ):
+                if new_value and old_value:
+                    changes.append(f"{label} {(new_value - old_value) / old_value * 100:+.0f}%")
+            line += "  (" + ", ".join(changes) + ")"
+        print(line)
+
+    health = report["scenarios"]["health_check"]
+    print(
+        f"health     {health['checks']['count']:>6} checks in {health['duration_seconds']}s, "
+        f"mean {_format_seconds(health['checks']['mean_seconds'])}, "
+        f"lag {_format_seconds(health['lag']['mean_seconds'])}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API against local mock devices")
+    parser.add_argument("--devices", type=int, default=10, help="Number of mock devices")
+    parser.add_argument("--base-address", default="127.0.1.1", help="Loopback address of the first device")
+    parser.add_argument("--ssh-port", type=int, default=None, help="SSH port of the devices, random if omitted")
+    parser.add_argument("--api-port", type=int, default=None, help="Port of the API server, random if omitted")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each device waits before answering")
+    parser.add_argument("--output-lines", type=int, default=50, help="Lines of generated show output")
+    parser.add_argument("--command", default="show version", help="Command sent to the devices")
+    parser.add_argument("--enable", action="store_true", help="Enter enable mode before every command")
+    parser.add_argument("--use-cache", action="store_true", help="Allow answers from the output cache")
+    parser.add_argument("--requests", type=int, default=200, help="Number of /connections/command requests")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent /connections/command requests")
+    parser.add_argument("--md-requests", type=int, default=20, help="Number of /connections/mdcommand requests")
+    parser.add_argument("--md-concurrency", type=int, default=2, help="Concurrent /connections/mdcommand requests")
+    parser.add_argument("--md-pattern", default=None, help="Hostname pattern for mdcommand, all devices if omitted")
+    parser.add_argument("--health-interval", type=float, default=5, help="HEALTH_CHECK_INTERVAL of the server")
+    parser.add_argument("--health-workers", type=int, default=10, help="HEALTH_CHECK_WORKERS of the server")
+    parser.add_argument("--health-duration", type=float, default=15, help="Seconds to watch the health checker")
+    parser.add_argument("--output", default=None, help="Result file, benchmark-<timestamp>.json if omitted")
+    parser.add_argument("--compare", default=None, help="Earlier result file to compare against")
+    args = parser.parse_args()
+
+    started_at = datetime.utcnow()
+    scenarios = run_benchmark(args)
+    report = {
+        "started_at": started_at.isoformat(),
+        "git_commit": _git_commit(),
+        "transport": os.environ.get("SSH_TRANSPORT", "netmiko"),
+        "config": vars(args),
+        "scenarios": scenarios,
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            previous = json.load(compare_file)
+    print_report(report, previous)
+
+    output = args.output or f"benchmark-{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
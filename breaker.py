@@ -0,0 +1,196 @@
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Failures in a row that open the circuit of a device
+FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "3"))
+# Seconds an open circuit rejects requests before letting a probe through
+RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", "30"))
+# Upper bound for the reset timeout, which doubles after every failed probe
+MAX_RESET_TIMEOUT = float(os.environ.get("BREAKER_MAX_RESET_TIMEOUT", "600"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of contacting a device whose circuit is open
+    """
+
+    def __init__(self, hostname, retry_after, last_error=None):
+        self.hostname = hostname
+        self.retry_after = retry_after
+        message = f"Circuit open for {hostname}, retry in {retry_after:.0f}s"
+        if last_error:
+            message += f" (last error: {last_error})"
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """
+    Failure state of one device.
+
+    Closed lets every request through and counts failures in a row. Open
+    rejects requests at once until the reset timeout is over, then lets a
+    single probe through (half-open): its success closes the circuit, its
+    failure opens it again with twice the timeout.
+    """
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.state = CLOSED
+        self.failures = 0
+        self.last_error = None
+        self.opened_at = None
+        self.reset_timeout = RESET_TIMEOUT
+        self._retry_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Ask to contact the device
+
+        :return: True if this caller is the half-open probe
+        :raises CircuitOpenError: If the circuit is open or a probe is already running
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._retry_at:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            retry_after = max(self._retry_at - now, 0)
+        metrics.CIRCUIT_REJECTIONS.inc()
+        raise CircuitOpenError(self.hostname, retry_after, self.last_error)
+
+    def check(self):
+        """
+        Fail fast like acquire() without taking the probe slot
+
+        :raises CircuitOpenError: If the circuit is open and not due for a probe
+        """
+        retry_after = self.retry_after()
+        if retry_after > 0:
+            metrics.CIRCUIT_REJECTIONS.inc()
+            raise CircuitOpenError(self.hostname, retry_after, self.last_error)
+
+    def release(self):
+        """
+        Give up a probe slot without an outcome, e.g. when no session was free
+        """
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.last_error = None
+            self._probing = False
+            if self.state != CLOSED:
+                self.reset_timeout = RESET_TIMEOUT
+                self.opened_at = None
+                self._set_state(CLOSED)
+
+    def failure(self, error):
+        with self._lock:
+            self.failures += 1
+            # Netmiko appends troubleshooting hints after the first line
+            self.last_error = (str(error).strip().splitlines() or [type(error).__name__])[0]
+            self._probing = False
+            if self.state == HALF_OPEN:
+                # The device is still down, wait longer before the next probe
+                self.reset_timeout = min(self.reset_timeout * 2, MAX_RESET_TIMEOUT)
+                self._open()
+            elif self.state == CLOSED and self.failures >= FAILURE_THRESHOLD:
+                self._open()
+
+    def _open(self):
+        self._retry_at = time.monotonic() + self.reset_timeout
+        self.opened_at = datetime.utcnow()
+        self._set_state(OPEN)
+        logger.warning(
+            f"Circuit for {self.hostname} opened after {self.failures} failures, "
+            f"next probe in {self.reset_timeout:.0f}s: {self.last_error}"
+        )
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.CIRCUIT_TRANSITIONS.labels(state).inc()
+
+    def retry_after(self):
+        """
+        Seconds until a probe is let through, 0 unless the circuit is open
+        """
+        with self._lock:
+            if self.state != OPEN:
+                return 0
+            return max(self._retry_at - time.monotonic(), 0)
+
+    def describe(self):
+        retry_after = self.retry_after()
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "last_error": self.last_error,
+                "opened_at": self.opened_at,
+                "retry_after": round(retry_after, 1)
+            }
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers of all devices, created on first use
+    """
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, hostname):
+        breaker = self._breakers.get(hostname)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(hostname, CircuitBreaker(hostname))
+        return breaker
+
+    def forget(self, hostname):
+        with self._lock:
+            self._breakers.pop(hostname, None)
+
+    def describe(self, hostname):
+        return self.get(hostname).describe()
+
+    def collect_metrics(self):
+        """
+        Export how many devices are in each circuit state at scrape time
+        """
+        counts = dict.fromkeys(STATES, 0)
+        for breaker in list(self._breakers.values()):
+            counts[breaker.state] += 1
+        yield (
+            'circuit_breaker_devices',
+            'Devices by circuit breaker state',
+            'gauge',
+            [({'state': state}, count) for state, count in counts.items()]
+        )
+
+
+# Global circuit breakers, consulted before every session checkout and reconnect
+circuit_breakers = CircuitBreakers()
+metrics.register_collector(circuit_breakers.collect_metrics)
@@ -0,0 +1,73 @@
+import json
+import logging
+import re
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds to sleep between channel reads when no data is waiting
+_READ_INTERVAL = 0.05
+
+
+class CommandStreamTimeout(Exception):
+    """
+    Raised when the device prompt did not come back before the read timeout
+    """
+
+
+def stream_command(ssh_conn, command, read_timeout=60):
+    """
+    Send a command and yield its output line by line as it is read off the channel.
+
+    The command echo and the trailing prompt are stripped, like send_command does.
+
+    :param ssh_conn: Connected Netmiko session
+    :param command: Command to execute
+    :param read_timeout: Seconds to wait for the prompt to come back
+    :return: Generator of output lines without line endings
+    """
+    prompt = re.compile(re.escape(ssh_conn.base_prompt) + r"[^\n]*[#>$]\s*$")
+
+    ssh_conn.clear_buffer()
+    ssh_conn.write_channel(ssh_conn.normalize_cmd(command))
+
+    buffer = ""
+    echo_stripped = False
+    deadline = time.monotonic() + read_timeout
+    output_bytes = metrics.OUTPUT_BYTES.labels(metrics.command_label(command))
+
+    while True:
+        data = ssh_conn.read_channel()
+        if not data:
+            if time.monotonic() >= deadline:
+                raise CommandStreamTimeout(
+                    f"Prompt not detected on {ssh_conn.host} within {read_timeout}s"
+                )
+            time.sleep(_READ_INTERVAL)
+            continue
+
+        output_bytes.inc(len(data))
+        buffer += data.replace("\r\n", "\n").replace("\r", "")
+        *lines, buffer = buffer.split("\n")
+
+        for line in lines:
+            # The first line is the command echoed back by the device
+            if not echo_stripped:
+                echo_stripped = True
+                if command.strip() in line:
+                    continue
+            yield line
+
+        # The prompt sits on the last, unterminated line once the output is done
+        if prompt.search(buffer):
+            return
+
+
+def ndjson(records):
+    """
+    Encode an iterable of JSON-serializable records as newline-delimited JSON
+    """
+    for record in records:
+        yield json.dumps(record) + "\n"
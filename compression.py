@@ -0,0 +1,146 @@
+import logging
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import zstandard
+except ImportError:  # Optional, responses are only gzip-compressed without it
+    zstandard = None
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Responses smaller than this many bytes are sent as they are
+MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+# Compression levels, low ones keep the CPU cost per response small
+GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.environ.get("COMPRESS_ZSTD_LEVEL", "3"))
+
+
+def _accepted(accept_encoding):
+    """
+    :return: Dictionary of the content codings a client named to their q-value
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    return accepted
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick the supported coding a client prefers, zstd over gzip when it likes both as much
+
+    :return: "zstd", "gzip" or None
+    """
+    accepted = _accepted(accept_encoding or "")
+    supported = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+    best, best_quality = None, 0.0
+    for coding in supported:
+        # Codings the client did not name get the q-value of "*", if it sent one
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+class _Compressor:
+    """
+    Incremental compressor that can be flushed after every streamed chunk
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._flush, self._finish = zstandard.COMPRESSOBJ_FLUSH_BLOCK, zstandard.COMPRESSOBJ_FLUSH_FINISH
+        else:
+            # wbits 31 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._flush, self._finish = zlib.Z_SYNC_FLUSH, zlib.Z_FINISH
+
+    def compress(self, data, final):
+        """
+        Compress a chunk, flushed so the client can decode everything sent so far
+        """
+        output = self._compressor.compress(data) + self._compressor.flush(self._finish if final else self._flush)
+        metrics.RESPONSE_BYTES.labels(self.encoding, "identity").inc(len(data))
+        metrics.RESPONSE_BYTES.labels(self.encoding, "compressed").inc(len(output))
+        return output
+
+
+class CompressionMiddleware:
+    """
+    Compress response bodies with zstd or gzip, as negotiated by Accept-Encoding.
+
+    Unlike Starlette's GZipMiddleware, streamed responses are flushed after
+    every chunk, so NDJSON records and streamed lines still reach the client
+    as soon as they are produced.
+    """
+
+    def __init__(self, app, minimum_size=MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("Accept-Encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether to compress
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                skip = "content-encoding" in headers or (not more_body and len(body) < self.minimum_size)
+                if not skip:
+                    compressor = _Compressor(encoding)
+                    body = compressor.compress(body, final=not more_body)
+                    message = dict(message, body=body)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if more_body:
+                        # Streamed, the compressed length is not known up front
+                        if "content-length" in headers:
+                            del headers["Content-Length"]
+                    else:
+                        headers["Content-Length"] = str(len(body))
+                await send(start)
+                start = None
+                await send(message)
+                return
+
+            if compressor is not None:
+                message = dict(message, body=compressor.compress(body, final=not more_body))
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
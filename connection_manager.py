@@ -1,30 +1,69 @@
-from netmiko import ConnectHandler, NetMikoTimeoutException, NetMikoAuthenticationException
+from netmiko import NetMikoTimeoutException, NetMikoAuthenticationException
+from paramiko import SSHException
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from sqlalchemy.orm import Session
 from datetime import datetime
-import time
 import threading
-import schedule
 import logging
 import os
-import socket
 
 from database import engine, Base, get_db  # Added get_db import here
 
 from models import NetworkConnection
-from database import engine, Base, SessionLocal
+from breaker import circuit_breakers, CircuitOpenError
+from database import engine, Base, SessionLocal, create_tables
+from health_checker import HealthChecker
+from host_index import host_index
+from output_cache import output_cache
+from resolver import resolver
+from scheduler import command_scheduler, QueueFull, HEALTH_CHECK, INTERACTIVE
+from shards import cluster
+from snapshots import snapshot_store
+from status_writer import status_writer
+from timing import timing_profiles
+import fan_out
+import metrics
+import transports
+from session_pool import DeviceSessionPool, PoolClosed, PoolTimeout, pool_size_for, POOL_SIZE_BY_HOSTNAME
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# SSH port of every device
+SSH_PORT = int(os.environ.get("SSH_PORT", "22"))
+# Devices connected at the same time while warming up after startup
+STARTUP_WORKERS = int(os.environ.get("STARTUP_CONNECT_WORKERS", "20"))
+
+# Errors of an established session that show the device or the path to it is gone;
+# other command errors, such as a ReadTimeout, only discard the session
+TRANSPORT_ERRORS = (NetMikoTimeoutException, NetMikoAuthenticationException, SSHException, OSError, EOFError)
+
 class NetworkConnectionManager:
     def __init__(self):
         # Create tables
-        Base.metadata.create_all(bind=engine)
+        create_tables()
         self.connections = {}
+        self._lock = threading.RLock()
+        self.startup_progress = {
+            'total': None,
+            'connected': 0,
+            'failed': 0,
+            'started_at': None,
+            'finished_at': None
+        }
+        
+        # Index hostnames for target resolution, a single query even for large inventories
+        self._load_host_index()
         
-        # Synchronize connections on startup
-        self.synchronize_connections()
+        # Synchronize connections in the background so startup returns immediately,
+        # requests connect the devices they target on demand in the meantime
+        self._startup_thread = threading.Thread(
+            target=self.synchronize_connections,
+            name="connection-startup",
+            daemon=True
+        )
+        self._startup_thread.start()
 
     def _validate_hostname(self, hostname):
         """
@@ -33,99 +72,225 @@ class NetworkConnectionManager:
         :param hostname: Hostname or IP address to validate
         :return: True if valid, False otherwise
         """
-        try:
-            # Try to resolve the hostname
-            socket.gethostbyname(hostname)
-            return True
-        except socket.error:
-            return False
+        # Resolve through the cache, reconnects reuse the address found before
+        return resolver.resolve(hostname) is not None
 
     def synchronize_connections(self):
         """
-        Synchronize connections with the database, ensuring:
-        1. All database-defined devices are connected
-        2. No extra connections exist
-        3. Disconnected devices are removed from active connections
+        Synchronize connections with the database, ensuring all
+        database-defined devices are connected.
+        
+        Runs in the background on startup and records its progress in
+        startup_progress. Extra connections are removed by the health checker.
         """
-        # Create a new database session
-        db = SessionLocal()
+        self.startup_progress['started_at'] = datetime.utcnow()
         
         try:
-            # Retrieve all saved network connections from the database
-            saved_connections = db.query(NetworkConnection).all()
+            # Retrieve all saved network connections; the rows are detached and
+            # only read by the workers, status changes go through the status writer
+            db = SessionLocal()
+            try:
+                saved_connections = db.query(NetworkConnection).all()
+            finally:
+                db.close()
+            # Other nodes connect the devices they own
+            saved_connections = [connection for connection in saved_connections if cluster.owns(connection.hostname)]
+            self.startup_progress['total'] = len(saved_connections)
             
-            # Track which hostnames we've processed
-            processed_hostnames = set()
+            # Resolve every hostname up front, in parallel with the first connects
+            resolver.prefetch(connection.hostname for connection in saved_connections)
             
             # Use ThreadPoolExecutor to connect to devices in parallel
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_hostname = {
-                    executor.submit(self._connect_or_maintain_connection, db, connection): connection.hostname
+            with ThreadPoolExecutor(max_workers=STARTUP_WORKERS) as executor:
+                future_to_connection = {
+                    executor.submit(self._connect_or_maintain_connection, connection): connection
                     for connection in saved_connections
                 }
                 
-                for future in as_completed(future_to_hostname):
-                    hostname = future_to_hostname[future]
-                    processed_hostnames.add(hostname)
+                for future in as_completed(future_to_connection):
+                    connection = future_to_connection[future]
                     
                     try:
-                        future.result()
+                        connected = future.result()
                     except Exception as e:
-                        logger.error(f"Error processing {hostname}: {str(e)}")
-            
-            # Remove any connections not in the database
-            self._cleanup_extra_connections(processed_hostnames)
-            
-            # Commit any status changes
-            db.commit()
+                        logger.error(f"Error processing {connection.hostname}: {str(e)}")
+                        connected = False
+                    
+                    with self._lock:
+                        if connected:
+                            self.startup_progress['connected'] += 1
+                        else:
+                            self.startup_progress['failed'] += 1
         
         except Exception as e:
             logger.error(f"Error during connection synchronization: {str(e)}")
         
         finally:
-            # Close the database session
+            self.startup_progress['finished_at'] = datetime.utcnow()
+            logger.info(
+                f"Startup synchronization finished: {self.startup_progress['connected']} connected, "
+                f"{self.startup_progress['failed']} failed"
+            )
+
+    def _load_host_index(self):
+        """
+        Fill the in-memory host index from the database
+        """
+        db = SessionLocal()
+        try:
+            host_index.load(
+                db.query(NetworkConnection.hostname, NetworkConnection.device_type).all()
+            )
+        finally:
             db.close()
 
-    def _connect_or_maintain_connection(self, db, connection):
+    def readiness(self):
+        """
+        Report startup progress
+        
+        :return: Dictionary with device counts and whether startup has finished
+        """
+        with self._lock:
+            progress = dict(self.startup_progress)
+        
+        total = progress['total']
+        done = progress['connected'] + progress['failed']
+        progress['pending'] = total - done if total is not None else None
+        progress['ready'] = progress['finished_at'] is not None
+        return progress
+
+    def _connect_or_maintain_connection(self, connection):
         """
         Connect to or maintain a connection for a given device
+        
+        :return: True if the device is connected
         """
         try:
             hostname = connection.hostname
             
-            # Check if connection already exists
-            if hostname in self.connections:
-                # Verify the existing connection is still valid
-                try:
-                    # Send a simple command to test connection
-                    self.connections[hostname]['ssh_conn'].send_command('show version')
-                    return  # Connection is good, move to next device
-                except:
-                    # Connection is no longer valid, remove it
-                    self._disconnect_device(hostname)
-            
-            # Attempt to establish a new connection
-            ssh_conn = self._create_connection(connection)
-            
-            if ssh_conn:
-                # Store the connection
-                self.connections[hostname] = {
-                    'ssh_conn': ssh_conn,
-                    'details': connection
-                }
+            # Commands of users go first, the check waits for its turn
+            with command_scheduler.slot(hostname, HEALTH_CHECK, "synchronize", device_limit=self.device_limit(connection)):
+                now = datetime.utcnow()
                 
-                # Update connection status
-                connection.is_connected = True
-                connection.last_connected = datetime.utcnow()
+                # Check if connection already exists and is still valid
+                if self.probe_connection(hostname) is not False:
+                    status_writer.queue(connection.id, is_connected=True, last_check=now)
+                    return True  # Connection is good, move to next device
+                
+                # Attempt to establish a new connection
+                if self.connect_device(connection):
+                    # Update connection status
+                    status_writer.queue(connection.id, is_connected=True, last_connected=now, last_check=now)
+                    return True
                 
-                logger.info(f"Successfully connected to {hostname}")
-            else:
                 # Mark as disconnected
-                connection.is_connected = False
-                logger.warning(f"Failed to connect to {hostname}")
+                status_writer.queue(connection.id, is_connected=False, last_check=now)
+                return False
         
         except Exception as conn_error:
             logger.error(f"Error processing {connection.hostname}: {str(conn_error)}")
+            return False
+
+    def probe_connection(self, hostname, mode="keepalive"):
+        """
+        Cheaply check that the connection to a device is still alive
+        
+        :param hostname: Device hostname
+        :param mode: "keepalive" only touches the transport, "prompt" waits for the prompt
+        :return: True if alive, False if it is gone, None if every session is busy
+        """
+        pool = self.get_pool(hostname)
+        if pool is None or pool.size == 0:
+            return False
+        
+        # Only probe an idle session, busy sessions are proof of life
+        ssh_conn = pool.try_checkout_idle()
+        if ssh_conn is None:
+            return None
+        
+        try:
+            if mode == "prompt":
+                alive = bool(ssh_conn.find_prompt())
+            else:
+                alive = ssh_conn.is_alive()
+        except Exception:
+            alive = False
+        
+        pool.checkin(ssh_conn, discard=not alive)
+        if not alive:
+            # Connection is no longer valid, remove it
+            self._disconnect_device(hostname)
+        return alive
+
+    def connect_device(self, connection):
+        """
+        Make sure a device has an established session in its pool
+        
+        :param connection: NetworkConnection database model instance
+        :return: True if connected, False otherwise
+        """
+        pool = self._ensure_pool(connection)
+        breaker = circuit_breakers.get(connection.hostname)
+        
+        try:
+            # Unreachable devices are only retried once their reset timeout is over
+            breaker.acquire()
+        except CircuitOpenError:
+            return False
+        
+        try:
+            # Opens the first session unless a request already did
+            ssh_conn = pool.checkout()
+        except Exception as e:
+            if isinstance(e, PoolTimeout):
+                # Every session is busy, which says nothing about the device
+                breaker.release()
+            else:
+                breaker.failure(e)
+            logger.warning(f"Failed to connect to {connection.hostname}: {str(e)}")
+            return False
+        
+        breaker.success()
+        pool.checkin(ssh_conn)
+        logger.info(f"Successfully connected to {connection.hostname}")
+        return True
+
+    def device_limit(self, connection):
+        """
+        Commands the scheduler lets run on a device at once, the size of its pool
+        """
+        pool = self.get_pool(connection.hostname)
+        return pool.max_size if pool is not None else pool_size_for(connection.hostname, connection.device_type)
+
+    def _ensure_pool(self, connection):
+        """
+        Get the pool of a device, registering an empty one that connects lazily
+        
+        :param connection: NetworkConnection database model instance
+        :return: DeviceSessionPool
+        """
+        with self._lock:
+            pool = self.get_pool(connection.hostname)
+            if pool is None:
+                pool = self._register_pool(
+                    connection.hostname,
+                    connection,
+                    lambda: self._create_connection(connection)
+                )
+        return pool
+
+    def _load_connection(self, hostname):
+        """
+        Load a device from the database
+        
+        :param hostname: Device hostname
+        :return: Detached NetworkConnection or None
+        """
+        db = SessionLocal()
+        try:
+            return db.query(NetworkConnection).filter_by(hostname=hostname).first()
+        finally:
+            db.close()
 
     def _cleanup_extra_connections(self, processed_hostnames):
         """
@@ -141,15 +306,154 @@ class NetworkConnectionManager:
         """
         Disconnect and remove a device from active connections
         """
-        if hostname in self.connections:
-            try:
-                # Disconnect SSH session
-                self.connections[hostname]['ssh_conn'].disconnect()
-            except Exception as e:
-                logger.error(f"Error disconnecting {hostname}: {str(e)}")
-            
-            # Remove from active connections
-            del self.connections[hostname]
+        with self._lock:
+            entry = self.connections.pop(hostname, None)
+        
+        if entry:
+            # Disconnect SSH sessions, busy ones close when they are returned
+            entry['pool'].close()
+            output_cache.invalidate_host(hostname)
+
+    def _register_pool(self, hostname, details, factory, ssh_conn=None):
+        """
+        Create the session pool for a device, replacing any previous one
+        
+        :param hostname: Device hostname
+        :param details: NetworkConnection database model instance
+        :param factory: Callable opening an additional session
+        :param ssh_conn: Already established session to seed the pool with
+        :return: DeviceSessionPool
+        """
+        pool = DeviceSessionPool(
+            hostname,
+            factory,
+            max_size=pool_size_for(hostname, details.device_type)
+        )
+        if ssh_conn:
+            pool.add(ssh_conn)
+        
+        with self._lock:
+            previous = self.connections.get(hostname)
+            self.connections[hostname] = {
+                'pool': pool,
+                'details': details
+            }
+        
+        if previous:
+            previous['pool'].close()
+        output_cache.invalidate_host(hostname)
+        return pool
+
+    def get_pool(self, hostname):
+        """
+        Get the session pool of a device
+        
+        :param hostname: Device hostname
+        :return: DeviceSessionPool or None if the device is not connected
+        """
+        entry = self.connections.get(hostname)
+        return entry['pool'] if entry else None
+
+    def get_details(self, hostname):
+        """
+        Get the database details a device's pool was registered with
+        
+        :param hostname: Device hostname
+        :return: NetworkConnection or None if the device has no pool
+        """
+        entry = self.connections.get(hostname)
+        return entry['details'] if entry else None
+
+    def get_or_create_pool(self, hostname):
+        """
+        Get the session pool of a device, registering it on demand if the
+        device is in the database but has not been connected yet
+        
+        :param hostname: Device hostname
+        :return: DeviceSessionPool or None if the device is unknown
+        """
+        pool = self.get_pool(hostname)
+        if pool is not None:
+            return pool
+        
+        connection = self._load_connection(hostname)
+        if connection is None:
+            return None
+        return self._ensure_pool(connection)
+
+    @contextmanager
+    def session(self, hostname, timeout=None, priority=INTERACTIVE, caller=None):
+        """
+        Check out an SSH session to a device for exclusive use.
+        
+        Devices that are not connected yet are connected on demand, so the
+        caller only waits on this one device. The session is only checked
+        out once the command scheduler gives the caller its turn.
+        
+        :param hostname: Device hostname
+        :param timeout: Seconds to wait for a free session
+        :param priority: Scheduler priority class of the commands
+        :param caller: Client the commands are run for, callers take turns
+        :raises KeyError: If the device is unknown
+        :raises CircuitOpenError: If the device failed recently and is not retried yet
+        :raises QueueFull: If the scheduler did not admit the commands
+        """
+        pool = self.get_or_create_pool(hostname)
+        if pool is None:
+            raise KeyError(f"No connection to {hostname}")
+        
+        breaker = circuit_breakers.get(hostname)
+        breaker.acquire()
+        connected = False
+        try:
+            with command_scheduler.slot(hostname, priority, caller, device_limit=pool.max_size):
+                with pool.session(timeout) as ssh_conn:
+                    connected = True
+                    # A fan-out's device deadline only covers the commands, not the wait for the session
+                    fan_out.mark_started()
+                    yield ssh_conn
+        except (PoolTimeout, PoolClosed, QueueFull):
+            # Waiting on busy or replaced sessions says nothing about the device
+            breaker.release()
+            raise
+        except Exception as e:
+            # Any error while connecting counts, once connected only transport errors do
+            if connected and not isinstance(e, TRANSPORT_ERRORS):
+                breaker.release()
+            else:
+                breaker.failure(e)
+            raise
+        except BaseException:
+            # Abandoned by the caller, e.g. a closed stream
+            breaker.release()
+            raise
+        breaker.success()
+
+    def collect_pool_metrics(self):
+        """
+        Report session pool occupancy summed over all devices, run at scrape time
+        """
+        totals = {'idle': 0, 'in_use': 0, 'creating': 0, 'waiting': 0}
+        for entry in list(self.connections.values()):
+            stats = entry['pool'].stats()
+            for state in totals:
+                totals[state] += stats[state]
+        
+        yield (
+            'ssh_pool_sessions',
+            'Pooled SSH sessions by state',
+            'gauge',
+            [({'state': state}, count) for state, count in totals.items() if state != 'waiting']
+        )
+        yield ('ssh_pool_waiters', 'Requests waiting for a pooled session', 'gauge', [({}, totals['waiting'])])
+        yield ('ssh_pool_devices', 'Devices with a session pool', 'gauge', [({}, len(self.connections))])
+
+    def shrink_pools(self):
+        """
+        Close surplus idle sessions on every device
+        """
+        for entry in list(self.connections.values()):
+            entry['pool'].shrink()
 
     def _create_connection(self, connection):
         """
@@ -171,10 +475,11 @@ class NetworkConnectionManager:
                 # 'password': self._retrieve_password(connection),
                 'username': "mo",
                 'password': 'mo',
-                'fast_cli': True
+                'port': SSH_PORT
             }
             
-            connection_handler = ConnectHandler(**device)
+            # Netmiko or asyncio backend, see transports.TRANSPORT
+            connection_handler = transports.connect(device)
             return connection_handler
         except (NetMikoTimeoutException, NetMikoAuthenticationException) as e:
             logger.error(f"Connection failed for {connection.hostname}: {str(e)}")
@@ -198,12 +503,6 @@ class NetworkConnectionManager:
         logger.warning(f"No secure password found for {connection.hostname}")
         return None
 
-    def periodic_connection_check(self):
-        """
-        Periodically synchronize connections to ensure database state is maintained
-        """
-        self.synchronize_connections()
-
     def add_connection(self, db: Session, connection_details):
         """
         Add a new network connection
@@ -214,17 +513,11 @@ class NetworkConnectionManager:
         """
         try:
             # Prepare device connection details
-            device = {
-                'device_type': connection_details.device_type,
-                'host': connection_details.hostname,
-                'username': connection_details.username,
-                'password': connection_details.password,
-                'fast_cli': True
-            }
+            device = self._device_params(connection_details)
             
             # Attempt to establish SSH connection
             try:
-                ssh_conn = ConnectHandler(**device)
+                ssh_conn = transports.connect(device)
             except (NetMikoTimeoutException, NetMikoAuthenticationException) as e:
                 logger.error(f"Connection failed for {connection_details.hostname}: {str(e)}")
                 raise ConnectionError(f"Failed to establish SSH connection: {str(e)}")
@@ -253,11 +546,19 @@ class NetworkConnectionManager:
                 db.commit()
                 db.refresh(db_connection)
             
-            # Store the SSH connection
-            self.connections[connection_details.hostname] = {
-                'ssh_conn': ssh_conn,
-                'details': db_connection
-            }
+            host_index.add(connection_details.hostname, connection_details.device_type)
+            
+            # Optional per-device pool size
+            if getattr(connection_details, 'max_sessions', None):
+                POOL_SIZE_BY_HOSTNAME[connection_details.hostname] = connection_details.max_sessions
+            
+            # Store the SSH connection, further sessions reuse the same credentials
+            self._register_pool(
+                connection_details.hostname,
+                db_connection,
+                lambda: transports.connect(device),
+                ssh_conn
+            )
             
             return db_connection
         
@@ -266,6 +567,80 @@ class NetworkConnectionManager:
             raise
     
     
+    def _device_params(self, connection_details):
+        """
+        Build Netmiko connection parameters from API connection details
+        """
+        return {
+            'device_type': connection_details.device_type,
+            'host': connection_details.hostname,
+            'username': connection_details.username,
+            'password': connection_details.password,
+            'port': SSH_PORT
+        }
+    
+    def bulk_upsert(self, rows):
+        """
+        Insert or update a batch of devices in a single transaction
+        
+        :param rows: List of connection details from the API request
+        :return: Dictionary of hostname to detached NetworkConnection
+        """
+        # Later rows win for duplicate hostnames
+        rows = {row.hostname: row for row in rows}
+        
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            connections = {
+                connection.hostname: connection
+                for connection in db.query(NetworkConnection).filter(NetworkConnection.hostname.in_(rows))
+            }
+            
+            for hostname, row in rows.items():
+                connection = connections.get(hostname)
+                if connection is None:
+                    connection = NetworkConnection(
+                        hostname=hostname,
+                        username=row.username,
+                        device_type=row.device_type,
+                        is_connected=False
+                    )
+                    db.add(connection)
+                    connections[hostname] = connection
+                else:
+                    connection.username = row.username
+                    connection.device_type = row.device_type
+            
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        
+        for hostname, row in rows.items():
+            host_index.add(hostname, row.device_type)
+            if getattr(row, 'max_sessions', None):
+                POOL_SIZE_BY_HOSTNAME[hostname] = row.max_sessions
+        
+        return connections
+    
+    def bring_up(self, connection_details, db_connection):
+        """
+        Register a device's pool with the given credentials and open its first session
+        
+        :param connection_details: Connection details from the API request
+        :param db_connection: NetworkConnection database model instance
+        :raises Exception: If the SSH session could not be established
+        """
+        device = self._device_params(connection_details)
+        pool = self._register_pool(
+            connection_details.hostname,
+            db_connection,
+            lambda: transports.connect(device)
+        )
+        pool.checkin(pool.checkout())
+    
     def remove_connection(self, db: Session, hostname):
         """
         Remove a network connection
@@ -273,37 +648,28 @@ class NetworkConnectionManager:
         # Remove from database
         conn = db.query(NetworkConnection).filter_by(hostname=hostname).first()
         if conn:
+            status_writer.discard(conn.id)
+            snapshot_store.delete_host(db, hostname)
+            timing_profiles.delete_host(db, hostname)
             db.delete(conn)
             db.commit()
+            # Only after the commit, before it the device's snapshots still use their chunks
+            snapshot_store.delete_orphaned_chunks()
+        host_index.remove(hostname)
+        circuit_breakers.forget(hostname)
         
-        # Remove SSH connection
-        if hostname in self.connections:
-            try:
-                self.connections[hostname]['ssh_conn'].disconnect()
-            except:
-                pass
-            del self.connections[hostname]
+        # Remove SSH connections
+        self._disconnect_device(hostname)
+        transports.forget_host(hostname)
+        # Commands that were still running may have updated the profiles since
+        timing_profiles.discard(hostname)
         
         return True
 
 # Global connection manager
 connection_manager = NetworkConnectionManager()
+metrics.register_collector(connection_manager.collect_pool_metrics)
 
-# Background thread for periodic connection checks
-def start_connection_checker():
-    """
-    Start a background thread to periodically check and sync connections
-    """
-    def job():
-        connection_manager.periodic_connection_check()
-    
-    # Check connections every minute
-    schedule.every(1).minutes.do(job)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
-
-# Start background connection checker
-checker_thread = threading.Thread(target=start_connection_checker, daemon=True)
-checker_thread.start()
\ No newline at end of file
+# Background health checker, spreads device checks across the interval
+health_checker = HealthChecker(connection_manager)
+health_checker.start()
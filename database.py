@@ -1,20 +1,130 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DatabaseError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
+import os
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./network_connections.db"
+try:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+except ImportError:  # Optional, only needed for DATABASE_ASYNC_URL
+    create_async_engine = None
+
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./network_connections.db")
+# Async URL for read endpoints, e.g. "postgresql+asyncpg://user:password@db/ssh";
+# derived from DATABASE_URL for Postgres when asyncpg is installed
+ASYNC_DATABASE_URL = os.environ.get("DATABASE_ASYNC_URL")
+
+# Connections kept open per engine, and extra ones allowed under load
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+# Seconds to wait for a pooled connection
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# Milliseconds SQLite waits on a locked database before failing
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000"))
+
+_url = make_url(SQLALCHEMY_DATABASE_URL)
+_is_sqlite = _url.get_backend_name() == "sqlite"
+_is_memory = _is_sqlite and _url.database in (None, "", ":memory:")
+
+if _is_memory:
+    # Every connection to :memory: would be a separate, empty database
+    from sqlalchemy.pool import StaticPool
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool
+    )
+else:
+    engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False} if _is_sqlite else {},
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_pre_ping=not _is_sqlite
+    )
+
+if _is_sqlite and not _is_memory:
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """
+        Let readers run alongside the writer and wait on locks instead of failing
+        """
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        cursor.close()
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, 
-    connect_args={"check_same_thread": False}
-)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+
+def _async_url():
+    if ASYNC_DATABASE_URL:
+        return ASYNC_DATABASE_URL
+    if _url.get_backend_name() == "postgresql":
+        try:
+            import asyncpg  # noqa: F401
+        except ImportError:
+            return None
+        return _url.set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+    return None
+
+
+async_engine = None
+AsyncSessionLocal = None
+_async_database_url = _async_url() if create_async_engine is not None else None
+if _async_database_url:
+    async_engine = create_async_engine(
+        _async_database_url,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_pre_ping=True
+    )
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+def create_tables(tables=None):
+    """
+    Create missing tables, also when several workers start on a fresh database at once
+
+    :param tables: Tables to create, all models if omitted
+    """
+    for attempt in range(3):
+        try:
+            Base.metadata.create_all(bind=engine, tables=tables)
+            return
+        except DatabaseError:
+            # Another worker created a table between the existence check and the CREATE
+            if attempt == 2:
+                raise
+
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+async def fetch_all(statement):
+    """
+    Run a SELECT of ORM entities and return them detached from the session.
+
+    Uses the async engine when one is configured, otherwise the pooled
+    sync engine in a worker thread, so the event loop never blocks on I/O.
+    """
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            return (await db.scalars(statement)).all()
+
+    def run():
+        with SessionLocal() as db:
+            return db.scalars(statement).all()
+    return await run_in_threadpool(run)
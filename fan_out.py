@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on devices worked on at the same time by a single fan-out
+MAX_WORKERS = int(os.environ.get("FANOUT_MAX_WORKERS", "32"))
+# Seconds a single device may spend on its command once it has started, see mark_started()
+DEVICE_TIMEOUT = float(os.environ.get("FANOUT_DEVICE_TIMEOUT", "60"))
+# Seconds the whole fan-out may take, queued devices included
+TOTAL_TIMEOUT = float(os.environ.get("FANOUT_TOTAL_TIMEOUT", "300"))
+
+# How often the collector wakes up to expire devices that overran their deadline
+_POLL_INTERVAL = 0.25
+
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+STATUS_TIMEOUT = "timeout"
+
+# Per-thread hook of the fan-out worker running on the current thread
+_worker = threading.local()
+
+
+def mark_started():
+    """
+    Start the per-device deadline of the calling fan-out worker.
+
+    Called once a device is actually worked on, i.e. its session has been
+    checked out, so time queued for a scheduler slot or a pooled session
+    does not count against the device. Does nothing outside a fan-out and
+    after the first call.
+    """
+    start = getattr(_worker, "start", None)
+    if start is not None:
+        start()
+
+
+def iter_fan_out(hostnames, func, max_workers=None, device_timeout=None, total_timeout=None):
+    """
+    Run func(hostname) for every hostname on a bounded worker pool and yield
+    results as each device finishes.
+
+    Devices that exceed device_timeout once started, or that have not finished
+    when total_timeout expires, are reported as timed out instead of holding
+    back the others. A device is started when func calls mark_started(),
+    devices that never do are only bound by total_timeout.
+
+    :param hostnames: Iterable of hostnames to run against
+    :param func: Callable taking a hostname and returning its result
+    :param max_workers: Concurrency cap, never above MAX_WORKERS
+    :param device_timeout: Per-device deadline in seconds
+    :param total_timeout: Deadline for the whole fan-out in seconds
+    :return: Generator of (hostname, status, value) tuples where value is the
+             function result, the raised exception or the timeout in seconds
+    """
+    hostnames = list(dict.fromkeys(hostnames))
+    if not hostnames:
+        return
+
+    max_workers = min(max_workers or MAX_WORKERS, MAX_WORKERS, len(hostnames))
+    device_timeout = device_timeout or DEVICE_TIMEOUT
+    total_timeout = total_timeout or TOTAL_TIMEOUT
+
+    started = {}
+    started_lock = threading.Lock()
+
+    def run(hostname):
+        def start():
+            with started_lock:
+                started.setdefault(hostname, time.monotonic())
+
+        _worker.start = start
+        try:
+            return func(hostname)
+        finally:
+            _worker.start = None
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fan-out")
+    deadline = time.monotonic() + total_timeout
+
+    try:
+        pending = {executor.submit(run, hostname): hostname for hostname in hostnames}
+
+        while pending:
+            now = time.monotonic()
+
+            # Expire devices that have been running longer than their own deadline
+            with started_lock:
+                overdue = [
+                    future for future, hostname in pending.items()
+                    if hostname in started and now - started[hostname] >= device_timeout
+                ]
+            for future in overdue:
+                hostname = pending.pop(future)
+                if not future.done():
+                    logger.warning(f"Command on {hostname} timed out after {device_timeout}s")
+                    yield hostname, STATUS_TIMEOUT, device_timeout
+                else:
+                    yield _collect(hostname, future)
+
+            # Global deadline reached: everything left over is reported as timed out
+            if now >= deadline:
+                for future, hostname in pending.items():
+                    future.cancel()
+                    logger.warning(f"Command on {hostname} did not finish before the {total_timeout}s deadline")
+                    yield hostname, STATUS_TIMEOUT, total_timeout
+                break
+
+            if not pending:
+                break
+
+            wakeup = min(deadline - now, _POLL_INTERVAL)
+            done, _ = wait(pending, timeout=wakeup, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                hostname = pending.pop(future)
+                yield _collect(hostname, future)
+
+    finally:
+        # Do not wait for stuck devices, their threads finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fan_out(hostnames, func, max_workers=None, device_timeout=None, total_timeout=None):
+    """
+    Run func(hostname) for every hostname in parallel and collect all results
+
+    :return: List of (hostname, status, value) tuples in completion order
+    """
+    return list(iter_fan_out(hostnames, func, max_workers, device_timeout, total_timeout))
+
+
+def _collect(hostname, future):
+    """
+    Turn a finished future into a (hostname, status, value) tuple
+    """
+    try:
+        return hostname, STATUS_OK, future.result()
+    except Exception as e:
+        return hostname, STATUS_ERROR, e
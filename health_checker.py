@@ -0,0 +1,253 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+
+import metrics
+from database import SessionLocal
+from host_index import host_index
+from models import NetworkConnection
+from resolver import resolver
+from scheduler import command_scheduler, QueueFull, HEALTH_CHECK
+from shards import cluster
+from status_writer import status_writer
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of a healthy device
+CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", "60"))
+# Upper bound for the exponential back-off of failing devices
+MAX_BACKOFF = float(os.environ.get("HEALTH_CHECK_MAX_BACKOFF", "900"))
+# Devices checked or reconnected at the same time
+WORKERS = int(os.environ.get("HEALTH_CHECK_WORKERS", "10"))
+# "keepalive" only touches the transport, "prompt" waits for the device prompt
+PROBE_MODE = os.environ.get("HEALTH_CHECK_PROBE", "keepalive")
+# Seconds between re-reading the device list from the database
+INVENTORY_REFRESH_INTERVAL = float(os.environ.get("HEALTH_CHECK_INVENTORY_REFRESH", "60"))
+
+# Fraction of the interval used to randomize the next due time
+_JITTER = 0.1
+
+
+class HealthChecker:
+    """
+    Incremental health checker.
+
+    Every device has its own next-due time, spread across the check interval
+    so the fleet is never probed all at once. Healthy devices get a cheap
+    liveness probe, failing devices are reconnected with exponential back-off,
+    and status changes are written to the database in batches.
+    """
+
+    def __init__(self, manager):
+        """
+        :param manager: NetworkConnectionManager whose devices are checked
+        """
+        self.manager = manager
+
+        self._heap = []  # (due, hostname)
+        self._due = {}  # hostname -> due time of its live heap entry
+        self._failures = {}  # hostname -> consecutive failures
+        self._devices = {}  # hostname -> NetworkConnection (detached)
+        self._in_progress = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="health-check")
+
+        self._next_inventory_refresh = 0
+        self._next_pool_shrink = 0
+
+    def start(self):
+        """
+        Start the scheduler in a background thread
+        """
+        if self._thread is None:
+            cluster.add_listener(self.refresh_inventory_soon)
+            self._thread = threading.Thread(target=self._run, name="health-checker", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the scheduler and write pending status changes
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+        status_writer.flush()
+
+    def schedule(self, hostname, delay=None):
+        """
+        Schedule the next check of a device
+
+        :param hostname: Device hostname
+        :param delay: Seconds until the check, random within the interval if omitted
+        """
+        if delay is None:
+            delay = random.uniform(0, CHECK_INTERVAL)
+        else:
+            delay += random.uniform(-_JITTER, _JITTER) * delay
+
+        due = time.monotonic() + max(0, delay)
+        with self._lock:
+            self._due[hostname] = due
+            heapq.heappush(self._heap, (due, hostname))
+
+    def device_count(self):
+        """
+        Number of devices checked by this node
+        """
+        return len(self._devices)
+
+    def refresh_inventory_soon(self):
+        """
+        Re-read the inventory on the next pass, used when shard ownership changed
+        """
+        self._next_inventory_refresh = 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+
+            try:
+                if now >= self._next_inventory_refresh:
+                    self._refresh_inventory()
+                    self._next_inventory_refresh = now + INVENTORY_REFRESH_INTERVAL
+
+                for hostname in self._pop_due(now):
+                    self._executor.submit(self._check, hostname)
+
+                if now >= self._next_pool_shrink:
+                    self.manager.shrink_pools()
+                    self._next_pool_shrink = now + CHECK_INTERVAL
+
+            except Exception as e:
+                logger.error(f"Error in health checker: {str(e)}")
+
+            with self._lock:
+                wait = self._heap[0][0] - now if self._heap else 1
+            self._stop.wait(min(max(wait, 0.05), 1))
+
+    def _pop_due(self, now):
+        """
+        Take every device whose check is due off the schedule
+        """
+        due_hostnames = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, hostname = heapq.heappop(self._heap)
+
+                # Skip entries superseded by a later schedule() or a removed device
+                if self._due.get(hostname) != due:
+                    continue
+                del self._due[hostname]
+                metrics.HEALTH_CHECK_LAG_SECONDS.observe(now - due)
+
+                if hostname in self._in_progress:
+                    continue
+                self._in_progress.add(hostname)
+                due_hostnames.append(hostname)
+        return due_hostnames
+
+    def _refresh_inventory(self):
+        """
+        Pick up devices added to or removed from the database, and devices
+        this node gained or lost when sharding
+        """
+        db = SessionLocal()
+        try:
+            inventory = db.query(NetworkConnection).all()
+        finally:
+            db.close()
+        devices = {connection.hostname: connection for connection in inventory if cluster.owns(connection.hostname)}
+
+        added = devices.keys() - self._devices.keys()
+        removed = self._devices.keys() - devices.keys()
+        self._devices = devices
+
+        resolver.prefetch(added)
+        for hostname in added:
+            # Unknown devices are spread randomly across the first interval
+            self.schedule(hostname)
+
+        with self._lock:
+            for hostname in removed:
+                self._due.pop(hostname, None)
+                self._failures.pop(hostname, None)
+
+        # Pick up rows changed outside the API, targets resolve against the whole inventory
+        host_index.load((connection.hostname, connection.device_type) for connection in inventory)
+        
+        # Drop connections that no longer have a database row or moved to another node
+        self.manager._cleanup_extra_connections(devices.keys())
+
+    def _probe(self, connection):
+        """
+        Probe a device and reconnect it if the probe failed
+
+        :return: (alive, time of the check), alive as from probe_connection
+        """
+        alive = self.manager.probe_connection(connection.hostname, mode=PROBE_MODE)
+        now = datetime.utcnow()
+
+        if alive is False:
+            reconnect_start = time.perf_counter()
+            alive = self.manager.connect_device(connection)
+            metrics.RECONNECT_SECONDS.labels("success" if alive else "failure").observe(
+                time.perf_counter() - reconnect_start
+            )
+            if alive:
+                status_writer.queue(connection.id, is_connected=True, last_connected=now, last_check=now)
+        return alive, now
+
+    def _check(self, hostname):
+        """
+        Probe a device and reconnect it if the probe fails
+        """
+        start = time.perf_counter()
+        result = "error"
+        try:
+            connection = self._devices.get(hostname)
+            if connection is None:
+                return
+
+            try:
+                # Commands of users go first, the check waits for its turn
+                with command_scheduler.slot(
+                    hostname, HEALTH_CHECK, "health_checker", device_limit=self.manager.device_limit(connection)
+                ):
+                    alive, now = self._probe(connection)
+            except QueueFull:
+                # Busy with commands all along, leave the status to them until the next check
+                result = "skipped"
+                delay = CHECK_INTERVAL
+            else:
+                result = "failure" if alive is False else "success"
+                if alive is False:
+                    status_writer.queue(connection.id, is_connected=False, last_check=now)
+                    failures = self._failures.get(hostname, 0) + 1
+                    self._failures[hostname] = failures
+                    delay = min(CHECK_INTERVAL * 2 ** failures, MAX_BACKOFF)
+                    logger.warning(f"Health check failed for {hostname} ({failures} in a row), next try in {delay:.0f}s")
+                else:
+                    # None means every session was busy, which proves the device is alive
+                    status_writer.queue(connection.id, is_connected=True, last_check=now)
+                    self._failures.pop(hostname, None)
+                    delay = CHECK_INTERVAL
+
+        except Exception as e:
+            logger.error(f"Error checking {hostname}: {str(e)}")
+            delay = CHECK_INTERVAL
+
+        finally:
+            metrics.HEALTH_CHECK_SECONDS.labels(result).observe(time.perf_counter() - start)
+            with self._lock:
+                self._in_progress.discard(hostname)
+
+        if hostname in self._devices:
+            self.schedule(hostname, delay)
@@ -0,0 +1,199 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+import fnmatch
+import re
+import threading
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# Bracket expressions of a glob pattern, a ']' right after the opening '[' or '[!' is part of the set
+_GLOB_CLASSES = re.compile(r"\[!?\]?[^\]]*\]")
+# Literal runs inside a glob pattern, used to narrow candidates through the trigram index
+_GLOB_LITERALS = re.compile(r"[^*?\[\]]+")
+
+
+class HostIndex:
+    """
+    In-memory index over device hostnames and device types.
+
+    Hostnames are matched case-insensitively like ILIKE. Substring and glob
+    lookups are narrowed through a trigram index, prefix lookups use a
+    sorted list, so resolving targets never touches the database.
+    """
+
+    def __init__(self):
+        self._device_types = {}  # hostname -> device_type
+        self._lower = {}  # hostname -> lowercase hostname
+        self._trigrams = defaultdict(set)  # trigram -> hostnames
+        self._sorted = []  # sorted (lowercase hostname, hostname)
+        self._by_device_type = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._device_types)
+
+    def __contains__(self, hostname):
+        return hostname in self._device_types
+
+    def add(self, hostname, device_type=None):
+        """
+        Add a device or update its device type
+        """
+        with self._lock:
+            self._add(hostname, device_type, keep_sorted=True)
+
+    def _add(self, hostname, device_type, keep_sorted):
+        if hostname in self._device_types:
+            self._by_device_type[self._device_types[hostname]].discard(hostname)
+        else:
+            lower = hostname.lower()
+            self._lower[hostname] = lower
+            for trigram in _trigrams(lower):
+                self._trigrams[trigram].add(hostname)
+            if keep_sorted:
+                insort(self._sorted, (lower, hostname))
+            else:
+                self._sorted.append((lower, hostname))
+
+        self._device_types[hostname] = device_type
+        self._by_device_type[device_type].add(hostname)
+
+    def remove(self, hostname):
+        """
+        Remove a device, unknown hostnames are ignored
+        """
+        with self._lock:
+            if hostname not in self._device_types:
+                return
+            self._by_device_type[self._device_types.pop(hostname)].discard(hostname)
+
+            lower = self._lower.pop(hostname)
+            for trigram in _trigrams(lower):
+                hostnames = self._trigrams[trigram]
+                hostnames.discard(hostname)
+                if not hostnames:
+                    del self._trigrams[trigram]
+
+            position = bisect_left(self._sorted, (lower, hostname))
+            del self._sorted[position]
+
+    def load(self, devices):
+        """
+        Replace the index content
+
+        :param devices: Iterable of (hostname, device_type) pairs
+        """
+        with self._lock:
+            devices = dict(devices)
+            for hostname in set(self._device_types) - set(devices):
+                self.remove(hostname)
+            # Append new hostnames and sort once instead of inserting one by one
+            for hostname, device_type in devices.items():
+                if self._device_types.get(hostname, object()) != device_type:
+                    self._add(hostname, device_type, keep_sorted=False)
+            self._sorted.sort()
+
+    def search(self, text):
+        """
+        Find hostnames containing text, ignoring case
+
+        :return: Sorted list of hostnames
+        """
+        text = text.lower()
+        with self._lock:
+            candidates = self._candidates([text])
+            return sorted(hostname for hostname in candidates if text in self._lower[hostname])
+
+    def prefix(self, text):
+        """
+        Find hostnames starting with text, ignoring case
+        """
+        text = text.lower()
+        with self._lock:
+            position = bisect_left(self._sorted, (text, ""))
+            hostnames = []
+            for lower, hostname in self._sorted[position:]:
+                if not lower.startswith(text):
+                    break
+                hostnames.append(hostname)
+            return hostnames
+
+    def glob(self, pattern):
+        """
+        Find hostnames matching a shell-style pattern, ignoring case
+        """
+        pattern = pattern.lower()
+        matcher = re.compile(fnmatch.translate(pattern))
+        with self._lock:
+            # Characters inside a bracket expression are alternatives, not literals
+            candidates = self._candidates(_GLOB_LITERALS.findall(_GLOB_CLASSES.sub("*", pattern)))
+            return sorted(hostname for hostname in candidates if matcher.match(self._lower[hostname]))
+
+    def regex(self, pattern):
+        """
+        Find hostnames matching a regular expression anywhere, ignoring case
+
+        :raises re.error: If the pattern is invalid
+        """
+        matcher = re.compile(pattern, re.IGNORECASE)
+        with self._lock:
+            return sorted(hostname for hostname in self._device_types if matcher.search(hostname))
+
+    def by_device_type(self, device_type):
+        """
+        Find hostnames of a device type
+        """
+        with self._lock:
+            return sorted(self._by_device_type.get(device_type, ()))
+
+    def select(self, hostname=None, pattern=None, prefix=None, glob=None, regex=None, device_type=None):
+        """
+        Find hostnames matching every given criterion
+
+        :return: Set of hostnames or None if no criterion was given
+        :raises re.error: If regex is invalid
+        """
+        lookups = []
+        if hostname:
+            lookups.append([hostname] if hostname in self else [])
+        if pattern:
+            lookups.append(self.search(pattern))
+        if prefix:
+            lookups.append(self.prefix(prefix))
+        if glob:
+            lookups.append(self.glob(glob))
+        if regex:
+            lookups.append(self.regex(regex))
+        if device_type:
+            lookups.append(self.by_device_type(device_type))
+
+        if not lookups:
+            return None
+        return set(lookups[0]).intersection(*lookups[1:])
+
+    def _candidates(self, literals):
+        """
+        Intersect the trigram postings of every literal long enough to have one
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams |= _trigrams(literal)
+        if not trigrams:
+            return self._device_types.keys()
+
+        postings = [self._trigrams.get(trigram, ()) for trigram in trigrams]
+        # Start from the rarest trigram so intersections stay small
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for hostnames in postings[1:]:
+            if not candidates:
+                break
+            candidates &= hostnames
+        return candidates
+
+
+# Global host index, kept in sync by the connection manager
+host_index = HostIndex()
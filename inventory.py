@@ -0,0 +1,396 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import os
+
+import connection_manager
+import metrics
+import schemas
+from database import SessionLocal
+from models import NetworkConnection
+from shards import cluster
+from status_writer import status_writer
+
+logger = logging.getLogger(__name__)
+
+# Rows upserted per database transaction
+BATCH_SIZE = int(os.environ.get("BULK_IMPORT_BATCH_SIZE", "500"))
+# Devices connected at the same time during an import
+CONNECT_WORKERS = int(os.environ.get("BULK_IMPORT_CONNECT_WORKERS", "50"))
+# Connections queued before reading more input, bounds memory for huge imports
+MAX_PENDING = int(os.environ.get("BULK_IMPORT_MAX_PENDING", "1000"))
+# Rows fetched per round trip while exporting
+EXPORT_BATCH_SIZE = int(os.environ.get("BULK_EXPORT_BATCH_SIZE", "1000"))
+
+FORMATS = ("csv", "json", "ndjson")
+
+_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+# Exported columns; passwords are never stored, so re-importing needs a password column
+EXPORT_FIELDS = ("hostname", "username", "device_type", "is_connected", "last_connected", "last_check")
+
+
+class ImportFormatError(ValueError):
+    """
+    Raised when the import body cannot be read in the requested format
+    """
+
+
+def format_for(content_type):
+    """
+    Map a Content-Type header to an import format
+
+    :return: Format name or None if the type is not supported
+    """
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    return _CONTENT_TYPES.get(media_type)
+
+
+async def _iter_text(chunks):
+    """
+    Decode a byte stream as UTF-8 without splitting multi-byte characters
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+async def _iter_lines(chunks):
+    """
+    Yield complete lines of a text stream without line endings
+    """
+    buffer = ""
+    async for text in _iter_text(chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def _iter_ndjson(chunks):
+    number = 0
+    async for line in _iter_lines(chunks):
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, f"Invalid JSON: {str(e)}"
+
+
+async def _iter_csv(chunks):
+    header = None
+    number = 0
+    pending = ""
+    async for line in _iter_lines(chunks):
+        # Quoted fields may span lines, wait until the quotes are balanced
+        pending = f"{pending}\n{line}" if pending else line
+        if pending.count('"') % 2:
+            continue
+        line, pending = pending, ""
+
+        if not line.strip():
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+
+        number += 1
+        if len(values) > len(header):
+            yield number, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        # Empty cells are treated as missing so optional fields keep their defaults
+        yield number, {name: value for name, value in zip(header, values) if value != ""}, None
+
+    if pending:
+        raise ImportFormatError("Unterminated quoted field at end of CSV input")
+
+
+def _skip_whitespace(text, position):
+    while position < len(text) and text[position] in " \t\r\n":
+        position += 1
+    return position
+
+
+async def _iter_json_array(chunks):
+    """
+    Decode the elements of a top-level JSON array one at a time as they arrive
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    state = "start"  # start -> item <-> separator -> end
+    number = 0
+
+    async for text in _iter_text(chunks):
+        buffer += text
+        position = 0
+        while True:
+            position = _skip_whitespace(buffer, position)
+            if position == len(buffer):
+                break
+            char = buffer[position]
+
+            if state == "start":
+                if char != "[":
+                    raise ImportFormatError("Expected a JSON array of devices")
+                position += 1
+                state = "item"
+            elif state == "separator":
+                if char not in ",]":
+                    raise ImportFormatError(f"Expected ',' or ']' after device {number}")
+                position += 1
+                state = "item" if char == "," else "end"
+            elif state == "item":
+                if char == "]" and number == 0:
+                    position += 1
+                    state = "end"
+                    continue
+                try:
+                    record, position = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    # Most likely an element cut off at the chunk boundary
+                    break
+                number += 1
+                state = "separator"
+                yield number, record, None
+            else:
+                raise ImportFormatError("Unexpected data after the JSON array")
+
+        buffer = buffer[position:]
+
+    if state != "end" or buffer.strip():
+        raise ImportFormatError(f"Incomplete or invalid JSON array after device {number}")
+
+
+def iter_records(chunks, format):
+    """
+    Parse a streamed import body record by record
+
+    :param chunks: Async iterable of body bytes
+    :param format: "csv", "json" (array of objects) or "ndjson"
+    :return: Async generator of (record number, dict or None, error or None)
+    """
+    if format == "csv":
+        return _iter_csv(chunks)
+    if format == "json":
+        return _iter_json_array(chunks)
+    if format == "ndjson":
+        return _iter_ndjson(chunks)
+    raise ImportFormatError(f"Unsupported import format {format!r}")
+
+
+def _bring_up(connection_details, db_connection):
+    """
+    Connect a single imported device, run in the import thread pool
+    """
+    manager = connection_manager.connection_manager
+    now = datetime.utcnow()
+    try:
+        manager.bring_up(connection_details, db_connection)
+    except Exception as e:
+        status_writer.queue(db_connection.id, is_connected=False, last_check=now)
+        return {"hostname": db_connection.hostname, "status": "failed", "error": str(e)}
+
+    status_writer.queue(
+        db_connection.id, is_connected=True, last_connected=now, last_check=now
+    )
+    return {"hostname": db_connection.hostname, "status": "connected"}
+
+
+async def import_devices(records, connect=True, max_workers=None):
+    """
+    Upsert streamed device records in batches and connect them in parallel.
+
+    Input is only read while fewer than MAX_PENDING devices are waiting to
+    be connected, so huge inventories never sit in memory as a whole.
+
+    :param records: Async generator from iter_records
+    :param connect: Open the first SSH session to every imported device
+    :param max_workers: Devices connected at the same time
+    :return: Async generator of one result per device and a final summary
+    """
+    manager = connection_manager.connection_manager
+    executor = ThreadPoolExecutor(
+        max_workers=max_workers or CONNECT_WORKERS,
+        thread_name_prefix="bulk-connect"
+    )
+    summary = {"imported": 0, "connected": 0, "failed": 0, "invalid": 0}
+    pending = set()
+    batch = []
+
+    def count(result):
+        summary[result["status"]] += 1
+        metrics.BULK_IMPORT_DEVICES.labels(result["status"]).inc()
+        return result
+
+    async def upsert(rows):
+        # Later rows of a batch win for duplicate hostnames
+        connections = await run_in_threadpool(manager.bulk_upsert, rows)
+        results = []
+        for row in {row.hostname: row for row in rows}.values():
+            summary["imported"] += 1
+            if connect and cluster.owns(row.hostname):
+                pending.add(asyncio.wrap_future(executor.submit(_bring_up, row, connections[row.hostname])))
+            elif cluster.enabled:
+                # The owning node connects it when it picks up the new rows
+                results.append({"hostname": row.hostname, "status": "imported", "shard": cluster.owner(row.hostname)})
+            else:
+                results.append({"hostname": row.hostname, "status": "imported"})
+        return results
+
+    async def wait(limit):
+        nonlocal pending
+        results = []
+        while len(pending) > limit:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results.extend(count(task.result()) for task in done)
+        return results
+
+    try:
+        try:
+            async for number, record, error in records:
+                if error is None and not isinstance(record, dict):
+                    error = "Expected an object"
+                if error is None:
+                    try:
+                        batch.append(schemas.NetworkConnectionCreate.model_validate(record))
+                    except ValidationError as e:
+                        error = "; ".join(
+                            f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in e.errors()
+                        )
+                if error is not None:
+                    hostname = record.get("hostname") if isinstance(record, dict) else None
+                    yield count({"record": number, "hostname": hostname, "status": "invalid", "error": error})
+
+                if len(batch) >= BATCH_SIZE:
+                    for result in await upsert(batch):
+                        yield result
+                    batch = []
+                    # Report finished devices and hold off reading while the pool is saturated
+                    for result in await wait(MAX_PENDING):
+                        yield result
+                    done = [task for task in pending if task.done()]
+                    pending.difference_update(done)
+                    for task in done:
+                        yield count(task.result())
+
+            if batch:
+                for result in await upsert(batch):
+                    yield result
+
+        except ImportFormatError as e:
+            # Rows read so far are kept, report why the rest was not
+            yield {"status": "error", "error": str(e)}
+
+        for result in await wait(0):
+            yield result
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    logger.info(
+        f"Bulk import finished: {summary['imported']} imported, {summary['connected']} connected, "
+        f"{summary['failed']} failed, {summary['invalid']} invalid"
+    )
+    yield {"summary": summary}
+
+
+async def ndjson_async(records):
+    """
+    Encode an async iterable of records as newline-delimited JSON
+    """
+    async for record in records:
+        yield json.dumps(record) + "\n"
+
+
+class ImportResponse(StreamingResponse):
+    """
+    Streaming response whose body is produced while the request body is still being read.
+
+    StreamingResponse listens for client disconnects on the same receive
+    channel, which would swallow request body chunks; the request stream
+    notices disconnects itself while it is being read.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def export_devices(format):
+    """
+    Stream the device inventory, fetching rows from the database in batches
+
+    :param format: "csv", "json" or "ndjson"
+    :return: Generator of text chunks
+    """
+    db = SessionLocal()
+    try:
+        columns = [getattr(NetworkConnection, field) for field in EXPORT_FIELDS]
+        rows = (
+            db.query(*columns)
+            .order_by(NetworkConnection.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+
+        if format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_FIELDS)
+            for row in rows:
+                writer.writerow([_export_value(value) for value in row])
+                # Flush whole batches, not single rows
+                if buffer.tell() >= 65536:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+            return
+
+        separator = "[\n" if format == "json" else ""
+        for row in rows:
+            record = json.dumps({field: _export_value(value) for field, value in zip(EXPORT_FIELDS, row)})
+            if format == "json":
+                yield separator + record
+                separator = ",\n"
+            else:
+                yield record + "\n"
+        if format == "json":
+            yield "[]\n" if separator == "[\n" else "\n]\n"
+    finally:
+        db.close()
@@ -0,0 +1,624 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import delete, select, update
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+
+import connection_manager
+import metrics
+from database import SessionLocal
+from host_index import host_index
+from models import CollectionJob, JobResult, JobRun
+from scheduler import BATCH
+from shards import cluster
+from snapshots import snapshot_store
+
+logger = logging.getLogger(__name__)
+
+# Devices collected at the same time across all jobs
+WORKERS = int(os.environ.get("JOB_WORKERS", "10"))
+# Commands per second across the fleet, 0 disables the limit
+GLOBAL_RATE = float(os.environ.get("JOB_RATE", "20"))
+# Job executions running on one device at the same time
+DEVICE_CONCURRENCY = int(os.environ.get("JOB_DEVICE_CONCURRENCY", "1"))
+# Commands per second sent to one device, 0 disables the limit
+DEVICE_RATE = float(os.environ.get("JOB_DEVICE_RATE", "1"))
+# Fraction of the interval a run's devices are spread across
+SPREAD = float(os.environ.get("JOB_SPREAD", "0.5"))
+# Runs kept per job, older runs and their results are deleted
+RUN_RETENTION = int(os.environ.get("JOB_RUN_RETENTION", "100"))
+# Seconds between re-reading job definitions, picks up changes made on other nodes
+REFRESH_INTERVAL = float(os.environ.get("JOB_REFRESH_INTERVAL", "30"))
+
+# Seconds before retrying a device that is busy with another job
+_BUSY_RETRY = 0.5
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, acquire() blocks until a token is available
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Tokens added per second, 0 for no limit
+        :param burst: Tokens that can be taken at once after a quiet period
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for it if necessary
+
+        :return: Seconds waited
+        """
+        if self.rate <= 0:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now so concurrent callers queue up behind each other
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def _definition(job):
+    return (job.name, job.targets, job.commands, job.interval, job.enable_mode, job.snapshot, job.enabled)
+
+
+def job_info(job):
+    return {
+        "id": job.id,
+        "name": job.name,
+        "targets": job.targets,
+        "commands": job.commands,
+        "interval": job.interval,
+        "enable_mode": job.enable_mode,
+        "snapshot": job.snapshot,
+        "enabled": job.enabled,
+        "created_at": job.created_at,
+        "last_run_at": job.last_run_at
+    }
+
+
+def run_info(run):
+    return {
+        "id": run.id,
+        "job_id": run.job_id,
+        "status": run.status,
+        "devices": run.devices,
+        "failed_devices": run.failed_devices,
+        "started_at": run.started_at,
+        "finished_at": run.finished_at
+    }
+
+
+class _Run:
+    """
+    In-memory state of a job run while its devices are being collected
+    """
+
+    def __init__(self, run_id, job, hostnames):
+        self.id = run_id
+        self.job = job
+        self.devices = len(hostnames)
+        self.remaining = len(hostnames)
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def device_done(self, failed):
+        """
+        :return: True once every device has finished
+        """
+        with self.lock:
+            self.remaining -= 1
+            if failed:
+                self.failed += 1
+            return self.remaining == 0
+
+
+class JobEngine:
+    """
+    Scheduler for recurring collection jobs.
+
+    Each run resolves its targets through the host index and spreads the
+    devices across part of the interval. Device collections share a
+    bounded worker pool, a fleet-wide rate limit and per-device
+    concurrency and rate limits, and check out sessions from the
+    connection manager's pools. A run that is due while the previous run
+    of the same job is still going is skipped.
+    """
+
+    def __init__(self):
+        self._heap = []  # (due, sequence, kind, payload)
+        self._sequence = itertools.count()
+        self._jobs = {}  # job_id -> detached CollectionJob
+        self._due = {}  # job_id -> due time of its live heap entry
+        self._running = {}  # job_id -> _Run
+        self._device_active = defaultdict(int)
+        self._device_buckets = {}
+        self._global_bucket = TokenBucket(GLOBAL_RATE, burst=max(1, int(GLOBAL_RATE)))
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="job")
+
+    def start(self):
+        """
+        Load the jobs and start the scheduler in a background thread
+        """
+        if self._thread is None:
+            self._refresh_jobs()
+            self._thread = threading.Thread(target=self._run, name="job-engine", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # Job definitions
+
+    def create_job(self, **fields):
+        """
+        Store a new job and schedule it
+
+        :return: Job description
+        """
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            job = CollectionJob(**fields)
+            db.add(job)
+            db.commit()
+        finally:
+            db.close()
+
+        self._set_job(job)
+        return job_info(job)
+
+    def update_job(self, job_id, **fields):
+        """
+        Change a job, the next run follows the new interval
+
+        :raises KeyError: If the job does not exist
+        """
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            job = db.get(CollectionJob, job_id)
+            if job is None:
+                raise KeyError(f"Job {job_id} not found")
+            for name, value in fields.items():
+                setattr(job, name, value)
+            db.commit()
+        finally:
+            db.close()
+
+        self._set_job(job)
+        return job_info(job)
+
+    def delete_job(self, job_id):
+        """
+        Delete a job with its runs and results; a run in progress finishes unrecorded
+
+        :raises KeyError: If the job does not exist
+        """
+        db = SessionLocal()
+        try:
+            job = db.get(CollectionJob, job_id)
+            if job is None:
+                raise KeyError(f"Job {job_id} not found")
+            run_ids = select(JobRun.id).where(JobRun.job_id == job_id)
+            db.execute(delete(JobResult).where(JobResult.run_id.in_(run_ids)))
+            db.execute(delete(JobRun).where(JobRun.job_id == job_id))
+            db.delete(job)
+            db.commit()
+        finally:
+            db.close()
+
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._due.pop(job_id, None)
+
+    def list_jobs(self):
+        """
+        Describe every job with its scheduling state
+        """
+        now = time.monotonic()
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job.id)
+            states = {job.id: (job.id in self._running, self._due.get(job.id)) for job in jobs}
+
+        result = []
+        for job in jobs:
+            info = job_info(job)
+            running, due = states[job.id]
+            info["running"] = running
+            info["next_run_in"] = round(max(0, due - now), 1) if due is not None else None
+            result.append(info)
+        return result
+
+    def get_job(self, job_id):
+        """
+        :raises KeyError: If the job does not exist
+        """
+        for info in self.list_jobs():
+            if info["id"] == job_id:
+                return info
+        raise KeyError(f"Job {job_id} not found")
+
+    def run_now(self, job_id):
+        """
+        Start a run immediately
+
+        :return: False if the job is already running
+        :raises KeyError: If the job does not exist
+        """
+        if job_id not in self._jobs:
+            # Created on another node since the last refresh
+            self._refresh_jobs()
+        with self._lock:
+            if job_id not in self._jobs:
+                raise KeyError(f"Job {job_id} not found")
+            if job_id in self._running:
+                return False
+            self._schedule_job(job_id, 0)
+        self._wakeup.set()
+        return True
+
+    def runs(self, job_id, limit=20):
+        """
+        List the latest runs of a job, newest first
+        """
+        db = SessionLocal()
+        try:
+            runs = db.scalars(
+                select(JobRun).where(JobRun.job_id == job_id).order_by(JobRun.id.desc()).limit(limit)
+            ).all()
+            return [run_info(run) for run in runs]
+        finally:
+            db.close()
+
+    def run_results(self, job_id, run_id, include_output=False):
+        """
+        Describe a run with the result of every device and command
+
+        :raises KeyError: If the run does not exist
+        """
+        db = SessionLocal()
+        try:
+            run = db.get(JobRun, run_id)
+            if run is None or run.job_id != job_id:
+                raise KeyError(f"Run {run_id} of job {job_id} not found")
+
+            info = run_info(run)
+            info["results"] = []
+            for result in db.scalars(select(JobResult).where(JobResult.run_id == run_id).order_by(JobResult.id)):
+                item = {
+                    "hostname": result.hostname,
+                    "command": result.command,
+                    "error": result.error,
+                    "duration": result.duration,
+                    "snapshot_id": result.snapshot_id
+                }
+                if include_output:
+                    if result.output is not None:
+                        item["output"] = zlib.decompress(result.output).decode("utf-8")
+                    elif result.snapshot_id is not None:
+                        try:
+                            item["output"] = snapshot_store.get(result.hostname, snapshot_id=result.snapshot_id)["output"]
+                        except KeyError:
+                            item["output"] = None
+                info["results"].append(item)
+            return info
+        finally:
+            db.close()
+
+    def _refresh_jobs(self):
+        """
+        Pick up jobs created, changed or deleted through any node
+        """
+        db = SessionLocal()
+        try:
+            jobs = {job.id: job for job in db.scalars(select(CollectionJob))}
+        finally:
+            db.close()
+
+        for job_id, job in jobs.items():
+            known = self._jobs.get(job_id)
+            if known is None or _definition(known) != _definition(job):
+                self._set_job(job)
+        with self._lock:
+            for job_id in self._jobs.keys() - jobs.keys():
+                del self._jobs[job_id]
+                self._due.pop(job_id, None)
+
+    def _set_job(self, job):
+        """
+        Keep a job definition in memory and schedule its next run
+        """
+        with self._lock:
+            self._jobs[job.id] = job
+            if not job.enabled:
+                self._due.pop(job.id, None)
+                return
+
+            # Continue the interval of the last run, new jobs start at a random point
+            delay = random.uniform(0, job.interval)
+            if job.last_run_at is not None:
+                since = (datetime.utcnow() - job.last_run_at).total_seconds()
+                delay = max(0, job.interval - since)
+            self._schedule_job(job.id, delay)
+        self._wakeup.set()
+
+    def _schedule_job(self, job_id, delay):
+        """
+        Schedule the next run of a job, called with the lock held
+        """
+        due = time.monotonic() + delay
+        self._due[job_id] = due
+        heapq.heappush(self._heap, (due, next(self._sequence), "job", job_id))
+
+    def _push(self, due, kind, payload):
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._sequence), kind, payload))
+
+    # Scheduling loop
+
+    def _run(self):
+        next_refresh = time.monotonic() + REFRESH_INTERVAL
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_refresh:
+                try:
+                    self._refresh_jobs()
+                except Exception as e:
+                    logger.error(f"Error refreshing jobs: {str(e)}")
+                next_refresh = now + REFRESH_INTERVAL
+
+            due_items = []
+            with self._lock:
+                while self._heap and self._heap[0][0] <= now:
+                    due_items.append(heapq.heappop(self._heap))
+                wait = self._heap[0][0] - now if self._heap else 1
+
+            for due, _, kind, payload in due_items:
+                try:
+                    if kind == "job":
+                        self._start_run(payload, due)
+                    else:
+                        self._dispatch_device(*payload)
+                except Exception as e:
+                    logger.error(f"Error in job engine: {str(e)}")
+
+            self._wakeup.wait(min(max(wait, 0.01), 1))
+            self._wakeup.clear()
+
+    def _start_run(self, job_id, due):
+        with self._lock:
+            # Skip entries superseded by an update or a removed job
+            if self._due.get(job_id) != due:
+                return
+            job = self._jobs[job_id]
+            running = job_id in self._running
+            if job.enabled:
+                self._schedule_job(job_id, job.interval)
+            else:
+                # Started through run_now, a disabled job does not come back on its own
+                del self._due[job_id]
+
+        now = datetime.utcnow()
+        if running:
+            logger.warning(f"Skipping run of job {job.name}, the previous run has not finished")
+            self._record_run(job, "skipped", now, finished_at=now)
+            metrics.JOB_RUNS.labels("skipped").inc()
+            return
+
+        try:
+            hostnames = set()
+            for target in job.targets:
+                hostnames |= host_index.select(**target) or set()
+            # When sharding, every node runs the job on the devices it owns
+            hostnames = sorted(hostname for hostname in hostnames if cluster.owns(hostname))
+        except Exception as e:
+            logger.error(f"Cannot resolve targets of job {job.name}: {str(e)}")
+            self._record_run(job, "failed", now, finished_at=now)
+            metrics.JOB_RUNS.labels("failed").inc()
+            return
+
+        run = _Run(self._record_run(job, "running", now, devices=len(hostnames)), job, hostnames)
+        self._set_last_run(job, now)
+        if not hostnames:
+            self._finish_run(run)
+            return
+
+        with self._lock:
+            self._running[job_id] = run
+
+        # Spread the devices so a large fleet is not hit all at once
+        start = time.monotonic()
+        spread = job.interval * SPREAD
+        for index, hostname in enumerate(hostnames):
+            self._push(start + spread * index / len(hostnames), "device", (run, hostname))
+        self._wakeup.set()
+
+    def _dispatch_device(self, run, hostname):
+        with self._lock:
+            if self._device_active[hostname] >= DEVICE_CONCURRENCY:
+                busy = True
+            else:
+                busy = False
+                self._device_active[hostname] += 1
+        if busy:
+            self._push(time.monotonic() + _BUSY_RETRY, "device", (run, hostname))
+            return
+        self._executor.submit(self._collect_device, run, hostname)
+
+    def _device_bucket(self, hostname):
+        bucket = self._device_buckets.get(hostname)
+        if bucket is None:
+            with self._lock:
+                bucket = self._device_buckets.setdefault(hostname, TokenBucket(DEVICE_RATE))
+        return bucket
+
+    # Collection
+
+    def _collect_device(self, run, hostname):
+        """
+        Run every command of a job on one device, each over a pooled session
+        """
+        job = run.job
+        results = []
+        start = time.perf_counter()
+        try:
+            for command in job.commands:
+                # Wait for the rate limits first, so no slot or session sits idle meanwhile
+                waited = self._global_bucket.acquire() + self._device_bucket(hostname).acquire()
+                metrics.JOB_RATE_LIMIT_WAIT_SECONDS.observe(waited)
+
+                # A session per command, interactive requests get their turn in between
+                with connection_manager.connection_manager.session(hostname, priority=BATCH, caller=f"job:{job.name}") as ssh_conn:
+                    if job.enable_mode:
+                        ssh_conn.enable()
+
+                    command_start = time.perf_counter()
+                    output = ssh_conn.send_command(command)
+                    duration = time.perf_counter() - command_start
+                results.append(self._result(run, hostname, command, output, duration))
+
+        except Exception as e:
+            # The session is discarded, commands not run yet are reported as failed
+            error = f"Command execution error: {str(e)}"
+            done = {result.command for result in results}
+            results.extend(
+                JobResult(run_id=run.id, hostname=hostname, command=command, error=error)
+                for command in job.commands if command not in done
+            )
+
+        finally:
+            with self._lock:
+                self._device_active[hostname] -= 1
+                if not self._device_active[hostname]:
+                    del self._device_active[hostname]
+
+        metrics.JOB_DEVICE_SECONDS.observe(time.perf_counter() - start)
+        failed = any(result.error for result in results)
+        self._save_results(results)
+        if run.device_done(failed):
+            self._finish_run(run)
+
+    def _result(self, run, hostname, command, output, duration):
+        result = JobResult(run_id=run.id, hostname=hostname, command=command, duration=duration)
+        if run.job.snapshot:
+            # Unchanged output costs a hash compare instead of another copy
+            try:
+                result.snapshot_id = snapshot_store.record(hostname, command, output)["id"]
+                return result
+            except Exception as e:
+                logger.error(f"Cannot record snapshot of {hostname}: {str(e)}")
+        result.output = zlib.compress(output.encode("utf-8"))
+        return result
+
+    def _save_results(self, results):
+        db = SessionLocal()
+        try:
+            db.add_all(results)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error saving job results: {str(e)}")
+        finally:
+            db.close()
+
+    def _record_run(self, job, status, started_at, devices=0, finished_at=None):
+        db = SessionLocal()
+        try:
+            run = JobRun(job_id=job.id, status=status, devices=devices, started_at=started_at, finished_at=finished_at)
+            db.add(run)
+            db.commit()
+            return run.id
+        finally:
+            db.close()
+
+    def _set_last_run(self, job, started_at):
+        job.last_run_at = started_at
+        db = SessionLocal()
+        try:
+            db.execute(update(CollectionJob).where(CollectionJob.id == job.id).values(last_run_at=started_at))
+            db.commit()
+        finally:
+            db.close()
+
+    def _finish_run(self, run):
+        with self._lock:
+            if self._running.get(run.job.id) is run:
+                del self._running[run.job.id]
+
+        if run.failed == 0:
+            status = "ok"
+        elif run.failed < run.devices:
+            status = "partial"
+        else:
+            status = "failed"
+        metrics.JOB_RUNS.labels(status).inc()
+
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(JobRun)
+                .where(JobRun.id == run.id)
+                .values(status=status, failed_devices=run.failed, finished_at=datetime.utcnow())
+            )
+            self._prune(db, run.job.id)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error finishing run {run.id} of job {run.job.name}: {str(e)}")
+        finally:
+            db.close()
+
+    def _prune(self, db, job_id):
+        """
+        Delete runs beyond the retention limit together with their results
+        """
+        keep = select(JobRun.id).where(JobRun.job_id == job_id).order_by(JobRun.id.desc()).limit(RUN_RETENTION)
+        old_runs = select(JobRun.id).where(JobRun.job_id == job_id, JobRun.id.not_in(keep))
+        db.execute(delete(JobResult).where(JobResult.run_id.in_(old_runs)))
+        db.execute(delete(JobRun).where(JobRun.job_id == job_id, JobRun.id.not_in(keep)))
+
+    def collect_metrics(self):
+        """
+        Export scheduler state at scrape time
+        """
+        with self._lock:
+            running = len(self._running)
+            active = sum(self._device_active.values())
+            queued = sum(1 for item in self._heap if item[2] == "device")
+        yield ('job_runs_in_progress', 'Job runs currently collecting', 'gauge', [({}, running)])
+        yield ('job_devices_active', 'Devices being collected by jobs', 'gauge', [({}, active)])
+        yield ('job_devices_queued', 'Devices waiting for their turn in a job run', 'gauge', [({}, queued)])
+
+
+# Global job engine
+job_engine = JobEngine()
+job_engine.start()
+metrics.register_collector(job_engine.collect_metrics)
@@ -1,148 +1,754 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
-import re
-import models
-import schemas
-import connection_manager
-from database import engine, get_db
-
-from fastapi import FastAPI, Depends, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from datetime import datetime
+from functools import partial
 from typing import List, Optional
+import math
+import re
 
 import models
 import schemas
 import connection_manager
-from database import engine, get_db
+import fan_out
+import inventory
+import jobs
+import metrics
+import output_cache
+import parsing
+from breaker import circuit_breakers, CircuitOpenError
+from command_stream import stream_command, ndjson
+from compression import CompressionMiddleware
+from host_index import host_index
+from output_filter import OutputFilter
+from scheduler import command_scheduler, QueueFull, BATCH, INTERACTIVE
+from session_pool import PoolTimeout
+from shards import cluster, merge, FORWARDED_HEADER
+from snapshots import snapshot_store
+from timing import timing_profiles
+from database import create_tables, fetch_all, get_db
 
 # Create tables
-models.Base.metadata.create_all(bind=engine)
+create_tables()
 
 app = FastAPI(title="Network SSH Connection Manager")
+# gzip or zstd for large bodies, as negotiated by Accept-Encoding
+app.add_middleware(CompressionMiddleware)
+
+# Names the client commands are run for, defaults to the client address
+CALLER_HEADER = "X-Caller"
+
+class OutputFilterRequest(BaseModel):
+    # Keep lines matching include and not matching exclude (regular expressions)
+    include: Optional[str] = None
+    exclude: Optional[str] = None
+    # First and last lines kept, both together select a range
+    head: Optional[int] = None
+    tail: Optional[int] = None
+    # Cut the output at this many bytes
+    max_bytes: Optional[int] = None
 
 class CommandRequest(BaseModel):
     hostname: str
     command: str
     enable_mode: Optional[bool] = False
+    # Fan-out controls, only used by /connections/mdcommand
+    timeout: Optional[float] = None
+    total_timeout: Optional[float] = None
+    max_workers: Optional[int] = None
+    # Serve recent identical show commands from the output cache
+    use_cache: Optional[bool] = True
+    # Return structured records parsed with TextFSM/TTP templates
+    parse: Optional[bool] = False
+    # Store the output in the device's change history, see /snapshots
+    snapshot: Optional[bool] = False
+    # Trim the returned output on the server, cached and stored outputs stay whole
+    filter: Optional[OutputFilterRequest] = None
+
+class BatchTarget(BaseModel):
+    # All given fields must match; targets in a batch are combined with OR
+    hostname: Optional[str] = None
+    # Case-insensitive substring, like /connections/mdcommand
+    pattern: Optional[str] = None
+    prefix: Optional[str] = None
+    glob: Optional[str] = None
+    regex: Optional[str] = None
+    device_type: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    targets: List[BatchTarget]
+    commands: List[str]
+    enable_mode: Optional[bool] = False
+    # Per-command timeout, a device may take this long for each of its commands
+    timeout: Optional[float] = None
+    total_timeout: Optional[float] = None
+    max_workers: Optional[int] = None
+    use_cache: Optional[bool] = True
+    parse: Optional[bool] = False
+    snapshot: Optional[bool] = False
+    filter: Optional[OutputFilterRequest] = None
+    # Stream one NDJSON record per device instead of a single JSON body
+    stream: Optional[bool] = False
+
+class ShardCommandRequest(BaseModel):
+    # Part of a /connections/mdcommand scattered to the node owning these devices
+    request: CommandRequest
+    hostnames: List[str]
+    # Client of the original request, so callers keep taking turns on this node
+    caller: Optional[str] = None
+
+class ShardBatchRequest(BaseModel):
+    request: BatchRequest
+    hostnames: List[str]
+    caller: Optional[str] = None
+
+class JobRequest(BaseModel):
+    name: str
+    targets: List[BatchTarget]
+    commands: List[str]
+    # Seconds between runs
+    interval: float = Field(..., ge=10)
+    enable_mode: Optional[bool] = False
+    # Keep the output in the change history instead of with the run
+    snapshot: Optional[bool] = False
+    enabled: Optional[bool] = True
 
 def starts_with_show_and_space(show_command):
     pattern = r'^show\s'
     return bool(re.match(pattern, show_command))
 
+def _parse(hostname, command, output):
+    """
+    Parse command output with the template for the device's device_type
+    """
+    details = connection_manager.connection_manager.get_details(hostname)
+    return parsing.parse_output(details.device_type, command, output)
+
+def _snapshot(hostname, command, output):
+    """
+    Record output in the change history, errors are reported instead of raised
+    """
+    try:
+        return {"snapshot": snapshot_store.record(hostname, command, output)}
+    except Exception as e:
+        return {"snapshot_error": str(e)}
+
+def _output_filter(request):
+    """
+    Build the output filter of a request, None if it has none
+    """
+    try:
+        return OutputFilter.from_request(request.filter)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _filtered(output_filter, fields):
+    """
+    Trim the raw output of a result, parsed records are returned whole
+    """
+    if output_filter is not None and isinstance(fields.get("output"), str):
+        fields["output"], truncated = output_filter.apply(fields["output"])
+        if truncated:
+            fields["truncated"] = True
+    return fields
+
+def _output_fields(request, hostname, command, output, output_filter=None):
+    """
+    Build the output part of a result, parsed if the caller asked for it
+    """
+    fields = _snapshot(hostname, command, output) if request.snapshot else {}
+    if not request.parse:
+        fields["output"] = output
+        return _filtered(output_filter, fields)
+    try:
+        fields["parsed"] = _parse(hostname, command, output)
+    except parsing.ParseError as e:
+        # Fall back to the raw output so the caller still gets an answer
+        fields.update(output=output, parse_error=str(e))
+    return _filtered(output_filter, fields)
+
+def _owner(request, hostname):
+    """
+    Find the node a request for a device has to be forwarded to
+    
+    :return: Node URL or None to handle the request here
+    """
+    if request.headers.get(FORWARDED_HEADER) or cluster.owns(hostname):
+        return None
+    return cluster.owner(hostname)
+
+def _caller(request):
+    """
+    Identify the client a request is run for, the scheduler lets callers take turns
+    """
+    return request.headers.get(CALLER_HEADER) or (request.client.host if request.client else None)
+
+def _forward(request, node, body=None, stream=False):
+    """
+    Relay a request to the node owning its device and return that node's response
+    """
+    path = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    # The owner picks the same representation, compression is left to this node
+    forwarded = {CALLER_HEADER: _caller(request)}
+    if "accept" in request.headers:
+        forwarded["Accept"] = request.headers["accept"]
+    try:
+        if stream:
+            status, headers, chunks = cluster.forward_stream(node, request.method, path, body, forwarded)
+            return StreamingResponse(chunks, status_code=status, headers=headers)
+        status, headers, content = cluster.forward(node, request.method, path, body, forwarded)
+    except OSError as e:
+        raise HTTPException(status_code=502, detail=f"Shard {node} unreachable: {str(e)}")
+    return Response(content, status_code=status, headers=headers)
+
+def _gather(node, hostnames, path, body, failed, caller=None):
+    """
+    Yield the records of the devices run on another node, or an error record
+    for every device it did not report
+    """
+    pending = set(hostnames)
+    try:
+        for record in cluster.scatter(node, path, {"request": body, "hostnames": hostnames, "caller": caller}):
+            pending.discard(record["hostname"])
+            yield record
+    except Exception as e:
+        for hostname in hostnames:
+            if hostname in pending:
+                yield failed(hostname, f"Shard {node} failed: {str(e)}")
+
+def _scatter(hostnames, run_local, path, body, failed, caller=None):
+    """
+    Run a fan-out on the nodes owning the devices and yield records as they arrive
+    
+    :param run_local: Callable yielding the records of a list of devices owned here
+    :param path: Endpoint running the part of another node
+    :param failed: Callable building the record of a device whose node failed
+    :param caller: Client the fan-out is run for
+    """
+    sources = []
+    for node, owned in cluster.group(hostnames).items():
+        if node == cluster.url:
+            sources.append(partial(run_local, owned))
+        else:
+            sources.append(partial(_gather, node, owned, path, body, failed, caller))
+    return merge(sources)
+
 @app.post("/connections/command")
 def execute_command(
     # hostname: str, 
     command_request: CommandRequest,
-    db: Session = Depends(get_db)
+    request: Request
 ):
     """
-    Execute a command on a specific network device
+    Execute a command on a specific network device.
+    
+    The output is a JSON string, or the text itself for "Accept: text/plain".
     """
     hostname = command_request.hostname
 
     if not starts_with_show_and_space(command_request.command):
         return {"respone": "Only supports show commands"}
+    output_filter = _output_filter(command_request)
     
-    # Find the connection
-    if hostname not in connection_manager.connection_manager.connections:
+    # When sharding, the node owning the device runs the command
+    node = _owner(request, hostname)
+    if node:
+        return _forward(request, node, command_request.model_dump())
+    
+    # Find the connection, devices not connected yet are connected on demand
+    if connection_manager.connection_manager.get_or_create_pool(hostname) is None:
         raise HTTPException(status_code=404, detail="Connection not found")
     
+    def run():
+        # Check out an SSH session for exclusive use, ahead of fan-outs and health checks
+        with connection_manager.connection_manager.session(hostname, caller=_caller(request)) as ssh_conn:
+            
+            # Optional: Enter enable mode if requested
+            if command_request.enable_mode:
+                ssh_conn.enable()
+            
+            # Execute the command
+            return ssh_conn.send_command(command_request.command)
+    
     try:
-        # Get the SSH connection
-        ssh_conn = connection_manager.connection_manager.connections[hostname]['ssh_conn']
-        
-        # Optional: Enter enable mode if requested
-        if command_request.enable_mode:
-            ssh_conn.enable()
-        
-        # Execute the command
-        output = ssh_conn.send_command(command_request.command)
-        
-        # return {
-        #     "hostname": hostname,
-        #     "command": command_request.command,
-        #     "output": output
-        # }
-        
-        return output
+        output = _cached(command_request, hostname, run)
     
+    except CircuitOpenError as e:
+        raise _circuit_open(e)
+    except QueueFull as e:
+        raise _queue_full(e)
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Command execution error: {str(e)}")
+    
+    # Optional: Keep the output in the change history, the response stays the same
+    if command_request.snapshot:
+        result = _snapshot(hostname, command_request.command, output)
+        if "snapshot_error" in result:
+            raise HTTPException(status_code=500, detail=f"Snapshot error: {result['snapshot_error']}")
+    
+    # Optional: Return structured records instead of raw text
+    if command_request.parse:
+        try:
+            return _parse(hostname, command_request.command, output)
+        except parsing.ParseError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    
+    # Optional: Only return the lines the caller asked for
+    if output_filter is not None:
+        output, _ = output_filter.apply(output)
+    
+    # return {
+    #     "hostname": hostname,
+    #     "command": command_request.command,
+    #     "output": output
+    # }
+    
+    # Raw text spares clients decoding a JSON-escaped string
+    if "text/plain" in request.headers.get("accept", ""):
+        return PlainTextResponse(output)
+    return output
 
-@app.post("/connections/mdcommand")
-def execute_command(
+@app.post("/connections/command/stream")
+def stream_device_command(
     command_request: CommandRequest,
-    db: Session = Depends(get_db)
+    request: Request
 ):
     """
-    Execute a command on a specific network device or all devices matching a partial hostname
+    Execute a command on a specific network device and stream its output
+    line by line as plain text while it is read off the channel
     """
     hostname = command_request.hostname
-    
+
     if not starts_with_show_and_space(command_request.command):
-        return "Only supports show commands"
-    # Find all connections that match the partial hostname
-    matching_connections = db.query(models.NetworkConnection).filter(
-        models.NetworkConnection.hostname.ilike(f"%{hostname}%")
-    ).all()
+        return {"respone": "Only supports show commands"}
+    output_filter = _output_filter(command_request)
     
-    if not matching_connections:
-        raise HTTPException(status_code=404, detail="No matching connections found")
+    node = _owner(request, hostname)
+    if node:
+        return _forward(request, node, command_request.model_dump(), stream=True)
     
-    results = []
+    # Find the connection before the response starts
+    if connection_manager.connection_manager.get_or_create_pool(hostname) is None:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    try:
+        circuit_breakers.get(hostname).check()
+        command_scheduler.check(INTERACTIVE)
+    except CircuitOpenError as e:
+        raise _circuit_open(e)
+    except QueueFull as e:
+        raise _queue_full(e)
+    caller = _caller(request)
     
-    for connection in matching_connections:
+    def lines():
         try:
-            # Get the SSH connection
-            ssh_conn = connection_manager.connection_manager.connections[connection.hostname]['ssh_conn']
+            # The session stays checked out until the stream is finished
+            with connection_manager.connection_manager.session(hostname, caller=caller) as ssh_conn:
+                if command_request.enable_mode:
+                    ssh_conn.enable()
+                
+                lines = stream_command(
+                    ssh_conn,
+                    command_request.command,
+                    read_timeout=command_request.timeout or fan_out.DEVICE_TIMEOUT
+                )
+                # Filtered while reading, lines past the limits are never sent
+                if output_filter is not None:
+                    lines = output_filter.lines(lines)
+                for line in lines:
+                    yield line + "\n"
+        except Exception as e:
+            # Headers are already sent, report the failure in-band
+            yield f"Command execution error: {str(e)}\n"
+    
+    return StreamingResponse(lines(), media_type="text/plain")
+
+def _circuit_open(error):
+    """
+    Fail fast for a device whose circuit is open, telling clients when to retry
+    """
+    return HTTPException(
+        status_code=503,
+        detail=str(error),
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    )
+
+def _queue_full(error):
+    """
+    Reject a request the command scheduler has no room for, telling clients when to retry
+    """
+    return HTTPException(
+        status_code=429,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def _admit_batch():
+    """
+    Turn a fan-out away before it starts while batch commands are backed up
+    """
+    try:
+        command_scheduler.check(BATCH)
+    except QueueFull as e:
+        raise _queue_full(e)
+
+def _find_matching_hostnames(hostname):
+    """
+    Find all hostnames that match the partial hostname
+    """
+    with metrics.TARGET_RESOLVE_SECONDS.labels("mdcommand").time():
+        hostnames = host_index.search(hostname)
+    
+    if not hostnames:
+        raise HTTPException(status_code=404, detail="No matching connections found")
+    
+    return hostnames
+
+def _cached(command_request, hostname, run, command=None, join=True):
+    """
+    Run a command through the output cache unless the caller opted out
+    
+    :param join: False for callers already holding a session, see OutputCache.get_or_run
+    """
+    if not command_request.use_cache:
+        return run()
+    return output_cache.output_cache.get_or_run(
+        hostname,
+        command or command_request.command,
+        command_request.enable_mode,
+        run,
+        join=join
+    )
+
+def _iter_command_results(command_request, hostnames, caller=None):
+    """
+    Run a command on several devices at once and yield one result per device
+    as soon as it finishes
+    """
+    output_filter = OutputFilter.from_request(command_request.filter)
+    
+    def send(hostname):
+        # Check out an SSH session for exclusive use, after interactive commands
+        with connection_manager.connection_manager.session(hostname, priority=BATCH, caller=caller) as ssh_conn:
             
             # Optional: Enter enable mode if requested
             if command_request.enable_mode:
                 ssh_conn.enable()
             
-            # Execute the command
-            output = ssh_conn.send_command(command_request.command)
+            # Execute the command, bounded by the given or the device's learned timeout
+            return ssh_conn.send_command(
+                command_request.command,
+                read_timeout=command_request.timeout
+            )
+    
+    def run(hostname):
+        output = _cached(command_request, hostname, lambda: send(hostname))
+        # Parse and filter in the worker thread so devices are handled in parallel
+        return _output_fields(command_request, hostname, command_request.command, output, output_filter)
+    
+    # Run on all matching devices at once, slow devices do not hold back the others
+    for device, status, value in fan_out.iter_fan_out(
+        hostnames,
+        run,
+        max_workers=command_request.max_workers,
+        device_timeout=command_request.timeout,
+        total_timeout=command_request.total_timeout
+    ):
+        result = {
+            "hostname": device,
+            "command": command_request.command
+        }
+        if status == fan_out.STATUS_OK:
+            result.update(value)
+        elif status == fan_out.STATUS_TIMEOUT:
+            result["error"] = f"Command timed out after {value}s"
+            result["timed_out"] = True
+        elif isinstance(value, CircuitOpenError):
+            result["error"] = str(value)
+            result["circuit_open"] = True
+        elif isinstance(value, QueueFull):
+            result["error"] = str(value)
+            result["rejected"] = True
+        else:
+            result["error"] = f"Command execution error: {str(value)}"
+        yield result
+
+def _iter_sharded_command_results(command_request, hostnames, caller=None):
+    """
+    Same as _iter_command_results, devices owned by other nodes run there
+    """
+    return _scatter(
+        hostnames,
+        partial(_iter_command_results, command_request, caller=caller),
+        "/shards/mdcommand",
+        command_request.model_dump(),
+        lambda hostname, error: {"hostname": hostname, "command": command_request.command, "error": error},
+        caller
+    )
+
+@app.post("/connections/mdcommand")
+def execute_command(
+    command_request: CommandRequest,
+    request: Request
+):
+    """
+    Execute a command on a specific network device or all devices matching a partial hostname
+    """
+    if not starts_with_show_and_space(command_request.command):
+        return "Only supports show commands"
+    _output_filter(command_request)
+    _admit_batch()
+    
+    hostnames = _find_matching_hostnames(command_request.hostname)
+    
+    return list(_iter_sharded_command_results(command_request, hostnames, _caller(request)))
+
+@app.post("/connections/mdcommand/stream")
+def stream_command_results(
+    command_request: CommandRequest,
+    request: Request
+):
+    """
+    Same as /connections/mdcommand, but streams one NDJSON record per device
+    as soon as that device has finished
+    """
+    if not starts_with_show_and_space(command_request.command):
+        return "Only supports show commands"
+    _output_filter(command_request)
+    _admit_batch()
+    
+    hostnames = _find_matching_hostnames(command_request.hostname)
+    
+    return StreamingResponse(
+        ndjson(_iter_sharded_command_results(command_request, hostnames, _caller(request))),
+        media_type="application/x-ndjson"
+    )
+
+
+def _resolve_target(target):
+    """
+    Find the hostnames matching every field of one batch target
+    
+    :return: Set of hostnames or None if the target has no fields
+    """
+    try:
+        return host_index.select(**target.model_dump())
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid regex {target.regex!r}: {str(e)}")
+
+def _resolve_batch_targets(targets):
+    """
+    Find all hostnames matching any of the batch targets
+    """
+    with metrics.TARGET_RESOLVE_SECONDS.labels("batch").time():
+        resolved = [_resolve_target(target) for target in targets]
+    
+    resolved = [hostnames for hostnames in resolved if hostnames is not None]
+    if not resolved:
+        raise HTTPException(status_code=400, detail="No targets given")
+    
+    hostnames = sorted(set().union(*resolved))
+    if not hostnames:
+        raise HTTPException(status_code=404, detail="No matching connections found")
+    
+    return hostnames
+
+def _iter_batch_results(batch_request, hostnames, caller=None):
+    """
+    Run every command on every device and yield (hostname, results) per device.
+    
+    Commands run back-to-back on one checked-out session per device, devices
+    run in parallel.
+    """
+    commands = list(dict.fromkeys(batch_request.commands))
+    # Without a timeout every command waits as long as its device usually needs
+    read_timeout = batch_request.timeout
+    output_filter = OutputFilter.from_request(batch_request.filter)
+    
+    def run(hostname):
+        results = {}
+        try:
+            # Cached outputs are answered without waiting for a slot or a session
+            if batch_request.use_cache:
+                for command in commands:
+                    output = output_cache.output_cache.get(hostname, command, batch_request.enable_mode)
+                    if output is not None:
+                        results[command] = _output_fields(batch_request, hostname, command, output, output_filter)
+            remaining = [command for command in commands if command not in results]
+            if not remaining:
+                return results
             
-            results.append({
-                "hostname": connection.hostname,
-                "command": command_request.command,
-                "output": output
-            })
-        
+            # One session for all other commands of this device, after interactive commands
+            with connection_manager.connection_manager.session(hostname, priority=BATCH, caller=caller) as ssh_conn:
+                if batch_request.enable_mode:
+                    ssh_conn.enable()
+                
+                for command in remaining:
+                    # Never wait on a request in flight while holding the session it may need
+                    output = _cached(
+                        batch_request,
+                        hostname,
+                        lambda: ssh_conn.send_command(command, read_timeout=read_timeout),
+                        command,
+                        join=False
+                    )
+                    results[command] = _output_fields(batch_request, hostname, command, output, output_filter)
+        except CircuitOpenError as e:
+            for command in commands:
+                results.setdefault(command, {"error": str(e), "circuit_open": True})
+        except QueueFull as e:
+            for command in commands:
+                results.setdefault(command, {"error": str(e), "rejected": True})
         except Exception as e:
-            results.append({
-                "hostname": connection.hostname,
-                "command": command_request.command,
-                "error": f"Command execution error: {str(e)}"
-            })
+            # The session is discarded, the remaining commands are not attempted
+            for command in commands:
+                results.setdefault(command, {"error": f"Command execution error: {str(e)}"})
+        # In the order of the request, cached outputs were filled in first
+        return {command: results[command] for command in commands}
     
-    return results
+    for device, status, value in fan_out.iter_fan_out(
+        hostnames,
+        run,
+        max_workers=batch_request.max_workers,
+        device_timeout=(read_timeout or fan_out.DEVICE_TIMEOUT) * len(commands),
+        total_timeout=batch_request.total_timeout
+    ):
+        if status == fan_out.STATUS_OK:
+            yield device, value
+        elif status == fan_out.STATUS_TIMEOUT:
+            yield device, {
+                command: {"error": f"Command timed out after {value}s", "timed_out": True}
+                for command in commands
+            }
+        else:
+            yield device, {
+                command: {"error": f"Command execution error: {str(value)}"}
+                for command in commands
+            }
+
+@app.post("/connections/batch")
+def execute_batch(
+    batch_request: BatchRequest,
+    request: Request
+):
+    """
+    Execute several commands on every device matching the targets.
+    
+    Returns results keyed by hostname and command, or streams one NDJSON
+    record per device when stream is set.
+    """
+    if not batch_request.commands:
+        raise HTTPException(status_code=400, detail="No commands given")
+    if not all(starts_with_show_and_space(command) for command in batch_request.commands):
+        return "Only supports show commands"
+    _output_filter(batch_request)
+    _admit_batch()
+    
+    hostnames = _resolve_batch_targets(batch_request.targets)
+    commands = list(dict.fromkeys(batch_request.commands))
+    caller = _caller(request)
+    records = _scatter(
+        hostnames,
+        lambda owned: ({"hostname": device, "results": value} for device, value in _iter_batch_results(batch_request, owned, caller)),
+        "/shards/batch",
+        batch_request.model_dump(),
+        lambda hostname, error: {"hostname": hostname, "results": {command: {"error": error} for command in commands}},
+        caller
+    )
+    
+    if batch_request.stream:
+        return StreamingResponse(ndjson(records), media_type="application/x-ndjson")
+    return {record["hostname"]: record["results"] for record in records}
 
 
 @app.post("/connections/", response_model=schemas.NetworkConnectionResponse)
 def create_connection(
     connection: schemas.NetworkConnectionCreate, 
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """
     Add a new network device SSH connection
     """
+    node = _owner(request, connection.hostname)
+    if node:
+        response = _forward(request, node, connection.model_dump())
+        if response.status_code == 200:
+            # Resolve targets to the new device here too without waiting for the next refresh
+            host_index.add(connection.hostname, connection.device_type)
+        return response
+    
     try:
         new_conn = connection_manager.connection_manager.add_connection(db, connection)
         return new_conn
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/connections/bulk")
+async def import_connections(
+    request: Request,
+    format: Optional[str] = None,
+    connect: bool = True,
+    max_workers: Optional[int] = None
+):
+    """
+    Add or update many network devices from a CSV, JSON array or NDJSON body.
+    
+    The body is read as it arrives and upserted in batches. Devices are
+    connected in parallel and one NDJSON result per device is streamed back
+    as soon as it is known, followed by a summary record.
+    """
+    format = format or inventory.format_for(request.headers.get("content-type"))
+    if format not in inventory.FORMATS:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported import format, use one of: {', '.join(inventory.FORMATS)}"
+        )
+    
+    records = inventory.iter_records(request.stream(), format)
+    return inventory.ImportResponse(
+        inventory.ndjson_async(inventory.import_devices(records, connect, max_workers)),
+        media_type="application/x-ndjson"
+    )
+
+@app.get("/connections/export")
+def export_connections(format: str = "ndjson"):
+    """
+    Stream the device inventory as CSV, a JSON array or NDJSON
+    """
+    if format not in inventory.FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported export format, use one of: {', '.join(inventory.FORMATS)}"
+        )
+    
+    return StreamingResponse(
+        inventory.export_devices(format),
+        media_type=inventory.EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename=connections.{format}"}
+    )
+
 @app.delete("/connections/{hostname}")
 def remove_connection(
     hostname: str, 
+    request: Request,
     db: Session = Depends(get_db)
 ):
     """
     Remove a network device SSH connection
     """
+    node = _owner(request, hostname)
+    if node:
+        response = _forward(request, node)
+        if response.status_code == 200:
+            host_index.remove(hostname)
+        return response
+    
     try:
         connection_manager.connection_manager.remove_connection(db, hostname)
         return {"message": f"Connection to {hostname} removed successfully"}
@@ -150,25 +756,300 @@ def remove_connection(
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.get("/connections/", response_model=List[schemas.NetworkConnectionResponse])
-def list_connections(db: Session = Depends(get_db)):
+async def list_connections():
     """
     List all network device connections
     """
-    connections = db.query(models.NetworkConnection).all()
+    connections = await fetch_all(select(models.NetworkConnection))
     return connections
 
-@app.get("/connections/{hostname}/status", response_model=schemas.NetworkConnectionResponse)
-def get_connection_status(
-    hostname: str, 
-    db: Session = Depends(get_db)
+@app.get("/connections/{hostname}/status", response_model=schemas.NetworkConnectionStatus)
+async def get_connection_status(
+    hostname: str,
+    request: Request
 ):
     """
-    Get status of a specific network device connection
+    Get status of a specific network device connection with its learned timing
+    and circuit breaker state
     """
-    connection = db.query(models.NetworkConnection).filter_by(hostname=hostname).first()
+    # Live state is kept by the node owning the device
+    node = _owner(request, hostname)
+    if node:
+        return await run_in_threadpool(_forward, request, node)
+    
+    connections = await fetch_all(select(models.NetworkConnection).filter_by(hostname=hostname))
+    connection = connections[0] if connections else None
     if not connection:
         raise HTTPException(status_code=404, detail="Connection not found")
-    return connection
+    
+    status = schemas.NetworkConnectionStatus.model_validate(connection)
+    status.timing = schemas.TimingProfileResponse(**timing_profiles.describe(hostname, connection.device_type))
+    status.circuit = schemas.CircuitBreakerResponse(**circuit_breakers.describe(hostname))
+    return status
+
+@app.get("/snapshots/{hostname}")
+def list_snapshots(
+    hostname: str,
+    command: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=1000)
+):
+    """
+    List the stored outputs of a device, newest first, without their text
+    """
+    try:
+        return snapshot_store.history(hostname, command, limit)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/snapshots/{hostname}/latest")
+def get_latest_snapshot(
+    hostname: str,
+    command: str,
+    at: Optional[datetime] = None
+):
+    """
+    Get the latest output of a command, or the one current at a given time
+    """
+    try:
+        return snapshot_store.get(hostname, command, at=at)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/snapshots/{hostname}/diff")
+def diff_snapshots(
+    hostname: str,
+    command: Optional[str] = None,
+    from_id: Optional[int] = None,
+    to_id: Optional[int] = None,
+    from_time: Optional[datetime] = None,
+    to_time: Optional[datetime] = None,
+    context: int = Query(3, ge=0, le=100)
+):
+    """
+    Unified diff between two outputs of a command.
+    
+    Points are given by snapshot id or by time; the newer one defaults to
+    the latest output and the older one to the output just before it.
+    """
+    try:
+        return snapshot_store.diff(hostname, command, from_id, to_id, from_time, to_time, context)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/snapshots/{hostname}/{snapshot_id}")
+def get_snapshot(
+    hostname: str,
+    snapshot_id: int
+):
+    """
+    Get a stored output by its id
+    """
+    try:
+        return snapshot_store.get(hostname, snapshot_id=snapshot_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def _job_fields(job_request):
+    """
+    Validate a job definition and convert it to column values
+    """
+    if not job_request.commands:
+        raise HTTPException(status_code=400, detail="No commands given")
+    if not all(starts_with_show_and_space(command) for command in job_request.commands):
+        raise HTTPException(status_code=400, detail="Only supports show commands")
+    targets = [target.model_dump(exclude_none=True) for target in job_request.targets]
+    if not targets or not all(targets):
+        raise HTTPException(status_code=400, detail="Every target needs at least one field")
+    for target in job_request.targets:
+        _resolve_target(target)
+    fields = job_request.model_dump()
+    fields["targets"] = targets
+    return fields
+
+@app.post("/jobs")
+def create_job(
+    job_request: JobRequest
+):
+    """
+    Define a recurring collection job.
+    
+    Runs are spread across the interval and share the fleet-wide and
+    per-device rate limits with all other jobs.
+    """
+    try:
+        return jobs.job_engine.create_job(**_job_fields(job_request))
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail=f"Job {job_request.name} already exists")
+
+@app.get("/jobs")
+def list_jobs():
+    """
+    List collection jobs with their scheduling state
+    """
+    return jobs.job_engine.list_jobs()
+
+@app.get("/jobs/{job_id}")
+def get_job(
+    job_id: int
+):
+    try:
+        return jobs.job_engine.get_job(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.put("/jobs/{job_id}")
+def update_job(
+    job_id: int,
+    job_request: JobRequest
+):
+    """
+    Replace a job definition, the next run follows the new interval
+    """
+    try:
+        return jobs.job_engine.update_job(job_id, **_job_fields(job_request))
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail=f"Job {job_request.name} already exists")
+
+@app.delete("/jobs/{job_id}")
+def delete_job(
+    job_id: int
+):
+    """
+    Delete a job with its run history
+    """
+    try:
+        jobs.job_engine.delete_job(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"message": f"Job {job_id} deleted"}
+
+@app.post("/jobs/{job_id}/run")
+def run_job(
+    job_id: int,
+    request: Request
+):
+    """
+    Start a run now instead of waiting for the next one.
+    
+    When sharding, every node starts a run on the devices it owns.
+    """
+    try:
+        started = jobs.job_engine.run_now(job_id)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if not started:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is already running")
+    
+    result = {"message": f"Job {job_id} started"}
+    if cluster.enabled and not request.headers.get(FORWARDED_HEADER):
+        result["shards"] = {cluster.url: 200}
+        for node in cluster.members():
+            if node != cluster.url:
+                try:
+                    result["shards"][node] = cluster.forward(node, "POST", request.url.path)[0]
+                except OSError as e:
+                    result["shards"][node] = str(e)
+    return result
+
+@app.get("/jobs/{job_id}/runs")
+def list_job_runs(
+    job_id: int,
+    limit: int = Query(20, ge=1, le=1000)
+):
+    """
+    List the latest runs of a job, newest first
+    """
+    return jobs.job_engine.runs(job_id, limit)
+
+@app.get("/jobs/{job_id}/runs/{run_id}")
+def get_job_run(
+    job_id: int,
+    run_id: int,
+    output: bool = False
+):
+    """
+    Get the per-device results of a run, with their output if asked for
+    """
+    try:
+        return jobs.job_engine.run_results(job_id, run_id, include_output=output)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/shards")
+def get_shards():
+    """
+    Describe the nodes sharing the inventory and how many devices this one owns
+    """
+    info = cluster.info()
+    info["owned_devices"] = connection_manager.health_checker.device_count()
+    return info
+
+@app.post("/shards/mdcommand")
+def run_shard_command(
+    shard_request: ShardCommandRequest
+):
+    """
+    Run the part of a scattered /connections/mdcommand owned by this node
+    """
+    return StreamingResponse(
+        ndjson(_iter_command_results(shard_request.request, shard_request.hostnames, shard_request.caller)),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/shards/batch")
+def run_shard_batch(
+    shard_request: ShardBatchRequest
+):
+    """
+    Run the part of a scattered /connections/batch owned by this node
+    """
+    results = _iter_batch_results(shard_request.request, shard_request.hostnames, shard_request.caller)
+    return StreamingResponse(
+        ndjson({"hostname": device, "results": value} for device, value in results),
+        media_type="application/x-ndjson"
+    )
+
+@app.get("/ready")
+def get_readiness():
+    """
+    Report progress of the background connection warm-up after startup.
+    
+    Requests are served during warm-up, devices are connected on demand.
+    """
+    return connection_manager.connection_manager.readiness()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Export metrics in the Prometheus text format
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/scheduler/stats")
+def get_scheduler_stats():
+    """
+    Get queue depth, running commands and wait times per priority class
+    """
+    return command_scheduler.stats()
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    """
+    Get hit/miss counters of the command output cache
+    """
+    return output_cache.output_cache.stats()
+
+@app.delete("/cache")
+def clear_cache():
+    """
+    Drop all cached command output
+    """
+    output_cache.output_cache.clear()
+    return {"message": "Output cache cleared"}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,303 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# Default latency buckets in seconds, from DNS lookups to slow show commands
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Base class of labelled metrics, children are created on first use
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._new_child()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, *values):
+        """
+        Get the child metric for a set of label values
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self):
+        if not self.labelnames:
+            return [((), self._default)]
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._samples():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observe the duration of a with block in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def register_collector(collect):
+    """
+    Register a callable run at scrape time, used to export state such as pool
+    occupancy without touching the hot path
+
+    :param collect: Callable returning an iterable of (name, documentation, kind, [(labels, value)])
+    """
+    with _registry_lock:
+        _collectors.append(collect)
+
+
+def render():
+    """
+    Render every metric in the Prometheus text exposition format
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    for collect in collectors:
+        for name, documentation, kind, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+def command_label(command):
+    """
+    Reduce a command to its first words to keep label cardinality bounded
+    """
+    return " ".join(command.split()[:3])
+
+
+# Connection establishment
+DNS_SECONDS = Histogram("ssh_dns_resolve_seconds", "Time spent resolving device hostnames")
+DNS_CACHE_LOOKUPS = Counter("dns_cache_lookups_total", "Hostname lookups by cache result", ["result"])
+CONNECT_SECONDS = Histogram(
+    "ssh_connect_seconds", "Time to open an SSH session and prepare the terminal", ["device_type"]
+)
+CONNECT_TOTAL = Counter("ssh_connect_total", "SSH connection attempts", ["result"])
+SESSION_OPEN_SECONDS = Histogram(
+    "ssh_session_open_seconds", "Time to open a session, over a new or a multiplexed transport", ["path"]
+)
+RECONNECT_SECONDS = Histogram(
+    "ssh_reconnect_seconds", "Time to reconnect a device after its connection was lost", ["result"]
+)
+HOST_KEY_MISMATCHES = Counter("ssh_host_key_mismatches_total", "Connections refused because the host key changed")
+
+# Command execution
+ENABLE_SECONDS = Histogram(
+    "ssh_enable_seconds", "Time spent entering enable mode, reused when the session already was privileged", ["result"]
+)
+PROMPT_CHANGES = Counter("ssh_prompt_changes_total", "Sessions whose prompt changed, so their state was checked again")
+COMMAND_SECONDS = Histogram("ssh_command_seconds", "Command latency per command", ["command"])
+DEVICE_COMMAND_SECONDS = Histogram("ssh_device_command_seconds", "Command latency per device", ["hostname"])
+COMMAND_ERRORS = Counter("ssh_command_errors_total", "Commands that raised an error", ["command"])
+OUTPUT_BYTES = Counter("ssh_command_output_bytes_total", "Bytes of command output read", ["command"])
+OUTPUT_SIZE = Histogram("ssh_command_output_bytes", "Size of command output", buckets=SIZE_BUCKETS)
+
+# Session pools
+CHECKOUT_WAIT_SECONDS = Histogram("ssh_pool_checkout_wait_seconds", "Time spent waiting for a pooled session")
+CHECKOUT_TIMEOUTS = Counter("ssh_pool_checkout_timeouts_total", "Checkouts that gave up waiting")
+
+# Target resolution through the in-memory host index
+TARGET_RESOLVE_SECONDS = Histogram(
+    "target_resolve_seconds", "Time to resolve request targets to hostnames", ["endpoint"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+)
+
+# Health checker
+HEALTH_CHECK_SECONDS = Histogram("health_check_seconds", "Duration of a single device health check", ["result"])
+HEALTH_CHECK_LAG_SECONDS = Histogram(
+    "health_check_lag_seconds", "Delay between a health check falling due and starting"
+)
+
+# Bulk import
+BULK_IMPORT_DEVICES = Counter("bulk_import_devices_total", "Devices processed by bulk imports", ["result"])
+
+# Write-behind status updates
+STATUS_WRITES = Counter("status_writes_total", "Device status rows written by the status writer")
+STATUS_FLUSH_SECONDS = Histogram("status_flush_seconds", "Duration of one batched status write")
+STATUS_DROPPED = Counter("status_writes_dropped_total", "Queued device status updates that were not written", ["reason"])
+
+# Output snapshots
+SNAPSHOTS = Counter("output_snapshots_total", "Recorded command outputs by whether they changed", ["result"])
+SNAPSHOT_CHUNKS = Counter(
+    "output_snapshot_chunks_total", "Snapshot chunks written or found already stored", ["result"]
+)
+
+# Collection jobs
+JOB_RUNS = Counter("job_runs_total", "Finished collection job runs", ["status"])
+JOB_DEVICE_SECONDS = Histogram("job_device_seconds", "Time to collect all commands of a job from one device")
+JOB_RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "job_rate_limit_wait_seconds", "Time job commands waited for the fleet and device rate limits"
+)
+
+# Sharding across service nodes
+SHARD_REQUESTS = Counter(
+    "shard_requests_total", "Requests sent to other nodes by kind and result", ["kind", "result"]
+)
+SHARD_REBALANCES = Counter("shard_rebalances_total", "Membership changes that moved device ownership")
+
+# Adaptive timing profiles
+READ_TIMEOUTS = Counter("ssh_read_timeouts_total", "Commands whose prompt did not come back within the read timeout")
+PROMPT_STRATEGY_COMMANDS = Counter(
+    "ssh_prompt_strategy_commands_total", "Commands sent per prompt detection strategy", ["strategy"]
+)
+
+# Circuit breakers
+CIRCUIT_REJECTIONS = Counter("circuit_breaker_rejections_total", "Requests failed fast because a device's circuit was open")
+CIRCUIT_TRANSITIONS = Counter("circuit_breaker_transitions_total", "Circuit breaker state changes by new state", ["state"])
+
+# Output filtering and response compression
+OUTPUT_FILTERED_BYTES = Counter("ssh_output_filtered_bytes_total", "Output bytes dropped by server-side filters and limits")
+RESPONSE_BYTES = Counter(
+    "http_response_compression_bytes_total", "Response bytes before and after compression", ["encoding", "stage"]
+)
+
+# Command scheduling
+SCHEDULER_WAIT_SECONDS = Histogram("scheduler_wait_seconds", "Time device commands waited for a slot", ["priority"])
+SCHEDULER_REJECTIONS = Counter(
+    "scheduler_rejections_total", "Device commands rejected because the queue was full or the wait too long", ["priority"]
+)
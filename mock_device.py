@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Local mock SSH server emulating an IOS-like network device.
+
+Used to exercise the transport backends and the API without real routers:
+
+    python mock_device.py --port 2222 --count 3
+
+serves three devices on 127.0.1.1, 127.0.1.2 and 127.0.1.3, port 2222.
+Any username and password is accepted.
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import logging
+
+import asyncssh
+
+logger = logging.getLogger(__name__)
+
+PAGE_LENGTH = 24
+
+SHOW_VERSION = """Cisco IOS Software, Mock Software (MOCK-ADVENTERPRISEK9-M), Version 15.2(4)M, RELEASE SOFTWARE (fc1)
+Technical Support: http://www.cisco.com/techsupport
+ROM: Bootstrap program is IOSv
+
+{hostname} uptime is 1 week, 2 days, 3 hours, 4 minutes
+System returned to ROM by reload
+System image file is "flash0:/vios-adventerprisek9-m"
+
+Cisco IOSv (revision 1.0) with 460017K/62464K bytes of memory.
+Processor board ID 9XXXXXXXXXXXXXXXXXXXX
+4 Gigabit Ethernet interfaces
+DRAM configuration is 72 bits wide with parity disabled.
+256K bytes of non-volatile configuration memory.
+
+Configuration register is 0x0"""
+
+
+class MockDevice:
+    """
+    Behaviour shared by every session to one mock device
+    """
+
+    def __init__(self, hostname, enable_secret="enable", latency=0.0, output_lines=50):
+        """
+        :param hostname: Name shown in the prompt
+        :param enable_secret: Password expected by the enable command
+        :param latency: Seconds to wait before answering each command
+        :param output_lines: Number of lines of generated show command output
+        """
+        self.hostname = hostname
+        self.enable_secret = enable_secret
+        self.latency = latency
+        self.output_lines = output_lines
+
+    def show(self, command):
+        """
+        Produce the output of a show command or None if it is unknown
+        """
+        words = command.split()
+        if words[:2] == ["show", "version"]:
+            return SHOW_VERSION.format(hostname=self.hostname)
+        if len(words) > 1 and "running-config".startswith(words[1]) and words[1].startswith("run"):
+            lines = [f"hostname {self.hostname}", "!"]
+            for index in range(self.output_lines):
+                lines += [
+                    f"interface GigabitEthernet0/{index}",
+                    f" description mock link {index}",
+                    f" ip address 10.{index // 256 % 256}.{index % 256}.1 255.255.255.0",
+                    "!"
+                ]
+            return "\n".join(lines)
+        if words[:2] == ["show", "interfaces"] or words[:3] == ["show", "ip", "interface"]:
+            lines = ["Port      Name               Status       Vlan       Duplex  Speed Type"]
+            for index in range(self.output_lines):
+                lines.append(f"Gi0/{index:<6} mock link {index:<8} connected    1          a-full  a-1000 10/100/1000BaseTX")
+            return "\n".join(lines)
+        if words and words[0] == "show" and len(words) > 1:
+            return "\n".join(f"{command} line {index}" for index in range(self.output_lines))
+        return None
+
+
+class _MockServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return True
+
+    def password_auth_supported(self):
+        return True
+
+    def validate_password(self, username, password):
+        return True
+
+
+class _Session:
+    """
+    CLI state of one interactive shell
+    """
+
+    def __init__(self, device, process):
+        self.device = device
+        self.process = process
+        self.privileged = False
+        self.paging = True
+        self._skip_lf = False
+
+    @property
+    def prompt(self):
+        return self.device.hostname + ("#" if self.privileged else ">")
+
+    def write(self, text):
+        self.process.stdout.write(text.replace("\n", "\r\n"))
+
+    async def readline(self, echo=True):
+        """
+        Read one line character by character, echoing it like a terminal
+        """
+        line = ""
+        while True:
+            char = await self.process.stdin.read(1)
+            if not char:
+                raise EOFError
+            # A CR LF pair ends a single line
+            if char == "\n" and self._skip_lf:
+                self._skip_lf = False
+                continue
+            self._skip_lf = char == "\r"
+            if char in "\r\n":
+                self.write("\n")
+                return line
+            # Keepalive NUL bytes and other control characters are ignored
+            if char < " ":
+                continue
+            if echo:
+                self.process.stdout.write(char)
+            line += char
+
+    async def write_paged(self, output):
+        lines = output.split("\n")
+        for start in range(0, len(lines), PAGE_LENGTH):
+            self.write("\n".join(lines[start:start + PAGE_LENGTH]) + "\n")
+            if self.paging and start + PAGE_LENGTH < len(lines):
+                self.process.stdout.write(" --More-- ")
+                if not await self.process.stdin.read(1):
+                    raise EOFError
+                self.process.stdout.write("\r          \r")
+
+    async def run(self):
+        self.write(self.prompt)
+        while True:
+            command = " ".join((await self.readline()).split())
+
+            if self.device.latency:
+                await asyncio.sleep(self.device.latency)
+
+            if command in ("exit", "quit", "logout"):
+                break
+            elif command == "":
+                pass
+            elif command in ("enable", "en"):
+                if not self.privileged:
+                    self.write("Password: ")
+                    password = await self.readline(echo=False)
+                    if password == self.device.enable_secret or not self.device.enable_secret:
+                        self.privileged = True
+                    else:
+                        self.write("% Bad secrets\n")
+            elif command == "disable":
+                self.privileged = False
+            elif command.startswith("terminal length"):
+                self.paging = command.split()[-1] != "0"
+            elif command.startswith("terminal width"):
+                pass
+            else:
+                output = self.device.show(command)
+                if output is None:
+                    self.write("% Invalid input detected at '^' marker.\n")
+                else:
+                    await self.write_paged(output)
+
+            self.write(self.prompt)
+
+
+def _process_factory(device):
+    async def handle(process):
+        try:
+            await _Session(device, process).run()
+        except (EOFError, asyncssh.BreakReceived, asyncssh.TerminalSizeChanged, ConnectionError):
+            pass
+        finally:
+            process.exit(0)
+    return handle
+
+
+async def start_device(device, host="127.0.0.1", port=2222, host_key=None):
+    """
+    Start serving a mock device
+
+    :param device: MockDevice to serve
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param host_key: Server host key, generated if omitted
+    :return: asyncssh server object
+    """
+    return await asyncssh.create_server(
+        _MockServer,
+        host,
+        port,
+        server_host_keys=[host_key or asyncssh.generate_private_key("ssh-ed25519")],
+        process_factory=_process_factory(device),
+        line_editor=False
+    )
+
+
+async def start_farm(count, base_address="127.0.1.1", port=2222, **device_options):
+    """
+    Start count mock devices on consecutive loopback addresses
+
+    :return: List of (address, server) tuples
+    """
+    host_key = asyncssh.generate_private_key("ssh-ed25519")
+    first = ipaddress.ip_address(base_address)
+    servers = []
+    for index in range(count):
+        address = str(first + index)
+        device = MockDevice(f"mock-{address.replace('.', '-')}", **device_options)
+        servers.append((address, await start_device(device, address, port, host_key)))
+    return servers
+
+
+async def _main(args):
+    servers = await start_farm(
+        args.count,
+        args.base_address,
+        args.port,
+        enable_secret=args.enable_secret,
+        latency=args.latency,
+        output_lines=args.output_lines
+    )
+    for address, _ in servers:
+        logger.info(f"Mock device listening on {address}:{args.port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve IOS-like mock devices over SSH")
+    parser.add_argument("--count", type=int, default=1, help="Number of devices")
+    parser.add_argument("--base-address", default="127.0.1.1", help="Address of the first device")
+    parser.add_argument("--port", type=int, default=2222, help="SSH port of every device")
+    parser.add_argument("--enable-secret", default="enable", help="Enable password, empty to disable")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each answer")
+    parser.add_argument("--output-lines", type=int, default=50, help="Lines of generated output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(args))
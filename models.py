@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, Index, JSON, LargeBinary, Text
 from database import Base
 from datetime import datetime
 
@@ -11,4 +11,123 @@ class NetworkConnection(Base):
     device_type = Column(String)
     is_connected = Column(Boolean, default=False)
     last_connected = Column(DateTime, default=datetime.utcnow)
-    last_check = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    last_check = Column(DateTime, default=datetime.utcnow)
+
+
+class OutputChunk(Base):
+    """
+    Compressed piece of command output, shared by every snapshot containing it
+    """
+    __tablename__ = "output_chunks"
+
+    digest = Column(String(64), primary_key=True)  # SHA-256 of the uncompressed chunk
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed
+    size = Column(Integer, nullable=False)
+
+
+class OutputSnapshot(Base):
+    """
+    Distinct output of a command on a device, kept until the device is removed
+    """
+    __tablename__ = "output_snapshots"
+    __table_args__ = (Index("ix_output_snapshots_device_command", "connection_id", "command", "id"),)
+
+    id = Column(Integer, primary_key=True)
+    connection_id = Column(Integer, ForeignKey("network_connections.id", ondelete="CASCADE"), nullable=False)
+    command = Column(String, nullable=False)  # Normalized command
+    digest = Column(String(64), nullable=False)  # SHA-256 of the whole output
+    size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)  # First time this output was seen
+    last_seen = Column(DateTime, default=datetime.utcnow)  # Last poll that returned it
+
+
+class OutputSnapshotChunk(Base):
+    """
+    Ordered list of chunks making up a snapshot
+    """
+    __tablename__ = "output_snapshot_chunks"
+
+    snapshot_id = Column(Integer, ForeignKey("output_snapshots.id", ondelete="CASCADE"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    digest = Column(String(64), ForeignKey("output_chunks.digest"), nullable=False, index=True)
+
+
+class CollectionJob(Base):
+    """
+    Recurring set of commands run against the devices matching target selectors
+    """
+    __tablename__ = "collection_jobs"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    targets = Column(JSON, nullable=False)  # List of batch target dicts
+    commands = Column(JSON, nullable=False)  # List of commands
+    interval = Column(Float, nullable=False)  # Seconds between runs
+    enable_mode = Column(Boolean, default=False)
+    snapshot = Column(Boolean, default=False)  # Keep output in the change history
+    enabled = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_run_at = Column(DateTime, nullable=True)
+
+
+class JobRun(Base):
+    """
+    One execution of a collection job across its devices
+    """
+    __tablename__ = "job_runs"
+    __table_args__ = (Index("ix_job_runs_job", "job_id", "id"),)
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("collection_jobs.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String, nullable=False)  # running, ok, partial, failed, skipped
+    devices = Column(Integer, default=0)
+    failed_devices = Column(Integer, default=0)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class JobResult(Base):
+    """
+    Outcome of one command on one device during a job run
+    """
+    __tablename__ = "job_results"
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("job_runs.id", ondelete="CASCADE"), nullable=False, index=True)
+    hostname = Column(String, nullable=False)
+    command = Column(String, nullable=False)
+    error = Column(Text, nullable=True)
+    duration = Column(Float, nullable=True)
+    snapshot_id = Column(Integer, nullable=True)  # Snapshots go away with their device
+    output = Column(LargeBinary, nullable=True)  # zlib-compressed, unless kept as a snapshot
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ShardMember(Base):
+    """
+    Service node taking part in sharding, kept alive by its heartbeats
+    """
+    __tablename__ = "shard_members"
+
+    url = Column(String, primary_key=True)  # Base URL other nodes forward requests to
+    started_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, nullable=False, index=True)
+
+
+class TimingProfile(Base):
+    """
+    Learned command latency of a device, of all devices of a device_type, or of
+    one command on a device
+    """
+    __tablename__ = "timing_profiles"
+
+    scope = Column(String, primary_key=True)  # "device", "device_type" or "command"
+    name = Column(String, primary_key=True)  # Hostname, device_type or "<hostname> <command>"
+    samples = Column(Integer, default=0)
+    latency = Column(Float, nullable=True)  # Smoothed seconds per command
+    deviation = Column(Float, nullable=True)  # Smoothed absolute deviation from latency
+    peak = Column(Float, nullable=True)  # Slowest recent command, decays over time
+    timeouts = Column(Integer, default=0)  # Read timeouts in a row
+    prompt_strategy = Column(String, nullable=True)  # find, cached or timing
+    streak = Column(Integer, default=0)  # Successes in a row with the current strategy
+    updated_at = Column(DateTime, default=datetime.utcnow)
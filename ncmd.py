@@ -7,7 +7,7 @@ import urllib.parse
 
 def execute_command(hostname, command):
     # Define the API endpoint
-    url = "http://localhost:8111/connections/mdcommand"  # Update with your actual API URL
+    url = "http://localhost:8111/connections/mdcommand/stream"  # Update with your actual API URL
     
     # Prepare the data to be sent
     data = {
@@ -23,25 +23,26 @@ def execute_command(hostname, command):
     req = urllib.request.Request(url, data=json_data, headers={'Content-Type': 'application/json'})
     
     try:
-        # Send the request and get the response
+        # Send the request and print each device as soon as its record arrives
         with urllib.request.urlopen(req) as response:
-            response_data = response.read().decode('utf-8')
-            results = json.loads(response_data)
-            
-            if type(results) is str:
-                if results == 'Only supports show commands':
-                    print(results)
-                    exit()
-            
-            # Print the output from each device
-            for result in results:
+            for line in response:
+                if not line.strip():
+                    continue
+                result = json.loads(line.decode('utf-8'))
+                
+                if type(result) is str:
+                    if result == 'Only supports show commands':
+                        print(result)
+                        exit()
+                
+                # Print the output from the device
                 print(f"Hostname: {result['hostname']}")
                 print(f"Command: {result['command']}")
                 if 'output' in result:
                     print(f"Output:\n{result['output']}")
                 elif 'error' in result:
                     print(f"Error:\n{result['error']}")
-                print("-" * 40)
+                print("-" * 40, flush=True)
     
     except urllib.error.HTTPError as e:
         print(f"HTTP Error: {e.code} - {e.reason}")
@@ -1,28 +1,27 @@
 #!/bin/bash
 
 # Check if the correct number of arguments is provided
-if [ "$#" -ne 2 ]; then
-  echo "Usage: $0 <hostname> <command>"
+if [ "$#" -lt 2 ] || [ "$#" -gt 3 ]; then
+  echo "Usage: $0 <hostname> <command> [include-regex]"
   exit 1
 fi
 
 # Assign arguments to variables
 hostname=$1
 command=$2
+include=${3:-}
 
-# Make the API call and capture the response
-response=$(curl -s -X 'POST' \
+# Build the request body, only lines matching the optional regex are returned
+body=$(jq -n --arg hostname "$hostname" --arg command "$command" --arg include "$include" '{
+  hostname: $hostname,
+  command: $command,
+  enable_mode: false
+} + (if $include != "" then {filter: {include: $include}} else {} end)')
+
+# Ask for plain, compressed text so the output can be printed as it is
+curl -s --compressed -X 'POST' \
   'http://127.0.0.1:8111/connections/command' \
-  -H 'accept: application/json' \
+  -H 'Accept: text/plain' \
   -H 'Content-Type: application/json' \
-  -d '{
-  "hostname": "'"$hostname"'",
-  "command": "'"$command"'",
-  "enable_mode": false
-}')
-
-# Extract the response body using jq
-output=$(echo "$response" | jq -r '.')
-
-# Print the output with proper formatting
-echo "$output" | sed 's/\\n/\n/g' | sed 's/\\"/"/g' | sed 's/\\t/\t/g'
\ No newline at end of file
+  -d "$body"
+echo
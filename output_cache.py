@@ -0,0 +1,243 @@
+from collections import OrderedDict
+import logging
+import os
+import re
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds a show command output stays fresh unless a pattern below matches
+DEFAULT_TTL = float(os.environ.get("OUTPUT_CACHE_TTL", "10"))
+# Maximum number of cached outputs
+MAX_ENTRIES = int(os.environ.get("OUTPUT_CACHE_MAX_ENTRIES", "1024"))
+# Maximum total size of cached outputs in bytes
+MAX_BYTES = int(os.environ.get("OUTPUT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# TTL per command pattern, first match wins; a TTL of 0 disables caching
+COMMAND_TTLS = [
+    (re.compile(r"^show\s+(clock|logging|processes|users)\b"), 0),
+    (re.compile(r"^show\s+(interfaces|ip\s+interface)"), 5),
+    (re.compile(r"^show\s+(version|inventory|running-config|startup-config)\b"), 60),
+]
+
+
+def normalize_command(command):
+    """
+    Normalize a command for use in a cache key.
+
+    Only whitespace is collapsed, arguments such as include filters can be
+    case sensitive.
+    """
+    return " ".join(command.split())
+
+
+def ttl_for(command):
+    """
+    Get the cache TTL in seconds for a normalized command
+    """
+    for pattern, ttl in COMMAND_TTLS:
+        if pattern.match(command):
+            return ttl
+    return DEFAULT_TTL
+
+
+class _Flight:
+    """
+    A device round-trip that concurrent identical requests wait on
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class OutputCache:
+    """
+    Size-bounded LRU cache of command output with per-command TTLs.
+
+    Concurrent requests for the same (hostname, command, enable_mode) share a
+    single device round-trip.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()  # key -> (expires_at, output, size)
+        self._in_flight = {}
+        self._generations = {}  # hostname -> invalidation counter
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, hostname, command, enable_mode):
+        """
+        Return cached output without running or waiting for anything
+
+        :return: Command output or None if it is not cached
+        """
+        command = normalize_command(command)
+        if ttl_for(command) <= 0:
+            return None
+
+        with self._lock:
+            entry = self._fresh((hostname, command, bool(enable_mode)))
+        return entry[1] if entry is not None else None
+
+    def get_or_run(self, hostname, command, enable_mode, run, join=True):
+        """
+        Return cached output or run the command once for all concurrent callers
+
+        :param hostname: Device hostname
+        :param command: Command as sent by the client
+        :param enable_mode: Whether the command runs in enable mode
+        :param run: Callable executing the command and returning its output
+        :param join: Wait for a round-trip already in flight; callers holding a
+            session to the device pass False and run the command themselves,
+            as the caller in flight may be waiting for that session
+        :return: Command output
+        """
+        command = normalize_command(command)
+        ttl = ttl_for(command)
+        if ttl <= 0:
+            return run()
+
+        key = (hostname, command, bool(enable_mode))
+
+        with self._lock:
+            entry = self._fresh(key)
+            if entry is not None:
+                return entry[1]
+
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            generation = self._generations.get(hostname, 0)
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+                self.misses += 1
+            elif not join:
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader and not join:
+            output = run()
+            self._store(key, output, ttl, generation)
+            return output
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = run()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            self._store(key, flight.value, ttl, generation)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.event.set()
+
+        return flight.value
+
+    def _fresh(self, key):
+        """
+        Cache entry of a key that has not expired yet, called with the lock held
+        """
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        return None
+
+    def _store(self, key, output, ttl, generation):
+        size = len(output) if isinstance(output, str) else 0
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            # The device was re-added or removed while the command ran
+            if self._generations.get(key[0], 0) != generation:
+                return
+
+            previous = self._entries.pop(key, None)
+            if previous:
+                self._bytes -= previous[2]
+
+            self._entries[key] = (time.monotonic() + ttl, output, size)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate_host(self, hostname):
+        """
+        Drop every cached output of a device
+        """
+        with self._lock:
+            self._generations[hostname] = self._generations.get(hostname, 0) + 1
+            for key in [key for key in self._entries if key[0] == hostname]:
+                self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """
+        Drop every cached output
+        """
+        with self._lock:
+            for hostname in {key[0] for key in list(self._entries) + list(self._in_flight)}:
+                self._generations[hostname] = self._generations.get(hostname, 0) + 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Hit/miss counters and current size
+        """
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "in_flight": len(self._in_flight)
+            }
+
+
+    def collect_metrics(self):
+        """
+        Export the counters at scrape time
+        """
+        stats = self.stats()
+        yield (
+            'output_cache_requests_total',
+            'Output cache lookups by result',
+            'counter',
+            [({'result': result}, stats[result]) for result in ('hits', 'misses', 'coalesced')]
+        )
+        yield ('output_cache_evictions_total', 'Outputs evicted from the cache', 'counter', [({}, stats['evictions'])])
+        yield ('output_cache_bytes', 'Size of cached outputs', 'gauge', [({}, stats['bytes'])])
+
+
+# Global output cache
+output_cache = OutputCache()
+metrics.register_collector(output_cache.collect_metrics)
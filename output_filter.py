@@ -0,0 +1,118 @@
+from collections import deque
+import re
+
+import metrics
+
+
+class OutputFilter:
+    """
+    Server-side trimming of command output.
+
+    Lines are kept if they match include and do not match exclude, then
+    limited to the first head and the last tail of them; both together
+    select a range, e.g. head=20, tail=11 keeps lines 10 to 20. At most
+    max_bytes of the result are returned.
+    """
+
+    def __init__(self, include=None, exclude=None, head=None, tail=None, max_bytes=None):
+        """
+        :raises ValueError: If a regex does not compile or a limit is negative
+        """
+        self.include = _compile(include, "include")
+        self.exclude = _compile(exclude, "exclude")
+        for name, value in (("head", head), ("tail", tail), ("max_bytes", max_bytes)):
+            if value is not None and value < 0:
+                raise ValueError(f"{name} must not be negative")
+        self.head = head
+        self.tail = tail
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_request(cls, options):
+        """
+        :param options: Request model with the filter fields or None
+        :return: OutputFilter, None if nothing is to be filtered
+        """
+        if options is None:
+            return None
+        fields = options.model_dump(exclude_none=True)
+        return cls(**fields) if fields else None
+
+    def lines(self, lines, stats=None):
+        """
+        Filter lines while they are read.
+
+        Once head or max_bytes is reached the remaining lines are still
+        consumed, so the channel is left at the prompt, but no longer kept.
+
+        :param lines: Iterable of lines without line endings
+        :param stats: Dictionary that gets "truncated" set if a limit cut the output
+        :return: Generator of the kept lines
+        """
+        stats = stats if stats is not None else {}
+        kept = 0
+        dropped_bytes = 0
+        remaining = self.max_bytes
+        last = deque(maxlen=self.tail) if self.tail is not None else None
+
+        def fit(line):
+            # Count the line against max_bytes, the one crossing it is shortened
+            nonlocal remaining
+            if remaining is None:
+                return line
+            encoded = line.encode("utf-8") + b"\n"
+            if len(encoded) <= remaining:
+                remaining -= len(encoded)
+                return line
+            stats["truncated"] = True
+            line = encoded[:remaining].decode("utf-8", "ignore")
+            remaining = 0
+            return line or None
+
+        for line in lines:
+            # Count everything and take back what is returned
+            dropped_bytes += len(line) + 1
+            if self.include is not None and not self.include.search(line):
+                continue
+            if self.exclude is not None and self.exclude.search(line):
+                continue
+            if self.head is not None and kept >= self.head:
+                stats["truncated"] = True
+                continue
+            kept += 1
+            if last is not None:
+                if len(last) == last.maxlen:
+                    stats["truncated"] = True
+                last.append(line)
+                continue
+            line = fit(line)
+            if line is not None:
+                dropped_bytes -= len(line) + 1
+                yield line
+
+        for line in last or ():
+            line = fit(line)
+            if line is not None:
+                dropped_bytes -= len(line) + 1
+                yield line
+
+        metrics.OUTPUT_FILTERED_BYTES.inc(max(dropped_bytes, 0))
+
+    def apply(self, output):
+        """
+        Filter an output that has been read completely
+
+        :return: (filtered output, True if a limit cut the output)
+        """
+        stats = {}
+        filtered = "\n".join(self.lines(output.split("\n"), stats))
+        return filtered, stats.get("truncated", False)
+
+
+def _compile(pattern, name):
+    if pattern is None:
+        return None
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid {name} regex {pattern!r}: {str(e)}")
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import logging
+import os
+import threading
+
+try:
+    import textfsm
+    from textfsm import clitable
+except ImportError:  # Installed with Netmiko, parsing is unavailable without it
+    textfsm = None
+
+try:
+    import ntc_templates
+except ImportError:
+    ntc_templates = None
+
+try:
+    from ttp import ttp
+except ImportError:
+    ttp = None
+
+from output_cache import normalize_command
+
+logger = logging.getLogger(__name__)
+
+# Directory with site-specific templates named <device_type>_<command>.textfsm or .ttp,
+# e.g. cisco_ios_show_interfaces_status.textfsm; checked before ntc-templates
+TEMPLATE_DIR = os.environ.get("PARSE_TEMPLATE_DIR")
+# Number of parsed outputs kept for repeated identical output
+PARSE_CACHE_SIZE = int(os.environ.get("PARSE_CACHE_SIZE", "256"))
+
+
+class ParseError(Exception):
+    """
+    Raised when output cannot be turned into structured records
+    """
+
+
+class _CompiledTemplate:
+    """
+    A compiled TextFSM or TTP template.
+
+    TextFSM state machines are reused across calls, so parsing with one
+    template is serialized by a lock.
+    """
+
+    def __init__(self, kind, source):
+        self.kind = kind
+        self.source = source
+        self.lock = threading.Lock()
+        self.fsm = None
+        if kind == "textfsm":
+            with open(source) as template_file:
+                self.fsm = textfsm.TextFSM(template_file)
+
+    def parse(self, output):
+        if self.kind == "ttp":
+            parser = ttp(data=output, template=self.source)
+            parser.parse()
+            results = parser.result(structure="flat_list")
+            return results
+
+        with self.lock:
+            self.fsm.Reset()
+            rows = self.fsm.ParseText(output)
+            header = [name.lower() for name in self.fsm.header]
+        return [dict(zip(header, row)) for row in rows]
+
+
+@lru_cache(maxsize=1)
+def _template_index():
+    """
+    Load the ntc-templates index once
+    """
+    if textfsm is None or ntc_templates is None:
+        return None
+    template_dir = os.environ.get(
+        "NET_TEXTFSM",
+        os.path.join(os.path.dirname(ntc_templates.__file__), "templates")
+    )
+    return clitable.CliTable("index", template_dir)
+
+
+def _site_template(device_type, command):
+    """
+    Look for a site-specific template for the command
+    """
+    if not TEMPLATE_DIR:
+        return None
+    name = f"{device_type}_{command.replace(' ', '_')}"
+    for kind in ("textfsm", "ttp"):
+        path = os.path.join(TEMPLATE_DIR, f"{name}.{kind}")
+        if os.path.exists(path):
+            if kind == "ttp":
+                if ttp is None:
+                    logger.warning(f"Skipping {path}, ttp is not installed")
+                    continue
+                with open(path) as template_file:
+                    return _CompiledTemplate(kind, template_file.read())
+            if textfsm is not None:
+                return _CompiledTemplate(kind, path)
+    return None
+
+
+@lru_cache(maxsize=512)
+def _compiled_template(device_type, command):
+    """
+    Find and compile the template for a (device_type, command) pair
+
+    :return: _CompiledTemplate or None if there is no template
+    """
+    template = _site_template(device_type, command)
+    if template is not None:
+        return template
+
+    index = _template_index()
+    if index is None:
+        return None
+
+    row = index.index.GetRowMatch({"Platform": device_type, "Command": command})
+    if not row and device_type == "cisco_xe":
+        row = index.index.GetRowMatch({"Platform": "cisco_ios", "Command": command})
+    if not row:
+        return None
+
+    # Multiple templates merged by key are rare, only the first is used
+    template_name = index.index.index[row]["Template"].split(":")[0]
+    return _CompiledTemplate("textfsm", os.path.join(index.template_dir, template_name))
+
+
+class _ParseCache:
+    """
+    LRU cache of parsed records keyed on template and output digest
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            records = self._entries.get(key)
+            if records is not None:
+                self._entries.move_to_end(key)
+            return records
+
+    def put(self, key, records):
+        with self._lock:
+            self._entries[key] = records
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_parse_cache = _ParseCache(PARSE_CACHE_SIZE)
+
+
+def parse_output(device_type, command, output):
+    """
+    Turn raw CLI output into a list of structured records.
+
+    Runs in the caller's thread; endpoints call it from their worker
+    threads, never from the event loop.
+
+    :param device_type: Netmiko device type of the device
+    :param command: Command that produced the output
+    :param output: Raw command output
+    :return: List of dictionaries, one per record
+    :raises ParseError: If no template exists or the output does not match it
+    """
+    if textfsm is None:
+        raise ParseError("Parsing requires textfsm and ntc-templates")
+
+    command = normalize_command(command)
+    template = _compiled_template(device_type, command)
+    if template is None:
+        raise ParseError(f"No parse template for {device_type} '{command}'")
+
+    key = (device_type, command, hashlib.sha1(output.encode("utf-8", "replace")).digest())
+    records = _parse_cache.get(key)
+    if records is not None:
+        return records
+
+    try:
+        records = template.parse(output)
+    except Exception as e:
+        raise ParseError(f"Failed to parse output of '{command}': {str(e)}")
+
+    _parse_cache.put(key, records)
+    return records
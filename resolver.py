@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds a resolved address is used before it is looked up again
+TTL = float(os.environ.get("DNS_CACHE_TTL", "300"))
+# Seconds a failed lookup is remembered, so dead names do not stall every reconnect
+NEGATIVE_TTL = float(os.environ.get("DNS_NEGATIVE_TTL", "30"))
+# Seconds a caller waits for a lookup that is not cached yet
+RESOLVE_TIMEOUT = float(os.environ.get("DNS_RESOLVE_TIMEOUT", "5"))
+# Lookups running at the same time
+WORKERS = int(os.environ.get("DNS_RESOLVER_WORKERS", "8"))
+
+
+def _is_address(hostname):
+    try:
+        ipaddress.ip_address(hostname)
+        return True
+    except ValueError:
+        return False
+
+
+class Resolver:
+    """
+    Caching hostname resolver.
+
+    Lookups run in a small thread pool so blocking getaddrinfo calls never
+    hold up a connecting thread longer than RESOLVE_TIMEOUT. Expired
+    addresses are served while a background lookup refreshes them, and
+    failures are cached for NEGATIVE_TTL.
+    """
+
+    def __init__(self, ttl=TTL, negative_ttl=NEGATIVE_TTL, workers=WORKERS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # hostname -> (address or None, expires)
+        self._in_flight = {}  # hostname -> Future
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dns")
+
+    def resolve(self, hostname, timeout=None):
+        """
+        Resolve a hostname to an address, from the cache if possible
+
+        :param hostname: DNS name or IP address
+        :param timeout: Seconds to wait for an uncached lookup
+        :return: Address or None if the name does not resolve
+        """
+        if _is_address(hostname):
+            return hostname
+
+        with self._lock:
+            entry = self._entries.get(hostname)
+            if entry is not None:
+                address, expires = entry
+                if time.monotonic() < expires:
+                    metrics.DNS_CACHE_LOOKUPS.labels("hit" if address else "negative").inc()
+                    return address
+                if address is not None:
+                    # Serve the stale address, the refresh runs in the background
+                    metrics.DNS_CACHE_LOOKUPS.labels("stale").inc()
+                    self._submit(hostname)
+                    return address
+
+            metrics.DNS_CACHE_LOOKUPS.labels("miss").inc()
+            future = self._submit(hostname)
+
+        try:
+            return future.result(RESOLVE_TIMEOUT if timeout is None else timeout)
+        except FutureTimeout:
+            logger.warning(f"DNS lookup for {hostname} timed out")
+            return None
+
+    def prefetch(self, hostnames):
+        """
+        Start lookups for every hostname that has no fresh cache entry, without waiting
+        """
+        now = time.monotonic()
+        with self._lock:
+            for hostname in hostnames:
+                entry = self._entries.get(hostname)
+                if (entry is None or entry[1] <= now) and not _is_address(hostname):
+                    self._submit(hostname)
+
+    def forget(self, hostname):
+        """
+        Drop the cached address of a hostname
+        """
+        with self._lock:
+            self._entries.pop(hostname, None)
+
+    def stats(self):
+        """
+        Snapshot of cache occupancy
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._entries.values())
+            in_flight = len(self._in_flight)
+        return {
+            "entries": len(entries),
+            "negative": sum(1 for address, _ in entries if address is None),
+            "expired": sum(1 for _, expires in entries if expires <= now),
+            "in_flight": in_flight
+        }
+
+    def collect_metrics(self):
+        """
+        Export cache occupancy at scrape time
+        """
+        stats = self.stats()
+        yield (
+            'dns_cache_entries',
+            'Cached hostname lookups',
+            'gauge',
+            [({'result': 'positive'}, stats['entries'] - stats['negative']), ({'result': 'negative'}, stats['negative'])]
+        )
+
+    def _submit(self, hostname):
+        """
+        Start a lookup unless one is already running, called with the lock held
+        """
+        future = self._in_flight.get(hostname)
+        if future is None:
+            future = self._executor.submit(self._lookup, hostname)
+            self._in_flight[hostname] = future
+        return future
+
+    def _lookup(self, hostname):
+        address = None
+        try:
+            with metrics.DNS_SECONDS.time():
+                address = socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM)[0][4][0]
+        except (socket.gaierror, UnicodeError) as e:
+            logger.warning(f"Cannot resolve {hostname}: {str(e)}")
+        except Exception as e:
+            logger.error(f"Error resolving {hostname}: {str(e)}")
+
+        ttl = self.ttl if address else self.negative_ttl
+        with self._lock:
+            self._entries[hostname] = (address, time.monotonic() + ttl)
+            self._in_flight.pop(hostname, None)
+        return address
+
+
+# Global resolver shared by all connection attempts
+resolver = Resolver()
+metrics.register_collector(resolver.collect_metrics)
@@ -0,0 +1,278 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import logging
+import math
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Device commands running at the same time across all devices
+MAX_ACTIVE = int(os.environ.get("SCHEDULER_MAX_ACTIVE", "64"))
+# Commands waiting per priority class before new ones are rejected
+MAX_QUEUED = int(os.environ.get("SCHEDULER_MAX_QUEUED", "256"))
+# Seconds a command may wait for its turn before it is rejected
+QUEUE_TIMEOUT = float(os.environ.get("SCHEDULER_QUEUE_TIMEOUT", "30"))
+
+# Priority classes, earlier ones are always served first
+INTERACTIVE = "interactive"
+BATCH = "batch"
+HEALTH_CHECK = "health_check"
+PRIORITIES = (INTERACTIVE, BATCH, HEALTH_CHECK)
+
+# Gain of the smoothed time a command holds its slot, used for Retry-After
+_HOLD_GAIN = 0.1
+
+
+class QueueFull(Exception):
+    """
+    Raised when a command is not admitted, or waited too long for its turn
+    """
+
+    def __init__(self, message, retry_after):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class _Ticket:
+    __slots__ = ("hostname", "priority", "caller", "device_limit", "queued_at", "granted", "event")
+
+    def __init__(self, hostname, priority, caller, device_limit):
+        self.hostname = hostname
+        self.priority = priority
+        self.caller = caller
+        self.device_limit = device_limit
+        self.queued_at = time.monotonic()
+        self.granted = False
+        self.event = threading.Event()
+
+
+class CommandScheduler:
+    """
+    Admission control and ordering of device commands.
+
+    A command takes a slot before it checks out a session. At most
+    MAX_ACTIVE commands run at once, and per device no more than its pool
+    holds sessions, so waiting happens here, in priority order, instead of
+    in the pools. Interactive commands go before batch ones, which go
+    before health checks. Within a class callers take turns, so one large
+    fan-out does not hold back the others. A class with MAX_QUEUED waiting
+    commands rejects new ones instead of letting threads pile up.
+    """
+
+    def __init__(self, max_active=MAX_ACTIVE, max_queued=MAX_QUEUED):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        # priority -> caller -> tickets, callers move to the end once served
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._queued = dict.fromkeys(PRIORITIES, 0)
+        self._running = dict.fromkeys(PRIORITIES, 0)
+        self._device_running = {}
+        self._active = 0
+        self._hold_seconds = 1.0
+        self._counters = {priority: {"admitted": 0, "rejected": 0, "timed_out": 0, "wait_seconds": 0.0} for priority in PRIORITIES}
+
+    @contextmanager
+    def slot(self, hostname, priority=INTERACTIVE, caller=None, device_limit=1, timeout=None):
+        """
+        Hold a command slot for the duration of a with block
+
+        :param hostname: Device the command runs on
+        :param priority: One of PRIORITIES
+        :param caller: Client the command is run for, callers of a class take turns
+        :param device_limit: Commands allowed on the device at once, its pool size
+        :param timeout: Seconds to wait for the slot, QUEUE_TIMEOUT by default
+        :raises QueueFull: If the class queue is full or the slot was not granted in time
+        """
+        ticket = self.acquire(hostname, priority, caller, device_limit, timeout)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(ticket, time.monotonic() - start)
+
+    def check(self, priority):
+        """
+        Reject work up front while a class queue is full
+
+        :raises QueueFull: If no more commands of this class are admitted
+        """
+        with self._lock:
+            rejection = self._reject_if_full(priority)
+        if rejection is not None:
+            raise rejection
+
+    def acquire(self, hostname, priority=INTERACTIVE, caller=None, device_limit=1, timeout=None):
+        """
+        Wait for a command slot, see slot()
+
+        :return: Ticket to pass to release()
+        """
+        ticket = _Ticket(hostname, priority, caller, max(1, device_limit))
+        with self._lock:
+            rejection = self._reject_if_full(priority)
+            if rejection is None:
+                self._queues[priority].setdefault(caller, deque()).append(ticket)
+                self._queued[priority] += 1
+                self._dispatch()
+        if rejection is not None:
+            raise rejection
+
+        if not ticket.event.wait(QUEUE_TIMEOUT if timeout is None else timeout):
+            with self._lock:
+                if not ticket.granted:
+                    self._remove(ticket)
+                    self._counters[priority]["timed_out"] += 1
+                    retry_after = self._retry_after()
+            if not ticket.granted:
+                metrics.SCHEDULER_REJECTIONS.labels(priority).inc()
+                raise QueueFull(f"No slot for {hostname} within the queue timeout", retry_after)
+
+        waited = time.monotonic() - ticket.queued_at
+        metrics.SCHEDULER_WAIT_SECONDS.labels(priority).observe(waited)
+        with self._lock:
+            counters = self._counters[priority]
+            counters["admitted"] += 1
+            counters["wait_seconds"] += waited
+        return ticket
+
+    def _reject_if_full(self, priority):
+        """
+        Count a rejection if the class queue is full, called with the lock held
+
+        :return: QueueFull to raise or None if there is room
+        """
+        if self._queued[priority] < self.max_queued:
+            return None
+        self._counters[priority]["rejected"] += 1
+        metrics.SCHEDULER_REJECTIONS.labels(priority).inc()
+        return QueueFull(f"Too many {priority} commands queued", self._retry_after())
+
+    def release(self, ticket, held=None):
+        """
+        Give a slot back and hand it to the next waiting command
+        """
+        with self._lock:
+            self._active -= 1
+            self._running[ticket.priority] -= 1
+            running = self._device_running[ticket.hostname] - 1
+            if running:
+                self._device_running[ticket.hostname] = running
+            else:
+                del self._device_running[ticket.hostname]
+            if held is not None:
+                self._hold_seconds += _HOLD_GAIN * (held - self._hold_seconds)
+            self._dispatch()
+
+    def _dispatch(self):
+        """
+        Grant free slots to waiting commands, called with the lock held
+        """
+        for priority in PRIORITIES:
+            callers = self._queues[priority]
+            while self._active < self.max_active:
+                ticket = self._next(callers)
+                if ticket is None:
+                    break
+                self._grant(ticket)
+            if self._active >= self.max_active:
+                return
+
+    def _next(self, callers):
+        """
+        Take the oldest command of the first caller in turn whose device has room
+        """
+        for caller, tickets in callers.items():
+            for ticket in tickets:
+                if self._device_running.get(ticket.hostname, 0) < ticket.device_limit:
+                    tickets.remove(ticket)
+                    if tickets:
+                        callers.move_to_end(caller)
+                    else:
+                        del callers[caller]
+                    return ticket
+        return None
+
+    def _grant(self, ticket):
+        self._queued[ticket.priority] -= 1
+        self._running[ticket.priority] += 1
+        self._active += 1
+        self._device_running[ticket.hostname] = self._device_running.get(ticket.hostname, 0) + 1
+        ticket.granted = True
+        ticket.event.set()
+
+    def _remove(self, ticket):
+        callers = self._queues[ticket.priority]
+        tickets = callers.get(ticket.caller)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del callers[ticket.caller]
+            self._queued[ticket.priority] -= 1
+
+    def _retry_after(self):
+        """
+        Estimate the seconds until the queues have drained, called with the lock held
+        """
+        queued = sum(self._queued.values())
+        return max(1, math.ceil(self._hold_seconds * (queued + 1) / self.max_active))
+
+    def stats(self):
+        """
+        Get queue depth, running commands and wait times per priority class
+        """
+        now = time.monotonic()
+        with self._lock:
+            classes = {}
+            for priority in PRIORITIES:
+                counters = self._counters[priority]
+                oldest = min(
+                    (tickets[0].queued_at for tickets in self._queues[priority].values()),
+                    default=None
+                )
+                classes[priority] = {
+                    "queued": self._queued[priority],
+                    "running": self._running[priority],
+                    "callers": len(self._queues[priority]),
+                    "admitted": counters["admitted"],
+                    "rejected": counters["rejected"],
+                    "timed_out": counters["timed_out"],
+                    "avg_wait_seconds": round(counters["wait_seconds"] / counters["admitted"], 3) if counters["admitted"] else 0.0,
+                    "oldest_wait_seconds": round(now - oldest, 3) if oldest is not None else 0.0
+                }
+            return {
+                "max_active": self.max_active,
+                "max_queued": self.max_queued,
+                "active": self._active,
+                "retry_after": self._retry_after(),
+                "classes": classes
+            }
+
+    def collect_metrics(self):
+        """
+        Export queue depth and running commands per class at scrape time
+        """
+        with self._lock:
+            queued = dict(self._queued)
+            running = dict(self._running)
+        yield (
+            'scheduler_queued_commands',
+            'Device commands waiting for a slot by priority class',
+            'gauge',
+            [({'priority': priority}, count) for priority, count in queued.items()]
+        )
+        yield (
+            'scheduler_running_commands',
+            'Device commands holding a slot by priority class',
+            'gauge',
+            [({'priority': priority}, count) for priority, count in running.items()]
+        )
+
+
+# Global command scheduler, every session checkout and health check takes a slot
+command_scheduler = CommandScheduler()
+metrics.register_collector(command_scheduler.collect_metrics)
@@ -1,12 +1,13 @@
 from pydantic import BaseModel, ConfigDict, Field
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 
 class NetworkConnectionCreate(BaseModel):
     hostname: str = Field(..., description="Hostname or IP address of the network device")
     username: str
     password: str
     device_type: str
+    max_sessions: Optional[int] = Field(None, ge=1, description="Maximum concurrent SSH sessions to this device")
 
 class NetworkConnectionResponse(BaseModel):
     id: int
@@ -16,4 +17,29 @@ class NetworkConnectionResponse(BaseModel):
     last_connected: datetime
     last_check: datetime
 
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+class TimingProfileResponse(BaseModel):
+    source: str = Field(..., description="Profile the settings come from: device, device_type or default")
+    samples: int
+    latency: Optional[float] = Field(None, description="Smoothed seconds per command")
+    deviation: Optional[float] = None
+    peak: Optional[float] = None
+    timeouts: int = Field(..., description="Read timeouts in a row")
+    read_timeout: float = Field(..., description="Read timeout of commands without a learned one")
+    commands: Dict[str, float] = Field(default_factory=dict, description="Learned read timeout per command")
+    prompt_strategy: str
+    fast_cli: bool
+    global_delay_factor: float
+    updated_at: Optional[datetime] = None
+
+class CircuitBreakerResponse(BaseModel):
+    state: str = Field(..., description="closed, open or half_open")
+    failures: int = Field(..., description="Failures in a row")
+    last_error: Optional[str] = None
+    opened_at: Optional[datetime] = None
+    retry_after: float = Field(..., description="Seconds until the next probe while open")
+
+class NetworkConnectionStatus(NetworkConnectionResponse):
+    timing: Optional[TimingProfileResponse] = None
+    circuit: Optional[CircuitBreakerResponse] = None
\ No newline at end of file
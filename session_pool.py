@@ -0,0 +1,264 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_sizes(value):
+    """
+    Parse a "key=size,key=size" setting into a dictionary
+    """
+    sizes = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            key, size = item.split("=", 1)
+            sizes[key.strip()] = int(size)
+    return sizes
+
+
+# Sessions kept per device unless overridden below
+DEFAULT_POOL_SIZE = int(os.environ.get("SSH_POOL_SIZE", "2"))
+# Overrides per device_type, e.g. "cisco_ios=4,juniper_junos=2"
+POOL_SIZE_BY_DEVICE_TYPE = _parse_sizes(os.environ.get("SSH_POOL_SIZES_BY_DEVICE_TYPE"))
+# Overrides per hostname, e.g. "core-rtr-1=6"; also set through the API
+POOL_SIZE_BY_HOSTNAME = _parse_sizes(os.environ.get("SSH_POOL_SIZES_BY_HOSTNAME"))
+# Seconds an idle session beyond the first may live before it is closed
+IDLE_TIMEOUT = float(os.environ.get("SSH_POOL_IDLE_TIMEOUT", "300"))
+# Seconds a request waits for a free session before giving up
+CHECKOUT_TIMEOUT = float(os.environ.get("SSH_POOL_CHECKOUT_TIMEOUT", "30"))
+
+
+def pool_size_for(hostname, device_type):
+    """
+    Resolve the maximum number of sessions for a device
+
+    :param hostname: Device hostname
+    :param device_type: Netmiko device type
+    :return: Maximum pool size, at least 1
+    """
+    size = POOL_SIZE_BY_HOSTNAME.get(hostname)
+    if size is None:
+        size = POOL_SIZE_BY_DEVICE_TYPE.get(device_type, DEFAULT_POOL_SIZE)
+    return max(1, size)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no session became free before the checkout timeout
+    """
+
+
+class PoolClosed(Exception):
+    """
+    Raised when checking out from a pool whose device has been removed
+    """
+
+
+class DeviceSessionPool:
+    """
+    Pool of SSH sessions to a single device.
+
+    Sessions are handed out exclusively, so concurrent commands never share a
+    channel. The pool grows lazily up to max_size and idle sessions above
+    min_size are closed after IDLE_TIMEOUT.
+    """
+
+    def __init__(self, hostname, factory, max_size=1, min_size=1, idle_timeout=None):
+        """
+        :param hostname: Device hostname, used for logging
+        :param factory: Callable returning a new connected session or None
+        :param max_size: Maximum number of sessions open at the same time
+        :param min_size: Idle sessions kept open when shrinking
+        :param idle_timeout: Seconds before surplus idle sessions are closed
+        """
+        self.hostname = hostname
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.min_size = min(min_size, self.max_size)
+        self.idle_timeout = IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+
+        self._idle = deque()  # (session, last_used)
+        self._in_use = 0
+        self._creating = 0
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        """
+        Number of sessions open or being opened
+        """
+        with self._cond:
+            return len(self._idle) + self._in_use + self._creating
+
+    def add(self, session):
+        """
+        Hand an already connected session to the pool
+        """
+        with self._cond:
+            if self._closed:
+                self._close_session(session)
+                return
+            self._idle.append((session, time.monotonic()))
+            self._cond.notify()
+
+    def checkout(self, timeout=None):
+        """
+        Take a session out of the pool, opening a new one if the pool has room
+
+        :param timeout: Seconds to wait for a free session
+        :return: Session for exclusive use until checkin
+        :raises PoolTimeout: If no session became free in time
+        :raises ConnectionError: If a new session could not be established
+        """
+        timeout = CHECKOUT_TIMEOUT if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosed(f"Connection to {self.hostname} has been removed")
+
+                if self._idle:
+                    # Most recently used first, so surplus sessions age out
+                    session, _ = self._idle.pop()
+                    self._in_use += 1
+                    metrics.CHECKOUT_WAIT_SECONDS.observe(time.monotonic() - started)
+                    return session
+
+                if self._in_use + self._creating < self.max_size:
+                    self._creating += 1
+                    metrics.CHECKOUT_WAIT_SECONDS.observe(time.monotonic() - started)
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.CHECKOUT_TIMEOUTS.inc()
+                    raise PoolTimeout(
+                        f"No free session to {self.hostname} after {timeout}s "
+                        f"({self._in_use} of {self.max_size} in use)"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        # Connect outside the lock so other checkouts are not blocked
+        session = None
+        try:
+            session = self.factory()
+        finally:
+            with self._cond:
+                self._creating -= 1
+                if session is not None:
+                    self._in_use += 1
+                self._cond.notify()
+
+        if session is None:
+            raise ConnectionError(f"Failed to establish SSH connection to {self.hostname}")
+        logger.info(f"Opened new session to {self.hostname} ({self.size} of {self.max_size})")
+        return session
+
+    def try_checkout_idle(self):
+        """
+        Take an idle session without waiting or opening a new one
+
+        :return: Session or None if every session is busy
+        """
+        with self._cond:
+            if self._closed or not self._idle:
+                return None
+            session, _ = self._idle.pop()
+            self._in_use += 1
+            return session
+
+    def checkin(self, session, discard=False):
+        """
+        Return a session to the pool
+
+        :param session: Session obtained from checkout
+        :param discard: Close the session instead of reusing it
+        """
+        with self._cond:
+            self._in_use -= 1
+            discard = discard or self._closed
+            if not discard:
+                self._idle.append((session, time.monotonic()))
+            self._cond.notify()
+
+        # Disconnecting can block, do it outside the lock
+        if discard:
+            self._close_session(session)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        Check out a session for the duration of a with block.
+
+        Sessions are discarded if the block raises, since the channel may
+        be left in an unknown state.
+        """
+        session = self.checkout(timeout)
+        try:
+            yield session
+        except BaseException:
+            self.checkin(session, discard=True)
+            raise
+        self.checkin(session)
+
+    def shrink(self):
+        """
+        Close idle sessions above min_size that have not been used recently
+        """
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            # Oldest sessions sit at the left of the deque
+            while len(self._idle) > self.min_size and now - self._idle[0][1] >= self.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+
+        for session in expired:
+            self._close_session(session)
+        if expired:
+            logger.info(f"Closed {len(expired)} idle session(s) to {self.hostname}")
+
+    def close(self):
+        """
+        Close all idle sessions; busy ones are closed when checked back in
+        """
+        with self._cond:
+            self._closed = True
+            idle = [session for session, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+
+        for session in idle:
+            self._close_session(session)
+
+    def stats(self):
+        """
+        Snapshot of pool occupancy
+        """
+        with self._cond:
+            return {
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "creating": self._creating,
+                "waiting": self._waiting
+            }
+
+    def _close_session(self, session):
+        try:
+            session.disconnect()
+        except Exception as e:
+            logger.error(f"Error disconnecting {self.hostname}: {str(e)}")
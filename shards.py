@@ -0,0 +1,323 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+import atexit
+import bisect
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import urllib.error
+import urllib.request
+
+import metrics
+from database import SessionLocal, create_tables
+from models import ShardMember
+
+logger = logging.getLogger(__name__)
+
+# Base URL other nodes reach this one at, e.g. "http://10.0.0.5:8000"; enables sharding
+NODE_URL = os.environ.get("SHARD_NODE_URL", "").rstrip("/") or None
+# Seconds between heartbeats, membership changes are noticed within one interval
+HEARTBEAT_INTERVAL = float(os.environ.get("SHARD_HEARTBEAT_INTERVAL", "5"))
+# Seconds without a heartbeat after which a node's devices move to the others
+MEMBER_TIMEOUT = float(os.environ.get("SHARD_MEMBER_TIMEOUT", "15"))
+# Points per node on the hash ring, more points spread devices more evenly
+VIRTUAL_NODES = int(os.environ.get("SHARD_VIRTUAL_NODES", "128"))
+# Seconds to wait on another node while forwarding
+FORWARD_TIMEOUT = float(os.environ.get("SHARD_FORWARD_TIMEOUT", "300"))
+
+# Set on requests sent to another node, which then handles them itself
+FORWARDED_HEADER = "X-Shard-Forwarded"
+
+# Hop-by-hop and framing headers not copied from a forwarded response
+_SKIPPED_HEADERS = {"connection", "content-length", "transfer-encoding", "keep-alive", "date", "server"}
+
+
+def _hash(key):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring, a node joining or leaving only moves the devices
+    of the ring segments next to its points
+    """
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (_hash(f"{node}#{index}"), node)
+            for node in self.nodes
+            for index in range(virtual_nodes)
+        )
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        """
+        :return: Node owning the key or None if the ring is empty
+        """
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class Cluster:
+    """
+    Membership of the service nodes sharing the inventory.
+
+    Every node heartbeats into the shared database and builds the same hash
+    ring from the live members, so all nodes agree on the owner of a device
+    without talking to each other. Only the owner keeps sessions to a device
+    and health checks it; the others forward requests for it. Listeners are
+    called when membership changes so ownership can be rebalanced.
+
+    Without SHARD_NODE_URL the node owns every device and nothing is forwarded.
+    """
+
+    def __init__(self, url=NODE_URL):
+        self.url = url
+        self._ring = HashRing([url] if url else [])
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.url is not None
+
+    def start(self):
+        """
+        Join the cluster and keep heartbeating in a background thread
+        """
+        if not self.enabled or self._thread is not None:
+            return
+        create_tables([ShardMember.__table__])
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._run, name="shard-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Leave the cluster so the other nodes take over at once instead of after the timeout
+        """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        db = SessionLocal()
+        try:
+            db.execute(delete(ShardMember).where(ShardMember.url == self.url))
+            db.commit()
+        except Exception as e:
+            logger.error(f"Error leaving the cluster: {str(e)}")
+        finally:
+            db.close()
+
+    def add_listener(self, listener):
+        """
+        :param listener: Callable run without arguments after membership changed
+        """
+        self._listeners.append(listener)
+
+    def heartbeat(self):
+        """
+        Record this node as alive and rebuild the ring from the live members
+        """
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            result = db.execute(update(ShardMember).where(ShardMember.url == self.url).values(heartbeat_at=now))
+            if result.rowcount == 0:
+                db.add(ShardMember(url=self.url, started_at=now, heartbeat_at=now))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Rejoined by an earlier heartbeat of the same URL
+                db.rollback()
+
+            cutoff = now - timedelta(seconds=MEMBER_TIMEOUT)
+            members = set(db.scalars(select(ShardMember.url).where(ShardMember.heartbeat_at >= cutoff)))
+            # Forget nodes that died without leaving
+            db.execute(delete(ShardMember).where(ShardMember.heartbeat_at < now - timedelta(seconds=MEMBER_TIMEOUT * 10)))
+            db.commit()
+        finally:
+            db.close()
+
+        members.add(self.url)
+        with self._lock:
+            changed = members != set(self._ring.nodes)
+            if changed:
+                previous = self._ring.nodes
+                self._ring = HashRing(members)
+        if changed:
+            logger.info(f"Shard members changed from {previous} to {sorted(members)}")
+            metrics.SHARD_REBALANCES.inc()
+            for listener in self._listeners:
+                try:
+                    listener()
+                except Exception as e:
+                    logger.error(f"Error rebalancing shards: {str(e)}")
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"Error in shard heartbeat: {str(e)}")
+
+    def members(self):
+        with self._lock:
+            return list(self._ring.nodes)
+
+    def owner(self, hostname):
+        """
+        :return: URL of the node owning a device, None if sharding is disabled
+        """
+        return self._ring.owner(hostname)
+
+    def owns(self, hostname):
+        return self._ring.owner(hostname) == self.url
+
+    def group(self, hostnames):
+        """
+        Split hostnames by owning node, devices of this node are under its URL
+
+        :return: Dictionary of node URL to list of hostnames
+        """
+        ring = self._ring
+        groups = {}
+        for hostname in hostnames:
+            groups.setdefault(ring.owner(hostname), []).append(hostname)
+        return groups
+
+    def info(self):
+        return {"enabled": self.enabled, "url": self.url, "members": self.members()}
+
+    # Requests to other nodes
+
+    def _request(self, node, method, path, body=None, headers=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = urllib.request.Request(node + path, data=data, method=method)
+        request.add_header(FORWARDED_HEADER, self.url)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+        try:
+            return urllib.request.urlopen(request, timeout=FORWARD_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            # Error statuses are passed through to the caller like any other response
+            return e
+
+    def forward(self, node, method, path, body=None, headers=None):
+        """
+        Send a request to another node and read the whole response
+
+        :return: (status, headers, body bytes)
+        :raises OSError: If the node cannot be reached
+        """
+        with self._request(node, method, path, body, headers) as response:
+            content = response.read()
+            metrics.SHARD_REQUESTS.labels("forward", "ok" if response.status < 500 else "error").inc()
+            return response.status, _response_headers(response), content
+
+    def forward_stream(self, node, method, path, body=None, headers=None):
+        """
+        Send a request to another node and relay its response as it arrives
+
+        :return: (status, headers, generator of body chunks)
+        :raises OSError: If the node cannot be reached
+        """
+        response = self._request(node, method, path, body, headers)
+        metrics.SHARD_REQUESTS.labels("forward", "ok" if response.status < 500 else "error").inc()
+
+        def chunks():
+            with response:
+                while True:
+                    chunk = response.read1(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return response.status, _response_headers(response), chunks()
+
+    def scatter(self, node, path, body):
+        """
+        Run part of a fan-out on another node and yield its NDJSON records as they arrive
+
+        :raises OSError: If the node cannot be reached or fails
+        """
+        with self._request(node, "POST", path, body) as response:
+            if response.status != 200:
+                metrics.SHARD_REQUESTS.labels("scatter", "error").inc()
+                raise OSError(f"{node} answered {response.status}: {response.read()[:200].decode('utf-8', 'replace')}")
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        metrics.SHARD_REQUESTS.labels("scatter", "ok").inc()
+
+    def collect_metrics(self):
+        """
+        Export membership at scrape time
+        """
+        yield ('shard_members', 'Live nodes sharing the inventory', 'gauge', [({}, len(self.members()))])
+
+
+def _response_headers(response):
+    return {
+        name: value for name, value in response.headers.items()
+        if name.lower() not in _SKIPPED_HEADERS
+    }
+
+
+def merge(sources, max_workers=None):
+    """
+    Interleave the items of several generators in the order they are produced.
+
+    Each source runs in its own thread, so a slow node does not hold back
+    results from the others. Sources must handle their own errors.
+
+    :param sources: Callables returning iterables
+    """
+    if len(sources) == 1:
+        yield from sources[0]()
+        return
+
+    items = queue.Queue()
+    done = object()
+
+    def pump(source):
+        try:
+            for item in source():
+                items.put(item)
+        except Exception as e:
+            logger.error(f"Error gathering shard results: {str(e)}")
+        finally:
+            items.put(done)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(sources), thread_name_prefix="shard-gather") as executor:
+        for source in sources:
+            executor.submit(pump, source)
+
+        remaining = len(sources)
+        while remaining:
+            item = items.get()
+            if item is done:
+                remaining -= 1
+            else:
+                yield item
+
+
+# Global cluster membership, joins on import when SHARD_NODE_URL is set
+cluster = Cluster()
+cluster.start()
+metrics.register_collector(cluster.collect_metrics)
+atexit.register(cluster.stop)
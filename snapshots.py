@@ -0,0 +1,344 @@
+from datetime import datetime
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+import difflib
+import hashlib
+import logging
+import os
+import threading
+import zlib
+
+import metrics
+from database import SessionLocal
+from models import NetworkConnection, OutputChunk, OutputSnapshot, OutputSnapshotChunk
+from output_cache import normalize_command
+
+logger = logging.getLogger(__name__)
+
+# A chunk ends after a line whose CRC has this many low zero bits, about every 2**n lines
+CHUNK_BOUNDARY_BITS = int(os.environ.get("SNAPSHOT_CHUNK_BOUNDARY_BITS", "5"))
+# Hard limit on lines per chunk
+MAX_CHUNK_LINES = int(os.environ.get("SNAPSHOT_MAX_CHUNK_LINES", "256"))
+# zlib level used for stored chunks
+COMPRESSION_LEVEL = int(os.environ.get("SNAPSHOT_COMPRESSION_LEVEL", "6"))
+
+_BOUNDARY_MASK = (1 << CHUNK_BOUNDARY_BITS) - 1
+# Keep IN lists below SQLite's bound parameter limit
+_IN_BATCH = 500
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_chunks(output):
+    """
+    Split output into content-defined chunks on line boundaries.
+
+    Boundaries depend only on the line that ends a chunk, so a change in one
+    part of a config leaves the chunks before and after it untouched.
+
+    :return: List of chunks, joined they give back the output exactly
+    """
+    chunks = []
+    current = []
+    for line in output.splitlines(keepends=True):
+        current.append(line)
+        if (zlib.crc32(line.encode("utf-8")) & _BOUNDARY_MASK) == 0 or len(current) >= MAX_CHUNK_LINES:
+            chunks.append("".join(current))
+            current = []
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def snapshot_info(snapshot, hostname):
+    """
+    Describe a snapshot without its output
+    """
+    return {
+        "id": snapshot.id,
+        "hostname": hostname,
+        "command": snapshot.command,
+        "digest": snapshot.digest,
+        "size": snapshot.size,
+        "created_at": snapshot.created_at,
+        "last_seen": snapshot.last_seen
+    }
+
+
+class SnapshotStore:
+    """
+    Change history of command output per device and command.
+
+    Only distinct outputs are stored. They are split into content-defined
+    chunks which are compressed and stored once by their SHA-256, so a
+    config that did not change costs a hash compare and a timestamp
+    update, and a small change only stores the chunks around it.
+    """
+
+    def __init__(self):
+        self._latest = {}  # (connection_id, command) -> (snapshot_id, digest)
+        self._connection_ids = {}  # hostname -> NetworkConnection id
+        self._locks = [threading.Lock() for _ in range(64)]
+        self._lock = threading.Lock()
+        # Held while a snapshot reuses chunks it found stored, and while orphaned chunks are deleted
+        self._chunks_lock = threading.Lock()
+
+    def record(self, hostname, command, output):
+        """
+        Store output as the latest snapshot unless it equals the previous one
+
+        :return: Snapshot description with a changed flag
+        :raises KeyError: If the device is unknown
+        """
+        command = normalize_command(command)
+        digest = _digest(output)
+        now = datetime.utcnow()
+
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            connection_id = self._connection_id(db, hostname)
+            key = (connection_id, command)
+
+            # Serialize writers of the same device and command
+            with self._locks[hash(key) % len(self._locks)]:
+                latest = self._latest.get(key)
+                if latest is None:
+                    latest = self._load_latest(db, connection_id, command)
+
+                if latest is not None and latest[1] == digest:
+                    db.execute(update(OutputSnapshot).where(OutputSnapshot.id == latest[0]).values(last_seen=now))
+                    db.commit()
+                    metrics.SNAPSHOTS.labels("unchanged").inc()
+                    return {"id": latest[0], "digest": digest, "changed": False, "last_seen": now}
+
+                try:
+                    snapshot = self._store(db, connection_id, command, output, digest, now)
+                except IntegrityError:
+                    # Another device stored one of the same chunks first, they exist now
+                    db.rollback()
+                    snapshot = self._store(db, connection_id, command, output, digest, now)
+                with self._lock:
+                    self._latest[key] = (snapshot.id, digest)
+                metrics.SNAPSHOTS.labels("changed").inc()
+                return {"id": snapshot.id, "digest": digest, "changed": True, "last_seen": now}
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _store(self, db, connection_id, command, output, digest, now):
+        chunks = split_chunks(output)
+        digests = [_digest(chunk) for chunk in chunks]
+        # Chunks found stored must not be deleted as orphans before the snapshot using them commits
+        with self._chunks_lock:
+            # Only chunks not stored by any earlier snapshot are compressed and written
+            unique = list(dict.fromkeys(digests))
+            existing = set()
+            for start in range(0, len(unique), _IN_BATCH):
+                existing.update(db.scalars(
+                    select(OutputChunk.digest).where(OutputChunk.digest.in_(unique[start:start + _IN_BATCH]))
+                ))
+
+            added = set()
+            for chunk, chunk_digest in zip(chunks, digests):
+                if chunk_digest in existing or chunk_digest in added:
+                    continue
+                data = chunk.encode("utf-8")
+                db.add(OutputChunk(digest=chunk_digest, data=zlib.compress(data, COMPRESSION_LEVEL), size=len(data)))
+                added.add(chunk_digest)
+            metrics.SNAPSHOT_CHUNKS.labels("stored").inc(len(added))
+            metrics.SNAPSHOT_CHUNKS.labels("deduplicated").inc(len(digests) - len(added))
+
+            snapshot = OutputSnapshot(
+                connection_id=connection_id,
+                command=command,
+                digest=digest,
+                size=len(output.encode("utf-8")),
+                created_at=now,
+                last_seen=now
+            )
+            db.add(snapshot)
+            db.flush()
+            db.add_all(
+                OutputSnapshotChunk(snapshot_id=snapshot.id, position=position, digest=chunk_digest)
+                for position, chunk_digest in enumerate(digests)
+            )
+            db.commit()
+            return snapshot
+
+    def _connection_id(self, db, hostname):
+        connection_id = self._connection_ids.get(hostname)
+        if connection_id is None:
+            connection_id = db.scalar(select(NetworkConnection.id).where(NetworkConnection.hostname == hostname))
+            if connection_id is None:
+                raise KeyError(f"No connection to {hostname}")
+            with self._lock:
+                self._connection_ids[hostname] = connection_id
+        return connection_id
+
+    def _load_latest(self, db, connection_id, command):
+        row = db.execute(
+            select(OutputSnapshot.id, OutputSnapshot.digest)
+            .where(OutputSnapshot.connection_id == connection_id, OutputSnapshot.command == command)
+            .order_by(OutputSnapshot.id.desc())
+            .limit(1)
+        ).first()
+        return tuple(row) if row else None
+
+    def history(self, hostname, command=None, limit=50):
+        """
+        List snapshots of a device, newest first
+
+        :param command: Only snapshots of this command
+        :raises KeyError: If the device is unknown
+        """
+        db = SessionLocal()
+        try:
+            query = select(OutputSnapshot).where(OutputSnapshot.connection_id == self._connection_id(db, hostname))
+            if command:
+                query = query.where(OutputSnapshot.command == normalize_command(command))
+            snapshots = db.scalars(query.order_by(OutputSnapshot.id.desc()).limit(limit)).all()
+            return [snapshot_info(snapshot, hostname) for snapshot in snapshots]
+        finally:
+            db.close()
+
+    def get(self, hostname, command=None, snapshot_id=None, at=None):
+        """
+        Get a snapshot with its output
+
+        :param command: Command of the snapshot, required unless snapshot_id is given
+        :param snapshot_id: Exact snapshot
+        :param at: Snapshot that was current at this time, latest if omitted
+        :raises KeyError: If the device or snapshot does not exist
+        """
+        db = SessionLocal()
+        try:
+            snapshot = self._find(db, hostname, command, snapshot_id, at)
+            info = snapshot_info(snapshot, hostname)
+            info["output"] = self._output(db, snapshot.id)
+            return info
+        finally:
+            db.close()
+
+    def diff(self, hostname, command, from_id=None, to_id=None, from_time=None, to_time=None, context=3):
+        """
+        Unified diff between two snapshots of a command.
+
+        Defaults to the latest snapshot against the one before it.
+
+        :raises KeyError: If the device or a snapshot does not exist
+        """
+        db = SessionLocal()
+        try:
+            new = self._find(db, hostname, command, to_id, to_time)
+            if from_id is None and from_time is None:
+                # The snapshot just before the newer one, or itself if it is the first
+                previous = db.scalars(
+                    select(OutputSnapshot)
+                    .where(
+                        OutputSnapshot.connection_id == new.connection_id,
+                        OutputSnapshot.command == new.command,
+                        OutputSnapshot.id < new.id
+                    )
+                    .order_by(OutputSnapshot.id.desc())
+                    .limit(1)
+                ).first()
+                old = previous or new
+            else:
+                old = self._find(db, hostname, new.command, from_id, from_time)
+
+            changed = old.digest != new.digest
+            text = ""
+            if changed:
+                text = "".join(difflib.unified_diff(
+                    self._output(db, old.id).splitlines(keepends=True),
+                    self._output(db, new.id).splitlines(keepends=True),
+                    fromfile=f"{hostname} #{old.id} {old.created_at.isoformat()}",
+                    tofile=f"{hostname} #{new.id} {new.created_at.isoformat()}",
+                    n=context
+                ))
+            return {
+                "from": snapshot_info(old, hostname),
+                "to": snapshot_info(new, hostname),
+                "changed": changed,
+                "diff": text
+            }
+        finally:
+            db.close()
+
+    def _find(self, db, hostname, command, snapshot_id, at):
+        connection_id = self._connection_id(db, hostname)
+        query = select(OutputSnapshot).where(OutputSnapshot.connection_id == connection_id)
+
+        if snapshot_id is not None:
+            query = query.where(OutputSnapshot.id == snapshot_id)
+        else:
+            if not command:
+                raise ValueError("A command is required unless a snapshot id is given")
+            query = query.where(OutputSnapshot.command == normalize_command(command))
+            if at is not None:
+                query = query.where(OutputSnapshot.created_at <= at)
+            query = query.order_by(OutputSnapshot.id.desc()).limit(1)
+
+        snapshot = db.scalars(query).first()
+        if snapshot is None:
+            raise KeyError(f"No matching snapshot for {hostname}")
+        return snapshot
+
+    def _output(self, db, snapshot_id):
+        """
+        Reassemble the output of a snapshot from its chunks
+        """
+        rows = db.execute(
+            select(OutputChunk.data)
+            .join(OutputSnapshotChunk, OutputSnapshotChunk.digest == OutputChunk.digest)
+            .where(OutputSnapshotChunk.snapshot_id == snapshot_id)
+            .order_by(OutputSnapshotChunk.position)
+        )
+        return "".join(zlib.decompress(data).decode("utf-8") for data, in rows)
+
+    def delete_host(self, db, hostname):
+        """
+        Delete the history of a device, its chunks are left to delete_orphaned_chunks()
+
+        :param db: Database session, committed by the caller
+        """
+        connection_id = db.scalar(select(NetworkConnection.id).where(NetworkConnection.hostname == hostname))
+        with self._lock:
+            self._connection_ids.pop(hostname, None)
+            for key in [key for key in self._latest if key[0] == connection_id]:
+                del self._latest[key]
+        if connection_id is None:
+            return
+
+        snapshot_ids = select(OutputSnapshot.id).where(OutputSnapshot.connection_id == connection_id)
+        db.execute(delete(OutputSnapshotChunk).where(OutputSnapshotChunk.snapshot_id.in_(snapshot_ids)))
+        db.execute(delete(OutputSnapshot).where(OutputSnapshot.connection_id == connection_id))
+
+    def delete_orphaned_chunks(self):
+        """
+        Delete chunks no snapshot uses any more.
+
+        Runs in its own transaction, serialized with storing snapshots: a
+        snapshot that found a chunk stored only adds a reference to it, so
+        the chunk must not disappear before that reference is committed.
+
+        :return: Number of chunks deleted
+        """
+        with self._chunks_lock:
+            db = SessionLocal()
+            try:
+                result = db.execute(
+                    delete(OutputChunk).where(~OutputChunk.digest.in_(select(OutputSnapshotChunk.digest)))
+                )
+                db.commit()
+                return result.rowcount
+            finally:
+                db.close()
+
+
+# Global snapshot store
+snapshot_store = SnapshotStore()
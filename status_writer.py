@@ -0,0 +1,184 @@
+from sqlalchemy import select, update
+from sqlalchemy.orm.exc import StaleDataError
+import atexit
+import logging
+import os
+import threading
+import time
+
+import metrics
+from database import SessionLocal
+from models import NetworkConnection
+
+logger = logging.getLogger(__name__)
+
+# Seconds between batched status writes
+FLUSH_INTERVAL = float(os.environ.get("STATUS_FLUSH_INTERVAL", os.environ.get("HEALTH_CHECK_STATUS_FLUSH", "5")))
+# Queued devices that trigger a write before the interval is over
+BATCH_SIZE = int(os.environ.get("STATUS_FLUSH_BATCH_SIZE", "500"))
+# Failed writes of a device's update before it is dropped
+MAX_RETRIES = int(os.environ.get("STATUS_FLUSH_MAX_RETRIES", "3"))
+
+
+class StatusWriter:
+    """
+    Write-behind queue for device status columns.
+
+    Updates from any thread are merged per device and written by a single
+    background thread in one transaction per batch, so concurrent workers
+    never share a database session or hold write locks.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+
+        self._pending = {}  # id -> column values
+        self._failures = {}  # id -> failed writes in a row
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the writer in a background thread
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="status-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the writer and write everything still queued
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def queue(self, connection_id, **values):
+        """
+        Queue column updates for a device, later values win
+
+        :param connection_id: NetworkConnection id
+        :param values: Column values, e.g. is_connected=True
+        """
+        with self._lock:
+            self._pending.setdefault(connection_id, {"id": connection_id}).update(values)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def discard(self, connection_id):
+        """
+        Drop queued updates of a device that is being deleted
+        """
+        with self._lock:
+            self._pending.pop(connection_id, None)
+            self._failures.pop(connection_id, None)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Write all queued updates in a single transaction
+
+        :return: Number of devices written
+        """
+        # One flush at a time so an older batch never overwrites a newer one
+        with self._flush_lock:
+            with self._lock:
+                pending = list(self._pending.values())
+                self._pending = {}
+            if not pending:
+                return 0
+
+            start = time.perf_counter()
+            db = SessionLocal()
+            try:
+                try:
+                    db.execute(update(NetworkConnection), pending)
+                except StaleDataError:
+                    # Devices deleted while their update was queued, write the others
+                    db.rollback()
+                    pending = self._existing(db, pending)
+                    if pending:
+                        db.execute(update(NetworkConnection), pending)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                self._requeue(pending)
+                logger.error(f"Error writing status of {len(pending)} devices: {str(e)}")
+                return 0
+            finally:
+                db.close()
+
+            with self._lock:
+                for row in pending:
+                    self._failures.pop(row["id"], None)
+            metrics.STATUS_FLUSH_SECONDS.observe(time.perf_counter() - start)
+            metrics.STATUS_WRITES.inc(len(pending))
+            return len(pending)
+
+    def _existing(self, db, rows):
+        """
+        Leave out rows of devices that no longer exist
+        """
+        ids = set(db.scalars(select(NetworkConnection.id).where(NetworkConnection.id.in_([row["id"] for row in rows]))))
+        missing = len(rows) - len(ids)
+        if missing:
+            logger.info(f"Dropped queued status of {missing} deleted devices")
+            metrics.STATUS_DROPPED.labels("deleted").inc(missing)
+            with self._lock:
+                for row in rows:
+                    if row["id"] not in ids:
+                        self._failures.pop(row["id"], None)
+        return [row for row in rows if row["id"] in ids]
+
+    def _requeue(self, rows):
+        """
+        Put a failed batch back without overwriting newer updates, rows that
+        failed MAX_RETRIES times are dropped
+        """
+        dropped = 0
+        with self._lock:
+            for row in rows:
+                failures = self._failures.get(row["id"], 0) + 1
+                if failures > self.max_retries:
+                    self._failures.pop(row["id"], None)
+                    dropped += 1
+                    continue
+                self._failures[row["id"]] = failures
+                newer = self._pending.get(row["id"])
+                self._pending[row["id"]] = dict(row, **newer) if newer else row
+        if dropped:
+            logger.warning(f"Dropped queued status of {dropped} devices after {self.max_retries} failed writes")
+            metrics.STATUS_DROPPED.labels("retries").inc(dropped)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error in status writer: {str(e)}")
+
+    def collect_metrics(self):
+        """
+        Export the queue depth at scrape time
+        """
+        yield ('status_writer_pending', 'Devices with queued status updates', 'gauge', [({}, self.pending())])
+
+
+# Global status writer, shared by the health checker, startup and bulk imports
+status_writer = StatusWriter()
+status_writer.start()
+metrics.register_collector(status_writer.collect_metrics)
+atexit.register(status_writer.stop)
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Modules read their settings and open the database on import
+_database_dir = tempfile.mkdtemp(prefix="ssh-api-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_database_dir, 'network_connections.db')}")
+# Devices in the tests are served by mock_device.py on this port
+SSH_PORT = free_port()
+os.environ["SSH_PORT"] = str(SSH_PORT)
+# Keep background health checks away from the devices under test
+os.environ.setdefault("HEALTH_CHECK_INTERVAL", "3600")
+os.environ.setdefault("HEALTH_CHECK_INVENTORY_REFRESH", "3600")
+# Jobs created by the tests are only run by the engines the tests start
+os.environ.setdefault("JOB_REFRESH_INTERVAL", "3600")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_device import MockDevice, start_device  # noqa: E402
+
+MOCK_HOST = "127.0.0.1"
+# Nothing listens here, connections are refused at once
+UNREACHABLE_HOST = "127.0.0.2"
+
+
+@pytest.fixture(scope="session")
+def _mock_server():
+    """
+    Mock IOS device served on MOCK_HOST:SSH_PORT for the whole test session
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="mock-device", daemon=True)
+    thread.start()
+    device = MockDevice("mock-sw1", output_lines=10)
+    server = asyncio.run_coroutine_threadsafe(start_device(device, MOCK_HOST, SSH_PORT), loop).result(10)
+    yield device
+
+    async def shutdown():
+        # End the shells of sessions still pooled by the modules under test
+        server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+
+
+@pytest.fixture
+def mock_device(_mock_server):
+    """
+    The mock device, answering without delay again after the test
+    """
+    yield _mock_server
+    _mock_server.latency = 0.0
+
+
+@pytest.fixture
+def device_params(mock_device):
+    """
+    Netmiko connection parameters of the mock device
+    """
+    return {
+        "device_type": "cisco_ios",
+        "host": MOCK_HOST,
+        "port": SSH_PORT,
+        "username": "admin",
+        "password": "admin",
+        "secret": "enable"
+    }
+
+
+@pytest.fixture
+def api():
+    """
+    Test client of the API app
+    """
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def mock_connection(api, mock_device):
+    """
+    The mock device added through the API, removed again after the test
+    """
+    response = api.post("/connections/", json={
+        "hostname": MOCK_HOST,
+        "username": "admin",
+        # The mock device accepts any login password, this one is also its enable secret
+        "password": "enable",
+        "device_type": "cisco_ios"
+    })
+    assert response.status_code == 200, response.text
+    yield MOCK_HOST
+    api.delete(f"/connections/{MOCK_HOST}")
+
+
+@pytest.fixture
+def live_server():
+    """
+    The API app served by uvicorn on a free local port, for tests needing a real HTTP connection
+
+    :return: Port number
+    """
+    import uvicorn
+
+    import main
+
+    # Streams cut off by a test must not hold up the shutdown
+    config = uvicorn.Config(
+        main.app, host="127.0.0.1", port=free_port(), log_level="warning", timeout_graceful_shutdown=1
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, name="api-server", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        assert time.monotonic() < deadline, "API server did not start"
+        time.sleep(0.05)
+    yield config.port
+    server.should_exit = True
+    thread.join(10)
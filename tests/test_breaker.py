@@ -0,0 +1,123 @@
+import time
+
+from netmiko.exceptions import ReadTimeout
+import pytest
+
+import breaker
+from breaker import CircuitBreaker, CircuitOpenError
+from conftest import MOCK_HOST, UNREACHABLE_HOST
+
+
+@pytest.fixture
+def fast_reset(monkeypatch):
+    monkeypatch.setattr(breaker, "FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(breaker, "RESET_TIMEOUT", 0.2)
+
+
+def _open(circuit):
+    for _ in range(breaker.FAILURE_THRESHOLD):
+        circuit.acquire()
+        circuit.failure(ConnectionError("TCP connection to device failed\nCommon causes: ..."))
+
+
+def test_failures_in_a_row_open_the_circuit(fast_reset):
+    circuit = CircuitBreaker("edge-sw1")
+    circuit.failure(ConnectionError("refused"))
+    circuit.success()
+    assert circuit.failures == 0
+
+    _open(circuit)
+
+    assert circuit.state == breaker.OPEN
+    assert circuit.last_error == "TCP connection to device failed"
+    with pytest.raises(CircuitOpenError) as error:
+        circuit.acquire()
+    assert 0 < error.value.retry_after <= 0.2
+
+
+def test_single_probe_after_reset_timeout(fast_reset):
+    circuit = CircuitBreaker("edge-sw1")
+    _open(circuit)
+    time.sleep(0.25)
+
+    assert circuit.acquire() is True
+    assert circuit.state == breaker.HALF_OPEN
+    # Everyone else keeps failing fast while the probe runs
+    with pytest.raises(CircuitOpenError):
+        circuit.acquire()
+
+    circuit.success()
+    assert circuit.state == breaker.CLOSED
+    assert circuit.acquire() is False
+
+
+def test_failed_probe_doubles_reset_timeout(fast_reset):
+    circuit = CircuitBreaker("edge-sw1")
+    _open(circuit)
+    time.sleep(0.25)
+
+    circuit.acquire()
+    circuit.failure(ConnectionError("still refused"))
+
+    assert circuit.state == breaker.OPEN
+    assert circuit.reset_timeout == pytest.approx(0.4)
+    time.sleep(0.25)
+    with pytest.raises(CircuitOpenError):
+        circuit.check()
+
+
+def test_released_probe_lets_the_next_caller_probe(fast_reset):
+    circuit = CircuitBreaker("edge-sw1")
+    _open(circuit)
+    time.sleep(0.25)
+
+    assert circuit.acquire() is True
+    circuit.release()
+    assert circuit.acquire() is True
+
+
+@pytest.fixture
+def manager(mock_device, fast_reset):
+    from connection_manager import connection_manager
+    from database import SessionLocal
+    from models import NetworkConnection
+
+    # Startup synchronization would connect the devices as well and add failures of its own
+    connection_manager._startup_thread.join(30)
+    db = SessionLocal()
+    for hostname in (MOCK_HOST, UNREACHABLE_HOST):
+        db.add(NetworkConnection(hostname=hostname, username="admin", device_type="cisco_ios"))
+    db.commit()
+    yield connection_manager
+    for hostname in (MOCK_HOST, UNREACHABLE_HOST):
+        connection_manager.remove_connection(db, hostname)
+    db.close()
+
+
+def test_unreachable_device_opens_its_circuit(manager):
+    for _ in range(breaker.FAILURE_THRESHOLD):
+        with pytest.raises(ConnectionError):
+            with manager.session(UNREACHABLE_HOST):
+                pass
+
+    assert breaker.circuit_breakers.describe(UNREACHABLE_HOST)["state"] == breaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        with manager.session(UNREACHABLE_HOST):
+            pass
+
+
+def test_slow_commands_do_not_open_the_circuit(manager, mock_device, monkeypatch):
+    # A single failure would be enough to open the circuit
+    monkeypatch.setattr(breaker, "FAILURE_THRESHOLD", 1)
+    with pytest.raises(ReadTimeout):
+        with manager.session(MOCK_HOST) as session:
+            mock_device.latency = 1.5
+            try:
+                session.send_command("show version", read_timeout=0.5)
+            finally:
+                mock_device.latency = 0.0
+
+    circuit = breaker.circuit_breakers.describe(MOCK_HOST)
+    assert circuit["state"] == breaker.CLOSED and circuit["failures"] == 0
+    with manager.session(MOCK_HOST) as session:
+        assert "mock-sw1 uptime is" in session.send_command("show version")
@@ -0,0 +1,153 @@
+import gc
+import socket
+import time
+
+import pytest
+
+import command_stream
+from command_stream import CommandStreamTimeout, stream_command
+
+
+class _FakeChannel:
+    """
+    Netmiko-like session answering a command with scripted reads
+    """
+
+    host = "fake-sw1"
+    base_prompt = "fake-sw1"
+
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.read_count = 0
+        self.written = []
+
+    def clear_buffer(self):
+        pass
+
+    def normalize_cmd(self, command):
+        return command + "\n"
+
+    def write_channel(self, data):
+        self.written.append(data)
+
+    def read_channel(self):
+        self.read_count += 1
+        return self.reads.pop(0) if self.reads else ""
+
+
+@pytest.fixture(autouse=True)
+def fast_reads(monkeypatch):
+    monkeypatch.setattr(command_stream, "_READ_INTERVAL", 0.01)
+
+
+def test_lines_are_yielded_as_they_are_read():
+    channel = _FakeChannel([
+        "show log\r\nline 1\r\nline",
+        " 2\r\n",
+        "",
+        "line 3\r\nfake-sw1#"
+    ])
+    lines = stream_command(channel, "show log")
+
+    assert next(lines) == "line 1"
+    # Nothing past the first read was needed for the first line
+    assert channel.read_count == 1
+    assert next(lines) == "line 2"
+    assert channel.read_count == 2
+    assert list(lines) == ["line 3"]
+    assert channel.written == ["show log\n"]
+
+
+def test_only_a_trailing_prompt_ends_the_output():
+    channel = _FakeChannel([
+        "show run\nhostname fake-sw1\nfake-sw1# is quoted here\n",
+        "fake-sw1(config)#\nend\n",
+        "fake-sw1>"
+    ])
+    assert list(stream_command(channel, "show run")) == [
+        "hostname fake-sw1",
+        "fake-sw1# is quoted here",
+        "fake-sw1(config)#",
+        "end"
+    ]
+
+
+def test_missing_prompt_times_out():
+    channel = _FakeChannel(["show log\nline 1\n"])
+    lines = stream_command(channel, "show log", read_timeout=0.2)
+
+    assert next(lines) == "line 1"
+    with pytest.raises(CommandStreamTimeout, match="fake-sw1 within 0.2s"):
+        next(lines)
+
+
+def test_mock_device_output_is_streamed(device_params):
+    import transports
+
+    session = transports.connect(device_params)
+    try:
+        lines = list(stream_command(session, "show interfaces status"))
+        assert len(lines) == 11
+        assert lines[0].startswith("Port")
+        assert lines[-1].startswith("Gi0/9")
+        # The session is left at the prompt for the next command
+        assert "uptime is" in session.send_command("show version")
+    finally:
+        session.disconnect()
+
+
+def test_slow_mock_device_times_out(device_params, mock_device):
+    import transports
+
+    session = transports.connect(device_params)
+    mock_device.latency = 1.0
+    try:
+        with pytest.raises(CommandStreamTimeout):
+            list(stream_command(session, "show version", read_timeout=0.3))
+    finally:
+        session.disconnect()
+
+
+def test_stream_endpoint_applies_the_filter_while_reading(api, mock_connection):
+    response = api.post("/connections/command/stream", json={
+        "hostname": mock_connection,
+        "command": "show interfaces status",
+        "filter": {"include": "^Gi", "head": 3}
+    })
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert response.text == "".join(f"Gi0/{index:<6} mock link {index:<8} connected    1          a-full  a-1000 10/100/1000BaseTX\n" for index in range(3))
+
+
+def test_session_is_discarded_when_the_client_goes_away(live_server, mock_connection, mock_device):
+    import connection_manager
+    from breaker import circuit_breakers
+
+    pool = connection_manager.connection_manager.get_pool(mock_connection)
+    # Long enough that the stream is still running when the client leaves
+    mock_device.output_lines = 20000
+    try:
+        with socket.create_connection(("127.0.0.1", live_server), timeout=10) as sock:
+            body = f'{{"hostname": "{mock_connection}", "command": "show interfaces status"}}'.encode()
+            sock.sendall(
+                b"POST /connections/command/stream HTTP/1.1\r\nHost: localhost\r\n"
+                b"Content-Type: application/json\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+            )
+            received = b""
+            while b"Gi0/" not in received:
+                received += sock.recv(65536)
+            assert pool.stats()["in_use"] == 1
+            size = pool.size
+
+        deadline = time.monotonic() + 20
+        while pool.stats()["in_use"]:
+            assert time.monotonic() < deadline, "session was not returned after the disconnect"
+            # The abandoned generator closes once it is collected
+            gc.collect()
+            time.sleep(0.05)
+    finally:
+        mock_device.output_lines = 10
+
+    # The channel was left mid-output, so the session is closed instead of reused
+    assert pool.size == size - 1
+    assert circuit_breakers.describe(mock_connection)["state"] == "closed"
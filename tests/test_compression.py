@@ -0,0 +1,144 @@
+import asyncio
+import zlib
+
+import pytest
+
+import compression
+from compression import CompressionMiddleware, choose_encoding
+
+BODY = b"interface GigabitEthernet0/1\n description uplink\n!\n" * 100
+
+
+@pytest.fixture
+def with_zstd(monkeypatch):
+    """
+    Negotiate as if zstandard were installed
+    """
+    if compression.zstandard is None:
+        monkeypatch.setattr(compression, "zstandard", object())
+
+
+@pytest.fixture
+def without_zstd(monkeypatch):
+    monkeypatch.setattr(compression, "zstandard", None)
+
+
+def test_gzip_is_chosen_when_asked_for(without_zstd):
+    assert choose_encoding("gzip, deflate") == "gzip"
+    assert choose_encoding("zstd, gzip") == "gzip"
+    assert choose_encoding("deflate, br") is None
+    assert choose_encoding("") is None
+    assert choose_encoding(None) is None
+
+
+def test_zstd_is_preferred_when_installed(with_zstd):
+    assert choose_encoding("gzip, zstd") == "zstd"
+    assert choose_encoding("gzip;q=0.8, zstd;q=0.8") == "zstd"
+    assert choose_encoding("gzip") == "gzip"
+
+
+def test_q_values_are_respected(with_zstd):
+    assert choose_encoding("gzip;q=1.0, zstd;q=0.5") == "gzip"
+    assert choose_encoding("zstd;q=0, gzip") == "gzip"
+    assert choose_encoding("gzip; q=0.000") is None
+    assert choose_encoding("gzip;q=bogus") is None
+    # The wildcard covers codings not named on their own
+    assert choose_encoding("*") == "zstd"
+    assert choose_encoding("zstd;q=0, *;q=0.1") == "gzip"
+    assert choose_encoding("*;q=0") is None
+
+
+def _respond(messages, accept_encoding="gzip", minimum_size=100):
+    """
+    Run the middleware around an app sending these ASGI messages
+
+    :return: Messages the client receives
+    """
+    async def app(scope, receive, send):
+        for message in messages:
+            await send(message)
+
+    received = []
+
+    async def send(message):
+        received.append(message)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    scope = {"type": "http", "headers": [(b"accept-encoding", accept_encoding.encode())]}
+    asyncio.run(CompressionMiddleware(app, minimum_size=minimum_size)(scope, receive, send))
+    return received
+
+
+def _start(headers=()):
+    return {"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain"), *headers]}
+
+
+def _headers(message):
+    return {name.decode(): value.decode() for name, value in message["headers"]}
+
+
+def test_large_bodies_are_compressed(without_zstd):
+    start, body = _respond([
+        _start([(b"content-length", str(len(BODY)).encode())]),
+        {"type": "http.response.body", "body": BODY}
+    ])
+
+    headers = _headers(start)
+    assert headers["content-encoding"] == "gzip"
+    assert headers["vary"] == "Accept-Encoding"
+    assert int(headers["content-length"]) == len(body["body"]) < len(BODY)
+    assert zlib.decompress(body["body"], 31) == BODY
+
+
+def test_small_bodies_are_sent_as_they_are(without_zstd):
+    start, body = _respond([_start(), {"type": "http.response.body", "body": b"ok"}])
+    assert "content-encoding" not in _headers(start)
+    assert body["body"] == b"ok"
+
+
+def test_clients_not_asking_get_identity(without_zstd):
+    start, body = _respond([_start(), {"type": "http.response.body", "body": BODY}], accept_encoding="br")
+    assert "content-encoding" not in _headers(start)
+    assert body["body"] == BODY
+
+
+def test_encoded_bodies_are_not_compressed_again(without_zstd):
+    encoded = zlib.compress(BODY)
+    start, body = _respond([
+        _start([(b"content-encoding", b"deflate")]),
+        {"type": "http.response.body", "body": encoded}
+    ])
+    assert _headers(start)["content-encoding"] == "deflate"
+    assert body["body"] == encoded
+
+
+def test_streamed_chunks_are_flushed_one_by_one(without_zstd):
+    chunks = [b'{"hostname": "sw%d"}\n' % index for index in range(3)]
+    start, *bodies = _respond([
+        _start([(b"content-length", b"999")]),
+        *({"type": "http.response.body", "body": chunk, "more_body": True} for chunk in chunks),
+        {"type": "http.response.body", "body": b"", "more_body": False}
+    ])
+
+    headers = _headers(start)
+    assert headers["content-encoding"] == "gzip"
+    # The compressed length is not known up front
+    assert "content-length" not in headers
+
+    # Every chunk can be decoded as soon as it arrives, even the small first one
+    decoder = zlib.decompressobj(31)
+    for chunk, body in zip(chunks, bodies):
+        assert body["more_body"]
+        assert decoder.decompress(body["body"]) == chunk
+    assert not bodies[-1]["more_body"]
+    decoder.decompress(bodies[-1]["body"])
+    assert decoder.eof
+
+
+def test_zstd_bodies_decode():
+    zstandard = pytest.importorskip("zstandard")
+    start, body = _respond([_start(), {"type": "http.response.body", "body": BODY}], accept_encoding="zstd")
+    assert _headers(start)["content-encoding"] == "zstd"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(body["body"]) == BODY
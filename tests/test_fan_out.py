@@ -0,0 +1,50 @@
+import threading
+import time
+
+import fan_out
+
+
+def test_results_are_collected_per_device():
+    def run(hostname):
+        if hostname == "bad":
+            raise ValueError("unreachable")
+        return hostname.upper()
+
+    results = {hostname: (status, value) for hostname, status, value in fan_out.fan_out(["a", "b", "bad"], run)}
+
+    assert results["a"] == (fan_out.STATUS_OK, "A")
+    assert results["b"] == (fan_out.STATUS_OK, "B")
+    assert results["bad"][0] == fan_out.STATUS_ERROR
+
+
+def test_device_deadline_starts_when_marked():
+    # One worker, the second device queues behind the first for longer than the deadline
+    def run(hostname):
+        time.sleep(0.6)
+        fan_out.mark_started()
+        time.sleep(0.1)
+        return hostname
+
+    results = fan_out.fan_out(["a", "b"], run, max_workers=1, device_timeout=0.5)
+
+    assert sorted(status for _, status, _ in results) == [fan_out.STATUS_OK, fan_out.STATUS_OK]
+
+
+def test_device_deadline_expires_after_start():
+    release = threading.Event()
+
+    def run(hostname):
+        fan_out.mark_started()
+        release.wait(5)
+        return hostname
+
+    start = time.monotonic()
+    results = fan_out.fan_out(["a"], run, device_timeout=0.3)
+    release.set()
+
+    assert results == [("a", fan_out.STATUS_TIMEOUT, 0.3)]
+    assert time.monotonic() - start < 2
+
+
+def test_mark_started_outside_fan_out_is_ignored():
+    fan_out.mark_started()
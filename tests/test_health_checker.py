@@ -0,0 +1,122 @@
+import time
+
+import pytest
+
+import health_checker
+from conftest import MOCK_HOST, UNREACHABLE_HOST
+from health_checker import HealthChecker
+from status_writer import status_writer
+
+
+@pytest.fixture
+def checker(mock_device, monkeypatch):
+    from connection_manager import connection_manager
+    from database import SessionLocal
+    from models import NetworkConnection
+
+    monkeypatch.setattr(health_checker, "CHECK_INTERVAL", 10)
+    monkeypatch.setattr(health_checker, "MAX_BACKOFF", 50)
+    monkeypatch.setattr(health_checker, "_JITTER", 0)
+
+    # Startup synchronization would connect the devices as well
+    connection_manager._startup_thread.join(30)
+    db = SessionLocal()
+    for hostname in (MOCK_HOST, UNREACHABLE_HOST):
+        db.add(NetworkConnection(hostname=hostname, username="admin", device_type="cisco_ios"))
+    db.commit()
+
+    # Not started, the tests run the checks themselves
+    checker = HealthChecker(connection_manager)
+    checker._refresh_inventory()
+    yield checker
+    checker._executor.shutdown(wait=True)
+    for hostname in (MOCK_HOST, UNREACHABLE_HOST):
+        connection_manager.remove_connection(db, hostname)
+    db.close()
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    """
+    Status updates queued with the status writer, by device id
+    """
+    updates = {}
+    queue = status_writer.queue
+
+    def record(connection_id, **values):
+        updates.setdefault(connection_id, []).append(values)
+        queue(connection_id, **values)
+
+    monkeypatch.setattr(status_writer, "queue", record)
+    return updates
+
+
+def _delay(checker, hostname):
+    return checker._due[hostname] - time.monotonic()
+
+
+def _is_connected(hostname):
+    from database import SessionLocal
+    from models import NetworkConnection
+
+    db = SessionLocal()
+    try:
+        return db.query(NetworkConnection).filter_by(hostname=hostname).one().is_connected
+    finally:
+        db.close()
+
+
+def test_only_idle_sessions_are_probed(checker, queued):
+    connection_id = checker._devices[MOCK_HOST].id
+
+    # No session yet, the failed probe connects the device
+    checker._check(MOCK_HOST)
+    pool = checker.manager.get_pool(MOCK_HOST)
+    assert pool.size == 1
+    assert any("last_connected" in update for update in queued[connection_id])
+
+    # The idle session is probed and put back
+    queued.clear()
+    checker._check(MOCK_HOST)
+    assert pool.size == 1
+    assert pool.stats()["in_use"] == 0
+    assert [sorted(update) for update in queued[connection_id]] == [["is_connected", "last_check"]]
+    assert queued[connection_id][0]["is_connected"] is True
+
+    # A busy session is proof of life, no other session is opened for the probe
+    session = pool.checkout()
+    try:
+        checker._check(MOCK_HOST)
+        assert pool.size == 1
+        assert queued[connection_id][-1]["is_connected"] is True
+    finally:
+        pool.checkin(session)
+
+    status_writer.flush()
+    assert _is_connected(MOCK_HOST)
+    assert 9 < _delay(checker, MOCK_HOST) <= 10
+
+
+def test_failing_device_backs_off_exponentially(checker, queued):
+    connection_id = checker._devices[UNREACHABLE_HOST].id
+
+    delays = []
+    for _ in range(4):
+        checker._check(UNREACHABLE_HOST)
+        delays.append(round(_delay(checker, UNREACHABLE_HOST)))
+
+    assert delays == [20, 40, 50, 50]
+    assert checker._failures[UNREACHABLE_HOST] == 4
+    assert all(update["is_connected"] is False for update in queued[connection_id])
+    status_writer.flush()
+    assert _is_connected(UNREACHABLE_HOST) is False
+
+
+def test_recovered_device_is_checked_at_the_normal_interval(checker, queued):
+    checker._failures[MOCK_HOST] = 3
+
+    checker._check(MOCK_HOST)
+
+    assert MOCK_HOST not in checker._failures
+    assert 9 < _delay(checker, MOCK_HOST) <= 10
+    assert queued[checker._devices[MOCK_HOST].id][-1]["is_connected"] is True
@@ -0,0 +1,50 @@
+import fnmatch
+import random
+
+import pytest
+
+from host_index import HostIndex
+
+HOSTNAMES = [
+    "core-rtr-a", "core-rtr-b", "core-rtr-x", "Core-RTR-C",
+    "edge-sw1", "edge-sw2", "edge-sw3", "edge-sw4", "edge-sw12",
+    "dist-sw-01.lab", "dist-sw-02.lab", "fw]1", "fw[1", "10.0.0.1"
+]
+
+
+@pytest.fixture
+def index():
+    index = HostIndex()
+    index.load((hostname, "cisco_ios") for hostname in HOSTNAMES)
+    return index
+
+
+def _expected(pattern, hostnames=HOSTNAMES):
+    return sorted(hostname for hostname in hostnames if fnmatch.fnmatchcase(hostname.lower(), pattern.lower()))
+
+
+@pytest.mark.parametrize("pattern", [
+    "edge-sw[123]", "core-rtr-[abc]", "core-rtr-[!xyz]", "edge-sw[1-3]", "edge-sw[!1]*",
+    "core-rtr-?", "*-sw*", "dist-sw-0[12].lab", "fw[]]1", "fw[[]1", "fw[1", "10.0.0.[0-9]",
+    "*", "edge-sw1", "nothing*"
+])
+def test_glob_matches_fnmatch(index, pattern):
+    assert index.glob(pattern) == _expected(pattern)
+
+
+def test_glob_matches_fnmatch_on_random_patterns():
+    rng = random.Random(7)
+    alphabet = "abcdesw-12."
+    hostnames = {"".join(rng.choice(alphabet) for _ in range(rng.randint(3, 10))) for _ in range(300)}
+    index = HostIndex()
+    index.load((hostname, None) for hostname in hostnames)
+
+    pieces = ["*", "?", "[12]", "[!a-c]", "[]a]", "sw", "e-", "a", "1", "."]
+    for _ in range(500):
+        pattern = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 5)))
+        assert index.glob(pattern) == _expected(pattern, hostnames), pattern
+
+
+def test_search_and_prefix_ignore_case(index):
+    assert index.search("RTR-C") == ["Core-RTR-C"]
+    assert index.prefix("core-rtr-") == ["core-rtr-a", "core-rtr-b", "Core-RTR-C", "core-rtr-x"]
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import socket
+
+import pytest
+
+import inventory
+from inventory import ImportFormatError, import_devices, iter_records
+
+
+async def _chunks(body, size=7):
+    """
+    Deliver a body in small pieces, cutting through lines and multi-byte characters
+    """
+    data = body.encode("utf-8") if isinstance(body, str) else body
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def _records(body, format, size=7):
+    async def collect():
+        return [record async for record in iter_records(_chunks(body, size), format)]
+    return asyncio.run(collect())
+
+
+def test_csv_rows_are_read_across_chunks():
+    body = (
+        "﻿hostname,username,password,device_type\r\n"
+        "sw1,admin,secret,cisco_ios\r\n"
+        '"sw2",admin,"pass, with\nnewline",cisco_xe\r\n'
+        "\r\n"
+        "süd-sw3,admin,secret,\r\n"
+    )
+    assert _records(body, "csv") == [
+        (1, {"hostname": "sw1", "username": "admin", "password": "secret", "device_type": "cisco_ios"}, None),
+        (2, {"hostname": "sw2", "username": "admin", "password": "pass, with\nnewline", "device_type": "cisco_xe"}, None),
+        # Empty cells are left out so defaults apply
+        (3, {"hostname": "süd-sw3", "username": "admin", "password": "secret"}, None),
+    ]
+
+
+def test_malformed_csv_row_does_not_stop_the_import():
+    body = "hostname,username\nsw1,admin\nsw2,admin,extra\nsw3,admin\n"
+    records = _records(body, "csv")
+    assert [number for number, _, _ in records] == [1, 2, 3]
+    assert records[1] == (2, None, "Expected 2 columns, got 3")
+    assert records[2][1] == {"hostname": "sw3", "username": "admin"}
+
+    with pytest.raises(ImportFormatError, match="Unterminated"):
+        _records('hostname\n"sw1\n', "csv")
+
+
+def test_empty_bodies_have_no_records():
+    assert _records("", "csv") == []
+    assert _records("﻿", "ndjson") == []
+    assert _records("﻿ [ ] \n", "json") == []
+    with pytest.raises(ImportFormatError, match="Incomplete"):
+        _records("", "json")
+
+
+def test_large_json_array_is_decoded_element_by_element():
+    devices = [{"hostname": f"sw{index}", "username": "admin", "note": "ü" * (index % 5)} for index in range(5000)]
+    records = _records(json.dumps(devices, indent=1), "json", size=1000)
+
+    assert len(records) == 5000
+    assert records[-1] == (5000, devices[-1], None)
+    assert all(record == device for (_, record, _), device in zip(records, devices))
+
+
+def test_invalid_json_array_is_reported():
+    with pytest.raises(ImportFormatError, match="Expected a JSON array"):
+        _records('{"hostname": "sw1"}', "json")
+    with pytest.raises(ImportFormatError, match="after device 1"):
+        _records('[{"hostname": "sw1"} {"hostname": "sw2"}]', "json")
+    with pytest.raises(ImportFormatError, match="Incomplete"):
+        _records('[{"hostname": "sw1"},', "json")
+
+
+def test_malformed_ndjson_line_does_not_stop_the_import():
+    records = _records('{"hostname": "sw1"}\n{"hostname": \n\n{"hostname": "sw3"}', "ndjson")
+    assert records[0] == (1, {"hostname": "sw1"}, None)
+    assert records[1][0] == 2 and records[1][2].startswith("Invalid JSON")
+    assert records[2] == (3, {"hostname": "sw3"}, None)
+
+
+@pytest.fixture
+def imported():
+    """
+    Hostnames imported by a test, removed afterwards
+    """
+    import connection_manager
+    from database import SessionLocal
+
+    hostnames = []
+    yield hostnames
+    db = SessionLocal()
+    try:
+        for hostname in hostnames:
+            connection_manager.connection_manager.remove_connection(db, hostname)
+    finally:
+        db.close()
+
+
+def test_every_record_is_validated(imported):
+    body = "\n".join(json.dumps(record) for record in [
+        {"hostname": "inventory-sw1", "username": "admin", "password": "secret", "device_type": "cisco_ios"},
+        {"hostname": "inventory-sw2", "username": "admin", "device_type": "cisco_ios"},
+        ["inventory-sw3"],
+        {"hostname": "inventory-sw4", "username": "admin", "password": "secret", "device_type": "cisco_ios", "max_sessions": 0},
+    ])
+    imported.extend(["inventory-sw1"])
+
+    async def collect():
+        records = iter_records(_chunks(body), "ndjson")
+        return [result async for result in import_devices(records, connect=False)]
+
+    results = asyncio.run(collect())
+    invalid = {result["record"]: result for result in results if result.get("status") == "invalid"}
+
+    assert invalid[2]["hostname"] == "inventory-sw2"
+    assert invalid[2]["error"] == "password: Field required"
+    assert invalid[3]["error"] == "Expected an object"
+    assert invalid[4]["error"].startswith("max_sessions: Input should be greater than or equal to 1")
+    assert {"hostname": "inventory-sw1", "status": "imported"} in results
+    assert results[-1] == {"summary": {"imported": 1, "connected": 0, "failed": 0, "invalid": 3}}
+
+
+def _read_until(sock, buffer, text):
+    while text not in buffer:
+        data = sock.recv(65536)
+        assert data, f"connection closed before {text!r} arrived"
+        buffer += data.decode("utf-8")
+    return buffer
+
+
+def test_bulk_import_streams_results_while_the_body_is_read(live_server, imported, monkeypatch):
+    imported.extend(["bulk-sw1", "bulk-sw2"])
+    # Upsert and report every record on its own
+    monkeypatch.setattr(inventory, "BATCH_SIZE", 1)
+
+    def record(hostname):
+        line = json.dumps({"hostname": hostname, "username": "admin", "password": "secret", "device_type": "cisco_ios"}) + "\n"
+        return f"{len(line.encode('utf-8')):x}\r\n{line}\r\n".encode("utf-8")
+
+    with socket.create_connection(("127.0.0.1", live_server), timeout=10) as sock:
+        sock.sendall(
+            b"POST /connections/bulk?connect=false HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Content-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+        sock.sendall(record("bulk-sw1"))
+
+        # The first device is reported while the request body is still open
+        buffer = _read_until(sock, "", '"hostname": "bulk-sw1"')
+        assert buffer.startswith("HTTP/1.1 200")
+        assert "bulk-sw2" not in buffer
+
+        sock.sendall(record("bulk-sw2") + b"0\r\n\r\n")
+        buffer = _read_until(sock, buffer, '"summary"')
+
+    assert '"hostname": "bulk-sw2", "status": "imported"' in buffer
+    assert '"imported": 2' in buffer
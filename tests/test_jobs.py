@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import time
+
+import pytest
+
+from database import create_tables
+from jobs import JobEngine, TokenBucket
+
+_names = itertools.count()
+
+
+@pytest.fixture
+def engine():
+    create_tables()
+    engine = JobEngine()
+    created = []
+
+    def create_job(**fields):
+        job = engine.create_job(**{
+            "name": f"test-job-{next(_names)}",
+            # Resolves to no devices, so runs finish at once
+            "targets": [{"hostname": "no-such-device"}],
+            "commands": ["show clock"],
+            "interval": 3600,
+            **fields
+        })
+        created.append(job["id"])
+        return job
+
+    engine.create = create_job
+    yield engine
+    for job_id in created:
+        try:
+            engine.delete_job(job_id)
+        except KeyError:
+            pass
+    engine.stop()
+
+
+def _start_due_run(engine, job_id):
+    """
+    Start a job's pending run the way the scheduling loop would
+    """
+    engine._start_run(job_id, engine._due[job_id])
+
+
+def test_token_bucket_without_rate_never_waits():
+    bucket = TokenBucket(0)
+    assert all(bucket.acquire() == 0 for _ in range(100))
+
+
+def test_token_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(20, burst=3)
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+
+    start = time.monotonic()
+    waited = bucket.acquire()
+    assert 0.03 < waited <= 0.05
+    assert time.monotonic() - start >= 0.03
+
+
+def test_token_bucket_queues_concurrent_callers():
+    bucket = TokenBucket(50)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        waits = sorted(executor.map(lambda _: bucket.acquire(), range(5)))
+
+    # Every caller reserved its own slot instead of all waking at once
+    assert waits[0] == 0
+    assert waits[-1] == pytest.approx(4 / 50, abs=0.01)
+    assert time.monotonic() - start >= 0.07
+
+
+def test_run_is_skipped_while_the_previous_one_runs(engine):
+    job = engine.create()
+    engine._running[job["id"]] = object()
+
+    _start_due_run(engine, job["id"])
+
+    assert [run["status"] for run in engine.runs(job["id"])] == ["skipped"]
+    # The skipped run does not cost the job its next turn
+    assert engine.get_job(job["id"])["next_run_in"] == pytest.approx(3600, abs=1)
+
+
+def test_run_of_a_job_without_devices_finishes(engine):
+    job = engine.create()
+    _start_due_run(engine, job["id"])
+
+    run, = engine.runs(job["id"])
+    assert run["status"] == "ok"
+    assert run["devices"] == 0
+    assert not engine.get_job(job["id"])["running"]
+
+
+def test_run_now_on_a_disabled_job_runs_once(engine):
+    job = engine.create(enabled=False)
+    assert engine.get_job(job["id"])["next_run_in"] is None
+
+    assert engine.run_now(job["id"])
+    assert engine.get_job(job["id"])["next_run_in"] == 0
+    _start_due_run(engine, job["id"])
+
+    assert len(engine.runs(job["id"])) == 1
+    assert engine.get_job(job["id"])["next_run_in"] is None
+    assert job["id"] not in engine._due
+
+
+def test_run_now_refuses_a_running_job(engine):
+    job = engine.create()
+    engine._running[job["id"]] = object()
+    assert not engine.run_now(job["id"])
+    with pytest.raises(KeyError):
+        engine.run_now(-1)
+
+
+def test_update_reschedules_the_next_run(engine):
+    job = engine.create()
+    old_due = engine._due[job["id"]]
+
+    engine.update_job(job["id"], interval=60)
+    assert engine.get_job(job["id"])["next_run_in"] <= 60
+
+    # The entry of the old interval is superseded
+    engine._start_run(job["id"], old_due)
+    assert engine.runs(job["id"]) == []
+
+    engine.update_job(job["id"], enabled=False)
+    assert engine.get_job(job["id"])["next_run_in"] is None
+
+
+def test_deleted_job_is_not_run(engine):
+    job = engine.create()
+    due = engine._due[job["id"]]
+
+    engine.delete_job(job["id"])
+
+    engine._start_run(job["id"], due)
+    with pytest.raises(KeyError):
+        engine.get_job(job["id"])
+    assert engine.runs(job["id"]) == []
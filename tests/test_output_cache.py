@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+import transports
+from output_cache import OutputCache
+from session_pool import DeviceSessionPool
+
+
+def _concurrently(count, func):
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        return list(executor.map(lambda _: func(), range(count)))
+
+
+def test_concurrent_requests_share_one_round_trip():
+    cache = OutputCache()
+    calls = []
+
+    def run():
+        calls.append(1)
+        time.sleep(0.2)
+        return "Cisco IOS Software"
+
+    outputs = _concurrently(8, lambda: cache.get_or_run("edge-sw1", "show  version", False, run))
+
+    assert outputs == ["Cisco IOS Software"] * 8
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] == 7 and stats["in_flight"] == 0
+    assert cache.get("edge-sw1", "show version", False) == "Cisco IOS Software"
+
+
+def test_followers_get_the_leaders_error():
+    cache = OutputCache()
+
+    def run():
+        time.sleep(0.2)
+        raise ConnectionError("device went away")
+
+    def request():
+        try:
+            return cache.get_or_run("edge-sw1", "show version", False, run)
+        except ConnectionError as e:
+            return e
+
+    errors = _concurrently(4, request)
+
+    assert all(isinstance(error, ConnectionError) for error in errors)
+    assert cache.get("edge-sw1", "show version", False) is None
+
+
+def test_callers_not_joining_run_the_command_themselves():
+    cache = OutputCache()
+    release = threading.Event()
+    leader = threading.Thread(
+        target=cache.get_or_run, args=("edge-sw1", "show version", False, lambda: release.wait(5) and "leader")
+    )
+    leader.start()
+    time.sleep(0.1)
+
+    # A caller holding the device's only session must not wait for the leader
+    assert cache.get_or_run("edge-sw1", "show version", False, lambda: "own", join=False) == "own"
+    release.set()
+    leader.join()
+
+
+def test_uncacheable_commands_always_run():
+    cache = OutputCache()
+    calls = []
+
+    for _ in range(3):
+        cache.get_or_run("edge-sw1", "show clock", False, lambda: calls.append(1) or "12:00")
+
+    assert len(calls) == 3
+    assert cache.get("edge-sw1", "show clock", False) is None
+
+
+def test_output_of_invalidated_device_is_not_stored():
+    cache = OutputCache()
+
+    def run():
+        # The device is removed while its command runs
+        cache.invalidate_host("edge-sw1")
+        return "stale"
+
+    assert cache.get_or_run("edge-sw1", "show version", False, run) == "stale"
+    assert cache.get("edge-sw1", "show version", False) is None
+
+
+def test_concurrent_requests_to_a_device_share_one_session(device_params):
+    cache = OutputCache()
+    pool = DeviceSessionPool(device_params["host"], lambda: transports.connect(device_params), max_size=4)
+    commands = []
+
+    def run():
+        with pool.session() as session:
+            commands.append(1)
+            return session.send_command("show version")
+
+    try:
+        outputs = _concurrently(6, lambda: cache.get_or_run(device_params["host"], "show version", False, run))
+    finally:
+        pool.close()
+
+    assert len(set(outputs)) == 1 and "mock-sw1 uptime is" in outputs[0]
+    assert len(commands) == 1
+
+
+@pytest.mark.parametrize("enable_mode", [False, True])
+def test_enable_mode_is_part_of_the_key(enable_mode):
+    cache = OutputCache()
+    cache.get_or_run("edge-sw1", "show version", not enable_mode, lambda: "other mode")
+
+    assert cache.get_or_run("edge-sw1", "show version", enable_mode, lambda: "this mode") == "this mode"
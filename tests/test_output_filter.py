@@ -0,0 +1,89 @@
+import pytest
+
+from output_filter import OutputFilter
+
+OUTPUT = "\n".join(f"line {index}{' error' if index % 3 == 0 else ''}" for index in range(1, 31))
+
+
+def _lines(output):
+    return output.split("\n") if output else []
+
+
+def test_include_and_exclude_are_regular_expressions():
+    output, truncated = OutputFilter(include=r"error$").apply(OUTPUT)
+    assert _lines(output) == [f"line {index} error" for index in range(3, 31, 3)]
+    assert not truncated
+
+    output, _ = OutputFilter(include="error", exclude=r"line 1\d").apply(OUTPUT)
+    assert _lines(output) == ["line 3 error", "line 6 error", "line 9 error", "line 21 error", "line 24 error", "line 27 error", "line 30 error"]
+
+
+def test_head_and_tail():
+    output, truncated = OutputFilter(head=2).apply(OUTPUT)
+    assert _lines(output) == ["line 1", "line 2"]
+    assert truncated
+
+    output, truncated = OutputFilter(tail=2).apply(OUTPUT)
+    assert _lines(output) == ["line 29", "line 30 error"]
+    assert truncated
+
+    # Together they select a range, lines 10 to 20
+    output, _ = OutputFilter(head=20, tail=11).apply(OUTPUT)
+    assert _lines(output)[0] == "line 10"
+    assert _lines(output)[-1] == "line 20"
+    assert len(_lines(output)) == 11
+
+
+def test_limits_apply_to_the_lines_left_by_include():
+    output, truncated = OutputFilter(include="error", head=2).apply(OUTPUT)
+    assert _lines(output) == ["line 3 error", "line 6 error"]
+    assert truncated
+
+    output, truncated = OutputFilter(include="error", head=100, tail=100).apply(OUTPUT)
+    assert len(_lines(output)) == 10
+    assert not truncated
+
+
+def test_max_bytes_cuts_the_output():
+    output, truncated = OutputFilter(max_bytes=20).apply(OUTPUT)
+    assert output == "line 1\nline 2\nline 3"
+    assert truncated
+
+    output, truncated = OutputFilter(max_bytes=len(OUTPUT) + 1).apply(OUTPUT)
+    assert output == OUTPUT
+    assert not truncated
+
+
+def test_max_bytes_does_not_split_characters():
+    output, truncated = OutputFilter(max_bytes=4).apply("äää")
+    assert output == "ää"
+    assert truncated
+
+
+def test_lines_consumes_everything_after_the_limit():
+    read = []
+
+    def source():
+        for index in range(10):
+            read.append(index)
+            yield f"line {index}"
+
+    stats = {}
+    assert list(OutputFilter(head=1).lines(source(), stats)) == ["line 0"]
+    assert read == list(range(10))
+    assert stats == {"truncated": True}
+
+
+def test_invalid_filters_are_rejected():
+    with pytest.raises(ValueError, match="include"):
+        OutputFilter(include="(")
+    with pytest.raises(ValueError, match="tail"):
+        OutputFilter(tail=-1)
+
+
+def test_empty_request_filter_is_none():
+    from main import OutputFilterRequest
+
+    assert OutputFilter.from_request(None) is None
+    assert OutputFilter.from_request(OutputFilterRequest()) is None
+    assert OutputFilter.from_request(OutputFilterRequest(head=1)).head == 1
@@ -0,0 +1,79 @@
+import pytest
+
+import output_cache
+import parsing
+from parsing import ParseError, parse_output
+
+
+@pytest.fixture
+def site_templates(tmp_path, monkeypatch):
+    """
+    Site template directory, template lookups are not cached across tests
+    """
+    monkeypatch.setattr(parsing, "TEMPLATE_DIR", str(tmp_path))
+    parsing._compiled_template.cache_clear()
+    yield tmp_path
+    parsing._compiled_template.cache_clear()
+
+
+def test_ntc_templates_are_found_by_device_type_and_command():
+    template = parsing._compiled_template("cisco_ios", "show interfaces status")
+    assert template is not None
+    assert template.kind == "textfsm"
+    assert template.source.endswith("cisco_ios_show_interfaces_status.textfsm")
+    # IOS-XE shares the IOS templates it has none of its own for
+    assert parsing._compiled_template("cisco_xe", "show interfaces status").source == template.source
+    assert parsing._compiled_template("cisco_ios", "show mock-table") is None
+
+
+def test_site_templates_come_first(site_templates):
+    (site_templates / "cisco_ios_show_interfaces_status.textfsm").write_text(
+        "Value PORT (\\S+)\n\nStart\n  ^${PORT}\\s+mock -> Record\n"
+    )
+    records = parse_output("cisco_ios", "show interfaces status", "Gi0/1  mock link\nGi0/2  other\n")
+    assert records == [{"port": "Gi0/1"}]
+
+
+def test_parsed_records_are_cached_per_template_and_output():
+    output = "Port      Name  Status       Vlan  Duplex  Speed Type\nGi0/1     up    connected    1     a-full  a-1000 10/100/1000BaseTX\n"
+    records = parse_output("cisco_ios", "show interfaces status", output)
+    assert [record["port"] for record in records] == ["Gi0/1"]
+
+    # Same template and output, spelled differently
+    assert parse_output("cisco_ios", "show  interfaces  status", output) is records
+    assert parse_output("cisco_ios", "show interfaces status", output + "\n") is not records
+    assert parse_output("cisco_xe", "show interfaces status", output) is not records
+    key = ("cisco_ios", output_cache.normalize_command("show interfaces status"))
+    assert any(cached[:2] == key for cached in parsing._parse_cache._entries)
+
+
+def test_missing_template_is_a_parse_error():
+    with pytest.raises(ParseError, match="No parse template"):
+        parse_output("cisco_ios", "show mock-table", "anything")
+
+
+def test_mock_device_output_is_parsed(api, mock_connection):
+    response = api.post("/connections/command", json={
+        "hostname": mock_connection,
+        "command": "show interfaces status",
+        "parse": True,
+        "use_cache": False
+    })
+    assert response.status_code == 200, response.text
+    records = response.json()
+    assert len(records) == 10
+    assert records[0]["port"] == "Gi0/0"
+    assert records[0]["status"] == "connected"
+
+
+def test_output_without_template_falls_back_to_raw(api, mock_connection):
+    response = api.post("/connections/mdcommand", json={
+        "hostname": mock_connection,
+        "command": "show mock-table",
+        "parse": True
+    })
+    assert response.status_code == 200, response.text
+    result, = response.json()
+    assert "parsed" not in result
+    assert result["output"].startswith("show mock-table line 0")
+    assert "No parse template" in result["parse_error"]
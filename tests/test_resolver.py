@@ -0,0 +1,131 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import resolver as resolver_module
+from resolver import Resolver
+
+
+class _FakeDNS:
+    """
+    Answers lookups of names under .test and counts them
+    """
+
+    def __init__(self):
+        self.addresses = {"sw1.test": "192.0.2.1"}
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._getaddrinfo = socket.getaddrinfo
+
+    def getaddrinfo(self, host, *args, **kwargs):
+        if not host.endswith(".test"):
+            return self._getaddrinfo(host, *args, **kwargs)
+        with self._lock:
+            self.counts[host] = self.counts.get(host, 0) + 1
+        if host not in self.addresses:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (self.addresses[host], 0))]
+
+
+@pytest.fixture
+def dns(monkeypatch):
+    fake = _FakeDNS()
+    monkeypatch.setattr(resolver_module.socket, "getaddrinfo", fake.getaddrinfo)
+    return fake
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_addresses_are_not_looked_up(dns):
+    assert Resolver().resolve("192.0.2.7") == "192.0.2.7"
+    assert Resolver().resolve("2001:db8::1") == "2001:db8::1"
+    assert dns.counts == {}
+
+
+def test_addresses_are_cached_for_their_ttl(dns):
+    resolver = Resolver(ttl=0.2)
+    assert resolver.resolve("sw1.test") == "192.0.2.1"
+    assert resolver.resolve("sw1.test") == "192.0.2.1"
+    assert dns.counts["sw1.test"] == 1
+
+    # Once expired the old address is served while it is looked up again
+    dns.addresses["sw1.test"] = "192.0.2.2"
+    time.sleep(0.25)
+    assert resolver.resolve("sw1.test") == "192.0.2.1"
+    _wait_for(lambda: resolver.stats()["expired"] == 0)
+    assert resolver.resolve("sw1.test") == "192.0.2.2"
+    assert dns.counts["sw1.test"] == 2
+
+
+def test_failed_lookups_are_cached_for_the_negative_ttl(dns):
+    resolver = Resolver(negative_ttl=0.2)
+    assert resolver.resolve("gone.test") is None
+    assert resolver.resolve("gone.test") is None
+    assert dns.counts["gone.test"] == 1
+    assert resolver.stats()["negative"] == 1
+
+    # A failure is not served stale, the next caller waits for a new lookup
+    dns.addresses["gone.test"] = "192.0.2.9"
+    time.sleep(0.25)
+    assert resolver.resolve("gone.test") == "192.0.2.9"
+    assert dns.counts["gone.test"] == 2
+
+
+def test_concurrent_lookups_of_a_name_are_shared(dns, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    slow = dns.getaddrinfo
+
+    def getaddrinfo(host, *args, **kwargs):
+        started.set()
+        release.wait(5)
+        return slow(host, *args, **kwargs)
+
+    monkeypatch.setattr(resolver_module.socket, "getaddrinfo", getaddrinfo)
+    resolver = Resolver()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve("sw1.test"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["192.0.2.1"] * 5
+    assert dns.counts["sw1.test"] == 1
+
+
+def test_prefetch_fills_the_cache_in_the_background(dns):
+    resolver = Resolver()
+    resolver.prefetch(["sw1.test", "192.0.2.7"])
+    _wait_for(lambda: resolver.stats()["entries"] == 1)
+    assert resolver.resolve("sw1.test") == "192.0.2.1"
+    assert dns.counts == {"sw1.test": 1}
+
+
+def test_removing_a_device_forgets_its_address(dns):
+    import connection_manager
+    from database import SessionLocal
+    from models import NetworkConnection
+    from resolver import resolver
+
+    db = SessionLocal()
+    db.add(NetworkConnection(hostname="sw1.test", username="admin", device_type="cisco_ios"))
+    db.commit()
+    assert resolver.resolve("sw1.test") == "192.0.2.1"
+
+    connection_manager.connection_manager.remove_connection(db, "sw1.test")
+    db.close()
+
+    assert "sw1.test" not in resolver._entries
+    resolver.resolve("sw1.test")
+    assert dns.counts["sw1.test"] == 2
+    resolver.forget("sw1.test")
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import BATCH, HEALTH_CHECK, INTERACTIVE, CommandScheduler, QueueFull, command_scheduler
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+class _Recorder:
+    """
+    Queue commands on a scheduler from threads and record the order they get their slots in
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.order = []
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def queue(self, name, hostname="sw1", priority=INTERACTIVE, caller=None, device_limit=1):
+        def run():
+            with self.scheduler.slot(hostname, priority, caller, device_limit=device_limit, timeout=5):
+                with self._lock:
+                    self.order.append(name)
+
+        queued = self.scheduler.stats()["classes"][priority]["queued"]
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        # One at a time, so the queue order is known
+        _wait_for(lambda: self.scheduler.stats()["classes"][priority]["queued"] > queued)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(5)
+
+
+def test_interactive_commands_go_before_batch_and_health_checks():
+    scheduler = CommandScheduler(max_active=1)
+    recorder = _Recorder(scheduler)
+    blocker = scheduler.acquire("busy-sw", BATCH)
+
+    recorder.queue("health", priority=HEALTH_CHECK)
+    recorder.queue("batch", priority=BATCH)
+    recorder.queue("interactive", priority=INTERACTIVE)
+    scheduler.release(blocker)
+    recorder.join()
+
+    assert recorder.order == ["interactive", "batch", "health"]
+
+
+def test_callers_take_turns_within_a_class():
+    scheduler = CommandScheduler(max_active=1)
+    recorder = _Recorder(scheduler)
+    blocker = scheduler.acquire("busy-sw", BATCH)
+
+    for index in range(3):
+        recorder.queue(f"fan-out {index}", hostname=f"sw{index}", priority=BATCH, caller="fan-out")
+    for index in range(2):
+        recorder.queue(f"user {index}", hostname=f"user-sw{index}", priority=BATCH, caller="user")
+    assert scheduler.stats()["classes"][BATCH]["callers"] == 2
+    scheduler.release(blocker)
+    recorder.join()
+
+    assert recorder.order == ["fan-out 0", "user 0", "fan-out 1", "user 1", "fan-out 2"]
+
+
+def test_devices_get_no_more_slots_than_their_pool_size():
+    scheduler = CommandScheduler(max_active=10)
+    held = [scheduler.acquire("sw1", device_limit=2) for _ in range(2)]
+
+    # A third command on the device waits, other devices are not held up
+    with pytest.raises(QueueFull):
+        scheduler.acquire("sw1", device_limit=2, timeout=0.1)
+    scheduler.release(scheduler.acquire("sw2", device_limit=2, timeout=0.1))
+
+    scheduler.release(held.pop())
+    scheduler.release(scheduler.acquire("sw1", device_limit=2, timeout=0.1))
+    scheduler.release(held.pop())
+    assert scheduler.stats()["active"] == 0
+
+
+def test_full_queue_rejects_with_retry_after():
+    scheduler = CommandScheduler(max_active=1, max_queued=1)
+    recorder = _Recorder(scheduler)
+    blocker = scheduler.acquire("busy-sw", BATCH)
+    recorder.queue("waiting", priority=BATCH)
+
+    with pytest.raises(QueueFull) as error:
+        scheduler.acquire("sw2", BATCH)
+    assert error.value.retry_after >= 1
+    with pytest.raises(QueueFull):
+        scheduler.check(BATCH)
+    # Other classes have queues of their own
+    scheduler.check(INTERACTIVE)
+
+    scheduler.release(blocker)
+    recorder.join()
+    assert scheduler.stats()["classes"][BATCH]["rejected"] == 2
+
+
+def test_manager_limits_a_device_to_its_pool(mock_connection):
+    import connection_manager
+
+    manager = connection_manager.connection_manager
+    pool = manager.get_pool(mock_connection)
+    release = threading.Event()
+    holding = threading.Semaphore(0)
+
+    def hold():
+        with manager.session(mock_connection, caller="hold"):
+            holding.release()
+            release.wait(5)
+
+    threads = [threading.Thread(target=hold) for _ in range(pool.max_size + 1)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(pool.max_size):
+            assert holding.acquire(timeout=10)
+        # The extra command waits for its turn in the scheduler, not in the pool
+        _wait_for(lambda: command_scheduler.stats()["classes"][INTERACTIVE]["queued"] == 1)
+        assert pool.stats()["waiting"] == 0
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+
+def test_full_queue_is_answered_with_429(api, mock_connection, monkeypatch):
+    monkeypatch.setattr(command_scheduler, "max_queued", 0)
+
+    for path in ("/connections/command", "/connections/mdcommand"):
+        response = api.post(path, json={"hostname": mock_connection, "command": "show version", "use_cache": False})
+        assert response.status_code == 429, response.text
+        assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+import transports
+from session_pool import DeviceSessionPool, PoolClosed, PoolTimeout
+
+
+@pytest.fixture
+def pool(device_params):
+    connects = []
+
+    def factory():
+        session = transports.connect(device_params)
+        connects.append(session)
+        return session
+
+    pool = DeviceSessionPool(device_params["host"], factory, max_size=2)
+    pool.connects = connects
+    yield pool
+    pool.close()
+
+
+def test_sessions_are_checked_out_exclusively(pool):
+    first = pool.checkout()
+    second = pool.checkout()
+
+    assert first is not second
+    assert pool.stats()["in_use"] == 2
+    with pytest.raises(PoolTimeout):
+        pool.checkout(timeout=0.2)
+
+    pool.checkin(first)
+    assert pool.checkout(timeout=0.2) is first
+    pool.checkin(first)
+    pool.checkin(second)
+    assert len(pool.connects) == 2
+
+
+def test_concurrent_commands_never_exceed_pool_size(pool):
+    busy = 0
+    most_busy = 0
+    lock = threading.Lock()
+
+    def run(index):
+        nonlocal busy, most_busy
+        with pool.session() as session:
+            with lock:
+                busy += 1
+                most_busy = max(most_busy, busy)
+            try:
+                return session.send_command("show version")
+            finally:
+                with lock:
+                    busy -= 1
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        outputs = list(executor.map(run, range(12)))
+
+    assert all("mock-sw1 uptime is" in output for output in outputs)
+    assert most_busy <= 2
+    assert len(pool.connects) <= 2
+    assert pool.stats()["in_use"] == 0
+
+
+def test_session_is_discarded_after_an_error(pool):
+    with pytest.raises(RuntimeError):
+        with pool.session() as session:
+            raise RuntimeError("channel in unknown state")
+
+    assert pool.size == 0
+    with pool.session() as replacement:
+        assert replacement is not session
+        assert "mock-sw1" in replacement.find_prompt()
+
+
+def test_closed_pool_refuses_checkouts(pool):
+    pool.checkin(pool.checkout())
+    pool.close()
+
+    assert pool.size == 0
+    with pytest.raises(PoolClosed):
+        pool.checkout(timeout=0.2)
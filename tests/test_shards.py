@@ -0,0 +1,270 @@
+from datetime import datetime, timedelta
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import pytest
+
+import shards
+from conftest import MOCK_HOST, SSH_PORT, free_port
+from database import SessionLocal, create_tables
+from models import ShardMember
+from shards import Cluster, FORWARDED_HEADER, HashRing, merge
+
+NODES = [f"http://node-{index}:8111" for index in range(4)]
+HOSTNAMES = [f"edge-sw{index}" for index in range(2000)]
+
+
+def test_every_node_builds_the_same_ring():
+    ring = HashRing(NODES)
+    shuffled = HashRing(list(reversed(NODES)))
+
+    assert all(ring.owner(hostname) == shuffled.owner(hostname) for hostname in HOSTNAMES)
+
+
+def test_devices_are_spread_across_nodes():
+    ring = HashRing(NODES)
+    counts = {node: 0 for node in NODES}
+    for hostname in HOSTNAMES:
+        counts[ring.owner(hostname)] += 1
+
+    # 128 points per node keep every share within a third of the fair one
+    fair = len(HOSTNAMES) / len(NODES)
+    assert all(abs(count - fair) < fair / 3 for count in counts.values())
+
+
+def test_leaving_node_only_moves_its_own_devices():
+    before = HashRing(NODES)
+    after = HashRing(NODES[:-1])
+
+    for hostname in HOSTNAMES:
+        if before.owner(hostname) != NODES[-1]:
+            assert after.owner(hostname) == before.owner(hostname)
+        else:
+            assert after.owner(hostname) in NODES[:-1]
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([]).owner("edge-sw1") is None
+
+
+def test_single_node_owns_everything_without_sharding():
+    cluster = Cluster(url=None)
+
+    assert not cluster.enabled
+    assert cluster.owner("edge-sw1") is None
+    assert cluster.group(["edge-sw1", "edge-sw2"]) == {None: ["edge-sw1", "edge-sw2"]}
+
+
+def test_merge_yields_items_as_they_are_produced():
+    def slow():
+        time.sleep(0.3)
+        yield "slow"
+
+    def fast():
+        yield "fast"
+
+    def failing():
+        yield "partial"
+        raise ConnectionError("node went away")
+
+    items = list(merge([slow, fast, failing]))
+
+    assert sorted(items[:2]) == ["fast", "partial"]
+    assert items[2:] == ["slow"]
+
+
+@pytest.fixture
+def members():
+    create_tables([ShardMember.__table__])
+    yield
+    db = SessionLocal()
+    db.query(ShardMember).delete()
+    db.commit()
+    db.close()
+
+
+def test_expired_member_leaves_the_ring(members):
+    node, other = Cluster(NODES[0]), Cluster(NODES[1])
+    rebuilt = []
+    node.add_listener(lambda: rebuilt.append(node.members()))
+
+    node.heartbeat()
+    other.heartbeat()
+    node.heartbeat()
+    assert rebuilt == [NODES[:2]]
+    assert {node.owner(hostname) for hostname in HOSTNAMES} == set(NODES[:2])
+
+    # The other node stops heartbeating
+    db = SessionLocal()
+    db.query(ShardMember).filter_by(url=NODES[1]).update(
+        {"heartbeat_at": datetime.utcnow() - timedelta(seconds=shards.MEMBER_TIMEOUT + 1)}
+    )
+    db.commit()
+    db.close()
+    node.heartbeat()
+
+    assert rebuilt == [NODES[:2], NODES[:1]]
+    assert all(node.owns(hostname) for hostname in HOSTNAMES)
+
+
+def test_scatter_runs_devices_on_their_nodes(monkeypatch):
+    import main
+
+    cluster = Cluster(NODES[0])
+    cluster._ring = HashRing(NODES[:2])
+    monkeypatch.setattr(main, "cluster", cluster)
+    hostnames = HOSTNAMES[:50]
+    groups = cluster.group(hostnames)
+    local, remote = groups[NODES[0]], groups[NODES[1]]
+
+    sent = {}
+
+    def scatter(node, path, body):
+        sent[node] = (path, body)
+        # The node goes away before reporting its last device
+        for hostname in body["hostnames"][:-1]:
+            yield {"hostname": hostname, "node": node}
+        raise OSError("connection reset")
+
+    monkeypatch.setattr(cluster, "scatter", scatter)
+    run_here = []
+
+    def run_local(owned):
+        run_here.extend(owned)
+        for hostname in owned:
+            yield {"hostname": hostname, "node": NODES[0]}
+
+    records = list(main._scatter(
+        hostnames,
+        run_local,
+        "/shards/mdcommand",
+        {"command": "show version"},
+        lambda hostname, error: {"hostname": hostname, "error": error},
+        caller="ops"
+    ))
+
+    assert run_here == local
+    assert sent == {NODES[1]: (
+        "/shards/mdcommand",
+        {"request": {"command": "show version"}, "hostnames": remote, "caller": "ops"}
+    )}
+    by_hostname = {record["hostname"]: record for record in records}
+    assert len(records) == len(by_hostname) == len(hostnames)
+    assert all(by_hostname[hostname]["node"] == NODES[0] for hostname in local)
+    assert all(by_hostname[hostname]["node"] == NODES[1] for hostname in remote[:-1])
+    assert by_hostname[remote[-1]] == {"hostname": remote[-1], "error": f"Shard {NODES[1]} failed: connection reset"}
+
+
+def _call(port, method, path, body=None, headers=None):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}{path}",
+        data=json.dumps(body).encode("utf-8") if body is not None else None,
+        method=method,
+        headers={"Content-Type": "application/json", **(headers or {})}
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        content = response.read().decode("utf-8")
+        return json.loads(content) if response.headers.get_content_type() == "application/json" else content
+
+
+def _forwarded(port):
+    """
+    Requests a node forwarded to the owners of their devices
+    """
+    for line in _call(port, "GET", "/metrics").splitlines():
+        if line.startswith('shard_requests_total{kind="forward",result="ok"}'):
+            return int(float(line.split()[-1]))
+    return 0
+
+
+@pytest.fixture
+def nodes():
+    """
+    Two API nodes sharing one database, each in its own process
+
+    :return: Dictionary of node URL to (port, process)
+    """
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='ssh-api-shards-'), 'shared.db')}",
+        SSH_PORT=str(SSH_PORT),
+        SHARD_HEARTBEAT_INTERVAL="0.2",
+        SHARD_MEMBER_TIMEOUT="2"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    started = {}
+    try:
+        for _ in range(2):
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            started[url] = port, subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+                 "--log-level", "warning"],
+                cwd=root,
+                env=dict(env, SHARD_NODE_URL=url)
+            )
+            # One at a time, both would create the tables of the new database
+            _wait_for_members(port, len(started))
+        for port, _ in started.values():
+            _wait_for_members(port, 2)
+        yield started
+    finally:
+        for _, process in started.values():
+            process.kill()
+            process.wait(10)
+
+
+def _wait_for_members(port, count, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if len(_call(port, "GET", "/shards")["members"]) == count:
+                return
+        except OSError:
+            pass
+        assert time.monotonic() < deadline, f"Node on port {port} did not see {count} members"
+        time.sleep(0.1)
+
+
+def test_command_is_forwarded_to_the_owning_node_once(nodes, mock_device, monkeypatch):
+    shows = []
+    show = mock_device.show
+    monkeypatch.setattr(mock_device, "show", lambda command: shows.append(command) or show(command))
+
+    owner = HashRing(nodes).owner(MOCK_HOST)
+    (other,) = set(nodes) - {owner}
+    owner_port, _ = nodes[owner]
+    other_port, _ = nodes[other]
+
+    # Added through the other node, the owner connects it
+    _call(other_port, "POST", "/connections/", {
+        "hostname": MOCK_HOST, "username": "admin", "password": "enable", "device_type": "cisco_ios"
+    })
+    forwarded = _forwarded(other_port)
+    command = {"hostname": MOCK_HOST, "command": "show version", "use_cache": False}
+    output = _call(other_port, "POST", "/connections/command", command)
+
+    assert "mock-sw1 uptime is" in output
+    assert shows == ["show version"]
+    assert _forwarded(other_port) == forwarded + 1
+    assert _forwarded(owner_port) == 0
+
+    # A forwarded request is run where it arrives, it never bounces back
+    output = _call(other_port, "POST", "/connections/command", command, {FORWARDED_HEADER: owner})
+    assert "mock-sw1 uptime is" in output
+    assert shows == ["show version"] * 2
+    assert _forwarded(other_port) == forwarded + 1
+
+    # The owner dies without leaving, once it expires the other node takes over its devices
+    nodes[owner][1].kill()
+    _wait_for_members(other_port, 1)
+    assert _call(other_port, "GET", "/shards")["members"] == [other]
+    output = _call(other_port, "POST", "/connections/command", command)
+    assert "mock-sw1 uptime is" in output
+    assert shows == ["show version"] * 3
+    assert _forwarded(other_port) == forwarded + 1
@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import zlib
+
+import pytest
+from sqlalchemy import func, select
+
+import snapshots
+from database import SessionLocal, create_tables
+from models import NetworkConnection, OutputChunk
+from snapshots import SnapshotStore, split_chunks
+
+_names = itertools.count()
+
+
+def _config(lines=400, changed=None):
+    """
+    Config-like output, optionally with one line changed
+    """
+    rows = [f"interface GigabitEthernet0/{index}\n description link {index}\n!\n" for index in range(lines)]
+    if changed is not None:
+        rows[changed] = rows[changed].replace("description", "description changed")
+    return "".join(rows)
+
+
+def _chunk_count():
+    db = SessionLocal()
+    try:
+        return db.scalar(select(func.count()).select_from(OutputChunk))
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def store():
+    create_tables()
+    return SnapshotStore()
+
+
+@pytest.fixture
+def devices(store):
+    """
+    Add devices by name, removing them with their history afterwards
+    """
+    added = []
+
+    def add():
+        hostname = f"snapshot-sw{next(_names)}"
+        db = SessionLocal()
+        db.add(NetworkConnection(hostname=hostname, username="admin", device_type="cisco_ios"))
+        db.commit()
+        db.close()
+        added.append(hostname)
+        return hostname
+
+    yield add
+    for hostname in added:
+        _remove(store, hostname)
+
+
+def _remove(store, hostname):
+    db = SessionLocal()
+    try:
+        store.delete_host(db, hostname)
+        db.query(NetworkConnection).filter_by(hostname=hostname).delete()
+        db.commit()
+    finally:
+        db.close()
+    store.delete_orphaned_chunks()
+
+
+def test_chunks_join_back_to_the_output():
+    output = _config() + "no trailing newline"
+    assert "".join(split_chunks(output)) == output
+    assert split_chunks("") == []
+
+
+def test_chunk_boundaries_survive_a_change_elsewhere():
+    old = split_chunks(_config())
+    new = split_chunks(_config(changed=200))
+
+    assert len(old) > 10
+    # Only the chunk holding the changed line differs, plus its neighbour if a boundary moved
+    assert len(set(old) - set(new)) <= 2
+    assert old[:3] == new[:3]
+    assert old[-3:] == new[-3:]
+
+
+def test_chunks_are_cut_at_the_line_limit():
+    line = next(
+        f"line {index}\n" for index in itertools.count()
+        if zlib.crc32(f"line {index}\n".encode("utf-8")) & snapshots._BOUNDARY_MASK
+    )
+    chunks = split_chunks(line * (2 * snapshots.MAX_CHUNK_LINES + 1))
+    assert [chunk.count("\n") for chunk in chunks] == [snapshots.MAX_CHUNK_LINES, snapshots.MAX_CHUNK_LINES, 1]
+
+
+def test_unchanged_output_only_updates_last_seen(store, devices):
+    hostname = devices()
+    first = store.record(hostname, "show running-config", _config())
+    again = store.record(hostname, "show  running-config", _config())
+
+    assert first["changed"]
+    assert not again["changed"]
+    assert again["id"] == first["id"]
+    assert len(store.history(hostname)) == 1
+
+
+def test_devices_share_identical_chunks(store, devices):
+    first, second = devices(), devices()
+    store.record(first, "show running-config", _config())
+    stored = _chunk_count()
+
+    store.record(second, "show running-config", _config())
+    assert _chunk_count() == stored
+    # A small change only stores the chunks around it
+    store.record(second, "show running-config", _config(changed=200))
+    assert 0 < _chunk_count() - stored <= 2
+
+    assert store.get(first, "show running-config")["output"] == _config()
+    assert store.get(second, "show running-config")["output"] == _config(changed=200)
+
+
+def test_history_get_and_diff(store, devices):
+    hostname = devices()
+    old = store.record(hostname, "show running-config", _config())
+    new = store.record(hostname, "show running-config", _config(changed=5))
+    store.record(hostname, "show version", "Version 1")
+
+    history = store.history(hostname, "show running-config")
+    assert [snapshot["id"] for snapshot in history] == [new["id"], old["id"]]
+    assert len(store.history(hostname)) == 3
+    assert store.get(hostname, snapshot_id=old["id"])["output"] == _config()
+    assert store.get(hostname, "show running-config", at=history[1]["created_at"])["id"] == old["id"]
+
+    diff = store.diff(hostname, "show running-config")
+    assert diff["changed"]
+    assert (diff["from"]["id"], diff["to"]["id"]) == (old["id"], new["id"])
+    assert "- description link 5\n" in diff["diff"]
+    assert "+ description changed link 5\n" in diff["diff"]
+    assert not store.diff(hostname, "show running-config", from_id=new["id"], to_id=new["id"])["changed"]
+
+    with pytest.raises(KeyError):
+        store.get(hostname, "show clock")
+    with pytest.raises(KeyError):
+        store.history("no-such-device")
+
+
+def test_delete_keeps_chunks_other_devices_use(store, devices):
+    removed, kept = devices(), devices()
+    store.record(removed, "show running-config", _config(changed=1))
+    store.record(kept, "show running-config", _config())
+    store.record(removed, "show version", "only on the removed device\n")
+    before = _chunk_count()
+
+    _remove(store, removed)
+
+    assert _chunk_count() < before
+    assert store.get(kept, "show running-config")["output"] == _config()
+    with pytest.raises(KeyError):
+        store.history(removed)
+
+
+def test_chunks_of_a_removed_device_stay_for_concurrent_snapshots(store, devices):
+    for attempt in range(10):
+        removed, kept = devices(), devices()
+        output = _config(lines=50, changed=attempt)
+        store.record(removed, "show running-config", output)
+
+        # The second device finds the chunks stored while they become orphans
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            recorded = executor.submit(store.record, kept, "show running-config", output)
+            executor.submit(_remove, store, removed).result()
+            recorded.result()
+
+        assert store.get(kept, "show running-config")["output"] == output
@@ -0,0 +1,86 @@
+from datetime import datetime
+
+import pytest
+
+from database import SessionLocal, create_tables
+from models import NetworkConnection
+from status_writer import StatusWriter
+
+
+@pytest.fixture
+def connections():
+    create_tables([NetworkConnection.__table__])
+    db = SessionLocal()
+    rows = [NetworkConnection(hostname=f"status-{i}", username="admin", device_type="cisco_ios") for i in range(2)]
+    db.add_all(rows)
+    db.commit()
+    ids = [row.id for row in rows]
+    db.close()
+    yield ids
+    db = SessionLocal()
+    db.query(NetworkConnection).filter(NetworkConnection.id.in_(ids)).delete()
+    db.commit()
+    db.close()
+
+
+def _is_connected(connection_id):
+    db = SessionLocal()
+    try:
+        return db.get(NetworkConnection, connection_id).is_connected
+    finally:
+        db.close()
+
+
+def test_flush_writes_queued_updates(connections):
+    writer = StatusWriter()
+    writer.queue(connections[0], is_connected=True)
+    writer.queue(connections[0], last_check=datetime.utcnow())
+    writer.queue(connections[1], is_connected=True)
+
+    assert writer.flush() == 2
+    assert writer.pending() == 0
+    assert _is_connected(connections[0]) and _is_connected(connections[1])
+
+
+def test_flush_skips_deleted_devices(connections):
+    writer = StatusWriter()
+    writer.queue(connections[0], is_connected=True)
+    writer.queue(connections[1], is_connected=True)
+
+    db = SessionLocal()
+    db.delete(db.get(NetworkConnection, connections[1]))
+    db.commit()
+    db.close()
+
+    assert writer.flush() == 1
+    assert writer.pending() == 0
+    assert _is_connected(connections[0])
+
+    # Later updates are not held back by the deleted device
+    writer.queue(connections[0], is_connected=False)
+    assert writer.flush() == 1
+    assert not _is_connected(connections[0])
+
+
+def test_discard_drops_pending_update(connections):
+    writer = StatusWriter()
+    writer.queue(connections[0], is_connected=True)
+    writer.discard(connections[0])
+
+    assert writer.pending() == 0
+    assert writer.flush() == 0
+
+
+def test_failed_writes_are_retried_then_dropped(connections, monkeypatch):
+    writer = StatusWriter(max_retries=2)
+    writer.queue(connections[0], is_connected=True)
+
+    def fail(self, *args, **kwargs):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr("sqlalchemy.orm.Session.execute", fail)
+
+    for _ in range(2):
+        assert writer.flush() == 0
+        assert writer.pending() == 1
+    assert writer.flush() == 0
+    assert writer.pending() == 0
@@ -0,0 +1,72 @@
+import pytest
+
+import timing
+from timing import TimingProfiles
+
+
+@pytest.fixture
+def profiles():
+    return TimingProfiles()
+
+
+def test_commands_learn_their_own_read_timeout(profiles):
+    for _ in range(timing.MIN_SAMPLES):
+        profiles.observe("edge-sw1", "cisco_ios", 0.05, "show clock")
+        profiles.observe("edge-sw1", "cisco_ios", 8.0, "show running-config")
+
+    assert profiles.settings("edge-sw1", "cisco_ios", "show clock")["read_timeout"] == timing.MIN_READ_TIMEOUT
+    assert profiles.settings("edge-sw1", "cisco_ios", "show running-config")["read_timeout"] > 16
+    # Commands never seen on the device wait the longest
+    assert profiles.settings("edge-sw1", "cisco_ios", "show tech-support")["read_timeout"] == timing.MAX_READ_TIMEOUT
+
+
+def test_read_timeout_stays_above_netmiko_default(profiles):
+    for _ in range(20):
+        profiles.observe("edge-sw1", "cisco_ios", 0.01, "show clock")
+    assert profiles.settings("edge-sw1", "cisco_ios", "show clock")["read_timeout"] >= 10
+
+
+def test_timeouts_back_off(profiles):
+    for _ in range(timing.MIN_SAMPLES):
+        profiles.observe("edge-sw1", "cisco_ios", 0.05, "show clock")
+    profiles.timed_out("edge-sw1", "cisco_ios", "show clock")
+    assert profiles.settings("edge-sw1", "cisco_ios", "show clock")["read_timeout"] == 2 * timing.MIN_READ_TIMEOUT
+
+
+def test_flush_drops_deleted_profiles(profiles):
+    from sqlalchemy import delete
+
+    from database import SessionLocal
+    from models import TimingProfile
+
+    profiles.observe("flush-sw1", "cisco_ios", 0.1, "show clock")
+    profiles.observe("flush-sw2", "cisco_ios", 0.1, "show clock")
+    assert profiles.flush() == 5
+
+    # Another node removed flush-sw2 while its update was queued here
+    profiles.observe("flush-sw1", "cisco_ios", 0.2, "show clock")
+    profiles.observe("flush-sw2", "cisco_ios", 0.2, "show clock")
+    db = SessionLocal()
+    profiles.delete_host(db, "flush-sw2")
+    db.commit()
+    db.close()
+    profiles.observe("flush-sw2", "cisco_ios", 0.2, "show clock")
+    db = SessionLocal()
+    db.execute(delete(TimingProfile).where(TimingProfile.name == "flush-sw1"))
+    db.commit()
+    db.close()
+
+    assert profiles.flush() == 4
+    # The deleted row is not retried, it is stored again with its next change
+    assert profiles.flush() == 0
+    profiles.observe("flush-sw1", "cisco_ios", 0.2, "show clock")
+    assert profiles.flush() == 3
+
+
+def test_discard_forgets_device_and_command_profiles(profiles):
+    profiles.observe("gone-sw1", "cisco_ios", 0.1, "show clock")
+    profiles.discard("gone-sw1")
+
+    assert profiles.describe("gone-sw1", None)["samples"] == 0
+    assert profiles.describe("gone-sw1", None)["commands"] == {}
+    assert profiles.flush() == 1  # Only the device_type profile is left
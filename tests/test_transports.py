@@ -0,0 +1,135 @@
+from netmiko import BaseConnection, NetMikoAuthenticationException
+from netmiko.exceptions import ReadTimeout
+import pytest
+
+import timing
+import transports
+from conftest import MOCK_HOST
+from timing import timing_profiles
+
+
+@pytest.fixture(autouse=True)
+def fresh_profile():
+    """
+    Forget what the tests taught the mock device's timing profile
+    """
+    yield
+    timing_profiles.discard(MOCK_HOST)
+
+
+@pytest.fixture(params=["netmiko", "asyncssh"])
+def backend(request, monkeypatch):
+    monkeypatch.setattr(transports, "TRANSPORT", request.param)
+    return transports.AsyncSSHSession if request.param == "asyncssh" else BaseConnection
+
+
+@pytest.fixture
+def cached_prompt(mock_device):
+    """
+    Let the mock device's profile earn the cached prompt strategy
+    """
+    for _ in range(timing.MIN_SAMPLES):
+        timing_profiles.observe(MOCK_HOST, "cisco_ios", 0.01)
+    assert timing_profiles.settings(MOCK_HOST, "cisco_ios")["prompt_strategy"] == "cached"
+
+
+@pytest.fixture
+def session(device_params):
+    session = transports.connect(device_params)
+    yield session
+    session.disconnect()
+
+
+def test_backend_runs_commands(backend, session):
+    assert isinstance(session.conn, backend)
+    assert session.find_prompt() == "mock-sw1>"
+
+    # Longer than a page of the mock device, so paging must have been disabled
+    output = session.send_command("show running-config")
+    assert output.count("interface GigabitEthernet") == 10
+    assert "--More--" not in output
+
+    session.enable()
+    assert session.find_prompt() == "mock-sw1#"
+    assert "uptime is" in session.send_command("show version")
+
+
+def test_unsupported_device_types_fall_back_to_netmiko(monkeypatch, device_params):
+    monkeypatch.setattr(transports, "TRANSPORT", "asyncssh")
+    assert not transports.asyncssh_supported("cisco_ios_ssh")
+
+    session = transports.connect(dict(device_params, device_type="cisco_ios_ssh"))
+    try:
+        assert isinstance(session.conn, BaseConnection)
+        assert "uptime is" in session.send_command("show version")
+    finally:
+        session.disconnect()
+
+
+def test_cached_prompt_is_looked_up_once(cached_prompt, session):
+    assert session.prompt is None
+    assert "uptime is" in session.send_command("show version")
+    assert session.prompt == "mock-sw1>"
+
+
+def test_enable_keeps_the_privileged_prompt(cached_prompt, session):
+    session.enable()
+
+    assert session.privileged
+    assert session.prompt == "mock-sw1#"
+    assert "uptime is" in session.send_command("show version")
+
+
+def test_cached_prompt_notices_dropped_privilege(cached_prompt, session):
+    session.enable()
+    session.send_command("show version")
+
+    # The device drops privilege behind the session's back, like a vty reset would
+    session.conn.send_command("disable", expect_string=r"mock-sw1>")
+
+    with pytest.raises(ReadTimeout):
+        session.send_command("show version", read_timeout=1)
+    assert not session.privileged
+    assert session.prompt == "mock-sw1>"
+
+    # enable() escalates again instead of trusting the stale state
+    session.enable()
+    assert session.privileged
+    assert session.conn.check_enable_mode()
+    assert "uptime is" in session.send_command("show version")
+
+
+@pytest.fixture
+def pinned_keys(monkeypatch):
+    """
+    Host keys pinned during the test only
+    """
+    keys = {}
+    monkeypatch.setattr(transports, "_host_keys", keys)
+    return keys
+
+
+def test_host_key_is_pinned_on_first_contact(backend, pinned_keys, device_params):
+    transports.connect(device_params).disconnect()
+    key = pinned_keys[(MOCK_HOST, device_params["port"])]
+    assert key.startswith("ssh-ed25519 ")
+
+    # The same key is accepted again
+    transports.connect(device_params).disconnect()
+    assert pinned_keys == {(MOCK_HOST, device_params["port"]): key}
+
+
+def test_changed_host_key_is_refused(backend, pinned_keys, device_params):
+    import asyncssh
+
+    other = asyncssh.generate_private_key("ssh-ed25519").export_public_key("openssh").decode()
+    pinned_keys[(MOCK_HOST, device_params["port"])] = " ".join(other.split()[:2])
+
+    with pytest.raises(NetMikoAuthenticationException, match="Host key of .* changed"):
+        transports.connect(device_params)
+
+
+def test_forgetting_a_host_drops_its_pinned_key(pinned_keys, device_params):
+    transports.connect(device_params).disconnect()
+    transports.forget_host(MOCK_HOST)
+    assert pinned_keys == {}
@@ -0,0 +1,424 @@
+from datetime import datetime
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+import atexit
+import logging
+import math
+import os
+import threading
+
+import metrics
+from database import SessionLocal, create_tables
+from models import TimingProfile
+from shards import cluster
+
+logger = logging.getLogger(__name__)
+
+# Samples before a device's own profile replaces the one of its device_type, and
+# before a command's read timeout is learned from its own latency
+MIN_SAMPLES = int(os.environ.get("TIMING_MIN_SAMPLES", "5"))
+# Read timeout as a multiple of the smoothed latency plus four deviations
+SAFETY_FACTOR = float(os.environ.get("TIMING_SAFETY_FACTOR", "3"))
+# Bounds of learned read timeouts; the upper one is used until anything is learned,
+# the lower one defaults to Netmiko's own read timeout
+MIN_READ_TIMEOUT = float(os.environ.get("TIMING_MIN_READ_TIMEOUT", "10"))
+MAX_READ_TIMEOUT = float(os.environ.get("TIMING_MAX_READ_TIMEOUT", "60"))
+# Devices answering within this many seconds use fast_cli, slower ones scale their delays
+FAST_LATENCY = float(os.environ.get("TIMING_FAST_LATENCY", "1"))
+MAX_DELAY_FACTOR = float(os.environ.get("TIMING_MAX_DELAY_FACTOR", "8"))
+# Read timeouts in a row before reading until the device goes quiet instead of waiting for the prompt
+PROMPT_FAILURES = int(os.environ.get("TIMING_PROMPT_FAILURES", "3"))
+# Seconds between writing changed profiles to the database
+FLUSH_INTERVAL = float(os.environ.get("TIMING_FLUSH_INTERVAL", "30"))
+
+# Prompt detection strategies: look the prompt up before every command, reuse
+# the prompt found when the session was prepared, or wait for the output to stop
+PROMPT_STRATEGIES = ("find", "cached", "timing")
+
+# Gains of the smoothed latency and deviation, as in TCP's retransmission timer
+_ALPHA = 0.125
+_BETA = 0.25
+# Per-command decay of the peak latency
+_PEAK_DECAY = 0.95
+# Successes in the timing strategy before prompt detection is tried again
+_RETRY_PROMPT_AFTER = 20
+
+_FIELDS = ("samples", "latency", "deviation", "peak", "timeouts", "prompt_strategy", "streak", "updated_at")
+
+
+def _command_name(hostname, command):
+    """
+    Name of the profile of a command on a device, commands are grouped by their first words
+    """
+    return f"{hostname} {metrics.command_label(command)}"
+
+
+class Profile:
+    """
+    Smoothed command latency of one device, device_type or command on a device
+    """
+
+    def __init__(self, scope, name):
+        self.scope = scope
+        self.name = name
+        self.samples = 0
+        self.latency = None
+        self.deviation = None
+        self.peak = None
+        self.timeouts = 0
+        self.prompt_strategy = "find"
+        self.streak = 0
+        self.updated_at = None
+        self.persisted = False
+
+    @classmethod
+    def from_row(cls, row):
+        profile = cls(row.scope, row.name)
+        for field in _FIELDS:
+            setattr(profile, field, getattr(row, field))
+        profile.prompt_strategy = profile.prompt_strategy or "find"
+        profile.persisted = True
+        return profile
+
+    def to_row(self):
+        row = {"scope": self.scope, "name": self.name}
+        row.update((field, getattr(self, field)) for field in _FIELDS)
+        return row
+
+    def observe(self, seconds):
+        """
+        Account for a command that completed after this many seconds
+        """
+        if self.samples == 0:
+            self.latency = seconds
+            self.deviation = seconds / 2
+        else:
+            self.deviation += _BETA * (abs(self.latency - seconds) - self.deviation)
+            self.latency += _ALPHA * (seconds - self.latency)
+        self.peak = max(seconds, (self.peak or 0) * _PEAK_DECAY)
+        self.samples += 1
+        self.timeouts = 0
+        self.streak += 1
+        self.updated_at = datetime.utcnow()
+
+        # Prompt detection is chosen per device, the other profiles only carry latency
+        if self.scope != "device":
+            return
+        # The prompt proved stable, stop looking it up before every command
+        if self.prompt_strategy == "find" and self.streak >= MIN_SAMPLES:
+            self._switch("cached")
+        elif self.prompt_strategy == "timing" and self.streak >= _RETRY_PROMPT_AFTER:
+            self._switch("find")
+
+    def timed_out(self):
+        """
+        Account for a command whose prompt did not come back in time
+        """
+        self.timeouts += 1
+        self.streak = 0
+        self.updated_at = datetime.utcnow()
+
+        if self.scope != "device":
+            return
+        if self.prompt_strategy == "cached":
+            # The prompt may have changed, look it up again
+            self._switch("find")
+        elif self.prompt_strategy == "find" and self.timeouts >= PROMPT_FAILURES:
+            self._switch("timing")
+
+    def _switch(self, strategy):
+        logger.info(f"Prompt detection for {self.name} switched from {self.prompt_strategy} to {strategy}")
+        self.prompt_strategy = strategy
+        self.streak = 0
+
+    def read_timeout(self):
+        """
+        Seconds to wait for a command, doubled for every timeout in a row
+        """
+        if self.samples == 0:
+            timeout = MAX_READ_TIMEOUT
+        else:
+            timeout = max(SAFETY_FACTOR * (self.latency + 4 * self.deviation), 2 * self.peak)
+        timeout = max(MIN_READ_TIMEOUT, timeout) * 2 ** min(self.timeouts, 4)
+        return round(min(MAX_READ_TIMEOUT, timeout), 2)
+
+    def connect_params(self):
+        """
+        Netmiko parameters for new sessions, fast_cli unless the device is slow
+        """
+        if self.samples == 0 or self.latency <= FAST_LATENCY:
+            return {"fast_cli": True, "global_delay_factor": 1}
+        factor = min(MAX_DELAY_FACTOR, math.ceil(self.latency / FAST_LATENCY))
+        return {"fast_cli": False, "global_delay_factor": factor}
+
+
+class TimingProfiles:
+    """
+    Per-device, per-device_type and per-command response time profiles
+    learned from observed command latencies.
+
+    Device profiles tune prompt detection and, like device_type profiles,
+    the delay settings of new sessions; a device without enough samples of
+    its own uses the profile of its device_type. Read timeouts are learned
+    per command on each device, so fast commands do not cut short the slow
+    ones, and stay at MAX_READ_TIMEOUT until a command has MIN_SAMPLES.
+    Changed profiles are written to the database in batches by a
+    background thread.
+    """
+
+    def __init__(self):
+        self._profiles = {}  # (scope, name) -> Profile
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Load stored profiles and start writing changes in a background thread
+        """
+        if self._thread is None:
+            try:
+                create_tables([TimingProfile.__table__])
+                self.load()
+            except Exception as e:
+                logger.error(f"Error loading timing profiles: {str(e)}")
+            # Pick up the latest profiles of devices taken over from another node
+            cluster.add_listener(self.load)
+            self._thread = threading.Thread(target=self._run, name="timing-profiles", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def load(self):
+        """
+        Read stored profiles, keeping changes not written yet
+        """
+        db = SessionLocal()
+        try:
+            rows = db.scalars(select(TimingProfile)).all()
+        finally:
+            db.close()
+
+        with self._lock:
+            for row in rows:
+                key = (row.scope, row.name)
+                if key not in self._dirty:
+                    self._profiles[key] = Profile.from_row(row)
+
+    def _get(self, scope, name, create=False):
+        profile = self._profiles.get((scope, name))
+        if profile is None and create:
+            profile = self._profiles.setdefault((scope, name), Profile(scope, name))
+        return profile
+
+    def _effective(self, hostname, device_type):
+        """
+        :return: (source, profile) used for timeouts and session parameters
+        """
+        device = self._get("device", hostname)
+        if device is not None and device.samples >= MIN_SAMPLES:
+            return "device", device
+        kind = self._get("device_type", device_type) if device_type else None
+        if kind is not None and kind.samples:
+            return "device_type", kind
+        if device is not None and device.samples:
+            return "device", device
+        return "default", Profile("default", "")
+
+    def _command(self, hostname, command):
+        """
+        :return: Profile the read timeout of a command on a device is taken from
+        """
+        profile = self._get("command", _command_name(hostname, command)) if command else None
+        if profile is None or profile.samples < MIN_SAMPLES:
+            return Profile("default", "")
+        return profile
+
+    def settings(self, hostname, device_type, command=None):
+        """
+        :param command: Command about to be sent, its own latency decides the read timeout
+        :return: Dictionary with read_timeout and prompt_strategy for the next command
+        """
+        with self._lock:
+            device = self._get("device", hostname)
+            return {
+                "read_timeout": self._command(hostname, command).read_timeout(),
+                # Prompt behavior belongs to the session of the device itself
+                "prompt_strategy": device.prompt_strategy if device else "find"
+            }
+
+    def connect_params(self, hostname, device_type):
+        with self._lock:
+            return self._effective(hostname, device_type)[1].connect_params()
+
+    def observe(self, hostname, device_type, seconds, command=None):
+        self._update(hostname, device_type, command, lambda profile: profile.observe(seconds))
+
+    def timed_out(self, hostname, device_type, command=None):
+        self._update(hostname, device_type, command, lambda profile: profile.timed_out())
+        metrics.READ_TIMEOUTS.inc()
+
+    def _update(self, hostname, device_type, command, change):
+        with self._lock:
+            keys = [("device", hostname)]
+            if device_type:
+                keys.append(("device_type", device_type))
+            if command:
+                keys.append(("command", _command_name(hostname, command)))
+            for scope, name in keys:
+                change(self._get(scope, name, create=True))
+                self._dirty.add((scope, name))
+
+    def describe(self, hostname, device_type):
+        """
+        Describe the learned profile of a device and the settings derived from it
+        """
+        with self._lock:
+            source, profile = self._effective(hostname, device_type)
+            device = self._get("device", hostname) or Profile("device", hostname)
+            prefix = f"{hostname} "
+            info = {
+                "source": source,
+                "samples": device.samples,
+                "latency": device.latency,
+                "deviation": device.deviation,
+                "peak": device.peak,
+                "timeouts": device.timeouts,
+                "read_timeout": Profile("default", "").read_timeout(),
+                "commands": {
+                    name[len(prefix):]: command.read_timeout()
+                    for (scope, name), command in self._profiles.items()
+                    if scope == "command" and name.startswith(prefix) and command.samples >= MIN_SAMPLES
+                },
+                "prompt_strategy": device.prompt_strategy,
+                "updated_at": device.updated_at
+            }
+            info.update(profile.connect_params())
+            return info
+
+    def discard(self, hostname):
+        """
+        Forget the profiles of a removed device, including changes not written yet
+        """
+        prefix = f"{hostname} "
+        with self._lock:
+            keys = [("device", hostname)] + [
+                key for key in self._profiles if key[0] == "command" and key[1].startswith(prefix)
+            ]
+            for key in keys:
+                self._profiles.pop(key, None)
+                self._dirty.discard(key)
+
+    def delete_host(self, db, hostname):
+        """
+        Drop the profiles of a removed device
+
+        :param db: Database session, committed by the caller
+        """
+        self.discard(hostname)
+        prefix = f"{hostname} "
+        db.execute(delete(TimingProfile).where(TimingProfile.scope == "device", TimingProfile.name == hostname))
+        db.execute(delete(TimingProfile).where(
+            TimingProfile.scope == "command", TimingProfile.name.startswith(prefix, autoescape=True)
+        ))
+
+    def flush(self):
+        """
+        Write changed profiles in a single transaction
+
+        :return: Number of profiles written
+        """
+        with self._lock:
+            profiles = [self._profiles[key] for key in self._dirty if key in self._profiles]
+            self._dirty = set()
+            new = [profile.to_row() for profile in profiles if not profile.persisted]
+            changed = [profile.to_row() for profile in profiles if profile.persisted]
+        if not profiles:
+            return 0
+
+        missing = set()
+        db = SessionLocal()
+        try:
+            try:
+                self._write(db, new, changed)
+            except StaleDataError:
+                # Rows deleted since they were loaded, e.g. of a removed device, are dropped
+                db.rollback()
+                missing = self._missing(db, changed)
+                self._write(db, new, [row for row in changed if (row["scope"], row["name"]) not in missing])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            with self._lock:
+                self._dirty.update((profile.scope, profile.name) for profile in profiles)
+            logger.error(f"Error writing {len(profiles)} timing profiles: {str(e)}")
+            return 0
+        finally:
+            db.close()
+
+        if missing:
+            logger.info(f"Dropped {len(missing)} timing profiles deleted from the database")
+        for profile in profiles:
+            # A dropped profile still in use is stored again with its next change
+            profile.persisted = (profile.scope, profile.name) not in missing
+        return len(profiles) - len(missing)
+
+    def _write(self, db, new, changed):
+        if changed:
+            db.execute(update(TimingProfile), changed)
+        if new:
+            try:
+                with db.begin_nested():
+                    db.execute(insert(TimingProfile), new)
+            except IntegrityError:
+                # Another node stored one of the device_types first, overwrite those
+                for row in new:
+                    try:
+                        with db.begin_nested():
+                            db.execute(insert(TimingProfile), [row])
+                    except IntegrityError:
+                        db.execute(update(TimingProfile), [row])
+
+    def _missing(self, db, rows):
+        """
+        :return: Set of (scope, name) of the rows no longer in the database
+        """
+        names = [row["name"] for row in rows]
+        stored = set(db.execute(select(TimingProfile.scope, TimingProfile.name).where(TimingProfile.name.in_(names))))
+        return {(row["scope"], row["name"]) for row in rows} - {tuple(key) for key in stored}
+
+    def _run(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error in timing profiles: {str(e)}")
+
+    def collect_metrics(self):
+        """
+        Export how many devices use each prompt detection strategy at scrape time
+        """
+        counts = dict.fromkeys(PROMPT_STRATEGIES, 0)
+        with self._lock:
+            for (scope, _), profile in self._profiles.items():
+                if scope == "device":
+                    counts[profile.prompt_strategy] += 1
+        yield (
+            'ssh_prompt_strategy_devices',
+            'Devices by prompt detection strategy',
+            'gauge',
+            [({'strategy': strategy}, count) for strategy, count in counts.items()]
+        )
+
+
+# Global timing profiles, shared by every session
+timing_profiles = TimingProfiles()
+timing_profiles.start()
+metrics.register_collector(timing_profiles.collect_metrics)
+atexit.register(timing_profiles.stop)
@@ -0,0 +1,787 @@
+from netmiko import ConnectHandler, NetMikoTimeoutException, NetMikoAuthenticationException
+from netmiko.channel import SSHChannel
+from netmiko.exceptions import ReadTimeout
+import abc
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    import asyncssh
+except ImportError:  # Optional backend, Netmiko is used without it
+    asyncssh = None
+
+import metrics
+from resolver import resolver
+from timing import timing_profiles
+
+logger = logging.getLogger(__name__)
+
+# "netmiko" or "asyncssh"; asyncssh falls back to Netmiko for unsupported device types
+TRANSPORT = os.environ.get("SSH_TRANSPORT", "netmiko")
+# Seconds between SSH keepalives on asyncio sessions, 0 disables them
+KEEPALIVE_INTERVAL = float(os.environ.get("SSH_KEEPALIVE_INTERVAL", "30"))
+# Terminal width requested for asyncio sessions
+TERMINAL_WIDTH = 511
+# Open additional sessions to a device as shell channels over its existing,
+# authenticated transport instead of a new SSH handshake
+MULTIPLEX_CHANNELS = os.environ.get("SSH_CHANNEL_MULTIPLEXING", "false").lower() in ("1", "true", "yes")
+# Remember the first host key seen per device and refuse connections presenting another
+PIN_HOST_KEYS = os.environ.get("SSH_PIN_HOST_KEYS", "true").lower() in ("1", "true", "yes")
+
+# Commands disabling paging per device type; only these types use the asyncio backend
+DISABLE_PAGING = {
+    'cisco_ios': 'terminal length 0',
+    'cisco_xe': 'terminal length 0',
+    'cisco_xr': 'terminal length 0',
+    'cisco_nxos': 'terminal length 0',
+    'arista_eos': 'terminal length 0',
+    'juniper_junos': 'set cli screen-length 0',
+}
+
+# Commands widening the terminal per device type
+SET_WIDTH = {
+    'cisco_ios': f'terminal width {TERMINAL_WIDTH}',
+    'cisco_xe': f'terminal width {TERMINAL_WIDTH}',
+    'cisco_xr': f'terminal width {TERMINAL_WIDTH}',
+    'arista_eos': f'terminal width {TERMINAL_WIDTH}',
+    'juniper_junos': f'set cli screen-width {TERMINAL_WIDTH}',
+}
+
+# send_command arguments send_command_timing accepts as well
+_TIMING_KWARGS = ('read_timeout', 'strip_prompt', 'strip_command', 'normalize')
+
+_PROMPT_END = re.compile(r"[>#$%]\s*$")
+_PAGER = re.compile(r"\s*-+\s*more\s*-+\s*$", re.IGNORECASE)
+
+
+# Host keys seen per (hostname, port), in OpenSSH "type base64" form
+_host_keys = {}
+# Transports channels can be multiplexed over, per (hostname, port, username)
+_transports = {}
+_registry_lock = threading.Lock()
+
+
+def connect(device):
+    """
+    Open an SSH session with the configured transport backend.
+
+    The hostname is resolved through the DNS cache, and with channel
+    multiplexing enabled a live transport to the same device is reused.
+
+    :param device: Netmiko style connection parameters
+    :return: DeviceSession exposing the Netmiko methods used by the manager
+    """
+    hostname = device['host']
+    key = (hostname, device.get('port', 22), device.get('username'))
+    start = time.perf_counter()
+
+    # fast_cli and delay factor learned from the device's response times
+    device = dict(device, **timing_profiles.connect_params(hostname, device.get('device_type')))
+
+    if MULTIPLEX_CHANNELS:
+        session = _open_multiplexed(key, device)
+        if session is not None:
+            metrics.SESSION_OPEN_SECONDS.labels("multiplexed").observe(time.perf_counter() - start)
+            return session
+
+    address = resolver.resolve(hostname)
+    if address is None:
+        metrics.CONNECT_TOTAL.labels("failure").inc()
+        raise NetMikoTimeoutException(f"DNS failure--the hostname was not resolvable: {hostname}")
+    # Connect to the cached address, the session keeps reporting the hostname
+    params = dict(device, host=address)
+    pinned = _host_keys.get(key[:2]) if PIN_HOST_KEYS else None
+
+    try:
+        if TRANSPORT == "asyncssh" and asyncssh_supported(device.get('device_type')):
+            conn = AsyncSSHSession.connect(params, host_key=pinned)
+            transport = _AsyncSSHTransport(conn)
+        else:
+            conn = ConnectHandler(**params)
+            transport = _NetmikoTransport(conn, params)
+        _check_host_key(key[:2], transport, conn)
+    except Exception:
+        metrics.CONNECT_TOTAL.labels("failure").inc()
+        raise
+
+    elapsed = time.perf_counter() - start
+    metrics.CONNECT_SECONDS.labels(device.get('device_type')).observe(elapsed)
+    metrics.SESSION_OPEN_SECONDS.labels("new").observe(elapsed)
+    metrics.CONNECT_TOTAL.labels("success").inc()
+
+    if not MULTIPLEX_CHANNELS:
+        return DeviceSession(conn, hostname)
+
+    with _registry_lock:
+        _transports[key] = transport
+    return DeviceSession(conn, hostname, transport)
+
+
+def _open_multiplexed(key, device):
+    """
+    Open a shell channel over a live transport to the device
+
+    :return: DeviceSession or None if there is no usable transport
+    """
+    with _registry_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            return None
+        if not transport.is_active() or not transport.acquire():
+            _transports.pop(key, None)
+            return None
+
+    try:
+        conn = transport.open_channel()
+    except Exception as e:
+        # Fall back to a new transport, this one may be going away
+        logger.warning(f"Could not open a channel to {key[0]} over the existing transport: {str(e)}")
+        transport.release()
+        with _registry_lock:
+            if _transports.get(key) is transport:
+                del _transports[key]
+        return None
+
+    return DeviceSession(conn, key[0], transport)
+
+
+def _check_host_key(key, transport, conn):
+    """
+    Pin the host key of a device on first contact and refuse a different one later
+    """
+    if not PIN_HOST_KEYS:
+        return
+
+    host_key = transport.host_key()
+    if host_key is None:
+        return
+
+    with _registry_lock:
+        pinned = _host_keys.setdefault(key, host_key)
+    if pinned != host_key:
+        metrics.HOST_KEY_MISMATCHES.inc()
+        transport.close()
+        raise NetMikoAuthenticationException(
+            f"Host key of {key[0]} changed since the first connection, refusing to connect"
+        )
+
+
+def forget_host(hostname):
+    """
+    Drop the pinned host key and cached address of a removed device
+    """
+    with _registry_lock:
+        for key in [key for key in _host_keys if key[0] == hostname]:
+            del _host_keys[key]
+        for key in [key for key in _transports if key[0] == hostname]:
+            del _transports[key]
+    resolver.forget(hostname)
+
+
+class DeviceSession:
+    """
+    Backend session wrapped with latency and output size instrumentation.
+
+    The session also remembers its CLI state: whether it is privileged,
+    whether paging and width are set up, and the last prompt seen. Enable
+    mode is entered once per session instead of before every command; a
+    changed prompt means the state is checked again. A reconnect starts a
+    new session with fresh state.
+
+    Everything not overridden here is passed through to the backend.
+    """
+
+    def __init__(self, conn, hostname, transport=None):
+        """
+        :param conn: Netmiko or asyncio backend session
+        :param hostname: Device hostname, used for labels
+        :param transport: Shared transport the session's channel runs over, if multiplexed
+        """
+        self.conn = conn
+        self.hostname = hostname
+        self.transport = transport
+        self._device_seconds = metrics.DEVICE_COMMAND_SECONDS.labels(hostname)
+
+        # Set by enable() and dropped when the prompt changes
+        self.privileged = False
+        # Paging and width are set up while the backend prepares the session
+        self.terminal_ready = True
+        # Last prompt seen, None until a command or probe looked it up
+        self.prompt = None
+        self._wants_privilege = False
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def find_prompt(self, *args, **kwargs):
+        prompt = self.conn.find_prompt(*args, **kwargs)
+        self._note_prompt(prompt)
+        return prompt
+
+    def _note_prompt(self, prompt):
+        """
+        Remember the prompt, forgetting the session state if it changed
+        """
+        prompt = prompt.strip()
+        if self.prompt is not None and prompt != self.prompt:
+            logger.info(f"Prompt of {self.hostname} changed from {self.prompt!r} to {prompt!r}")
+            metrics.PROMPT_CHANGES.inc()
+            self.privileged = False
+            self.terminal_ready = False
+        self.prompt = prompt
+
+    def _restore_state(self):
+        """
+        Set the terminal up and re-enter enable mode after the prompt changed
+
+        :return: True if anything was sent to the device
+        """
+        restored = False
+        if not self.terminal_ready:
+            device_type = getattr(self.conn, 'device_type', None)
+            for command in (DISABLE_PAGING.get(device_type), SET_WIDTH.get(device_type)):
+                if command:
+                    self.conn.send_command(command)
+                    restored = True
+            self.terminal_ready = True
+        if self._wants_privilege and not self.privileged:
+            self.enable()
+            restored = True
+        return restored
+
+    def send_command(self, command_string, *args, **kwargs):
+        """
+        Send a command with the read timeout learned for it and the prompt detection learned for the device
+        """
+        label = metrics.command_label(command_string)
+        device_type = getattr(self.conn, 'device_type', None)
+        settings = timing_profiles.settings(self.hostname, device_type, command_string)
+        if kwargs.get('read_timeout') is None:
+            kwargs['read_timeout'] = settings['read_timeout']
+
+        start = time.perf_counter()
+        send = self.conn.send_command
+        cached_prompt = False
+        # The asyncio backend always matches the prompt found when the session was prepared
+        if not isinstance(self.conn, AsyncSSHSession) and not args and kwargs.get('expect_string') is None:
+            if settings['prompt_strategy'] == 'find':
+                # Look the prompt up here instead of in Netmiko to notice when it changed
+                prompt = self.find_prompt()
+                if self._restore_state():
+                    prompt = self.find_prompt()
+                kwargs['expect_string'] = re.escape(prompt)
+            elif settings['prompt_strategy'] == 'cached':
+                if self.prompt is None:
+                    self.find_prompt()
+                # The whole prompt, so a device that dropped privilege times out instead of matching
+                kwargs['expect_string'] = re.escape(self.prompt)
+                cached_prompt = True
+            elif settings['prompt_strategy'] == 'timing':
+                send = self.conn.send_command_timing
+                kwargs = {name: value for name, value in kwargs.items() if name in _TIMING_KWARGS}
+        metrics.PROMPT_STRATEGY_COMMANDS.labels(settings['prompt_strategy']).inc()
+
+        try:
+            output = send(command_string, *args, **kwargs)
+        except (ReadTimeout, NetMikoTimeoutException):
+            metrics.COMMAND_ERRORS.labels(label).inc()
+            timing_profiles.timed_out(self.hostname, device_type, command_string)
+            if cached_prompt:
+                self._recheck_prompt()
+            raise
+        except Exception:
+            metrics.COMMAND_ERRORS.labels(label).inc()
+            raise
+        elapsed = time.perf_counter() - start
+        timing_profiles.observe(self.hostname, device_type, elapsed, command_string)
+
+        metrics.COMMAND_SECONDS.labels(label).observe(elapsed)
+        self._device_seconds.observe(elapsed)
+        if isinstance(output, str):
+            metrics.OUTPUT_BYTES.labels(label).inc(len(output))
+            metrics.OUTPUT_SIZE.observe(len(output))
+        return output
+
+    def enable(self, *args, **kwargs):
+        """
+        Enter enable mode unless this session already did and its prompt has not changed since
+        """
+        self._wants_privilege = True
+        if self.privileged and not args and not kwargs:
+            # Saves the prompt check, and possibly the password exchange, Netmiko does every time
+            metrics.ENABLE_SECONDS.labels("reused").observe(0)
+            return ""
+
+        with metrics.ENABLE_SECONDS.labels("escalated").time():
+            output = self.conn.enable(*args, **kwargs)
+        self.privileged = True
+        # Escalating changes the prompt, remember the new one for later comparisons
+        self.prompt = None
+        self.find_prompt()
+        return output
+
+    def _recheck_prompt(self):
+        """
+        Look the prompt up after the cached one did not come back, it may have changed
+        """
+        try:
+            self.find_prompt()
+        except Exception as e:
+            logger.warning(f"Could not read the prompt of {self.hostname} after a timeout: {str(e)}")
+
+    def disconnect(self):
+        if self.transport is None:
+            return self.conn.disconnect()
+        # Only close this channel, the transport goes with its last channel
+        self.transport.close_channel(self.conn)
+        self.transport.release()
+
+
+class _SharedTransport(abc.ABC):
+    """
+    Authenticated SSH transport shared by several shell channels.
+
+    Counts the channels open over it and closes it together with the last one.
+    Backends implement the abstract methods.
+    """
+
+    def __init__(self):
+        self._channels = 1
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Count a new channel, fails once the transport has been closed
+        """
+        with self._lock:
+            if self._channels == 0:
+                return False
+            self._channels += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._channels -= 1
+            last = self._channels == 0
+        if last:
+            self.close()
+
+    @abc.abstractmethod
+    def is_active(self):
+        """
+        Whether the transport is still connected
+        """
+
+    @abc.abstractmethod
+    def open_channel(self):
+        """
+        Open a new shell channel and return it as a prepared session
+        """
+
+    @abc.abstractmethod
+    def close_channel(self, conn):
+        """
+        Close one shell channel, leaving the transport open
+        """
+
+    @abc.abstractmethod
+    def host_key(self):
+        """
+        Host key the device presented, used for pinning
+        """
+
+    @abc.abstractmethod
+    def close(self):
+        """
+        Close the transport together with every channel still open over it
+        """
+
+
+class _NetmikoTransport(_SharedTransport):
+    """
+    Paramiko transport of a Netmiko session
+    """
+
+    def __init__(self, conn, params):
+        super().__init__()
+        self.client = conn.remote_conn_pre
+        self.params = params
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def open_channel(self):
+        # Prepare a Netmiko session by hand, on a new channel of the existing client
+        conn = ConnectHandler(**self.params, auto_connect=False)
+        conn._modify_connection_params()
+        conn.remote_conn_pre = self.client
+        conn.remote_conn = self.client.invoke_shell(term="vt100", width=TERMINAL_WIDTH, height=1000)
+        conn.remote_conn.settimeout(conn.blocking_timeout)
+        conn.channel = SSHChannel(conn=conn.remote_conn, encoding=conn.encoding)
+        try:
+            conn.special_login_handler()
+            conn._try_session_preparation()
+        except Exception:
+            conn.remote_conn.close()
+            raise
+        return conn
+
+    def close_channel(self, conn):
+        try:
+            conn.cleanup()
+        except Exception:
+            pass
+        try:
+            conn.remote_conn.close()
+        except Exception as e:
+            logger.debug(f"Error closing channel to {conn.host}: {str(e)}")
+
+    def host_key(self):
+        transport = self.client.get_transport()
+        if transport is None:
+            return None
+        key = transport.get_remote_server_key()
+        return f"{key.get_name()} {key.get_base64()}"
+
+    def close(self):
+        self.client.close()
+
+
+def asyncssh_supported(device_type):
+    """
+    Check whether a device type can be driven by the asyncio backend
+    """
+    return asyncssh is not None and device_type in DISABLE_PAGING
+
+
+class _EventLoopThread:
+    """
+    Event loop running in a daemon thread, shared by all asyncio sessions
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="ssh-event-loop", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the loop and wait for its result from a regular thread
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+
+class AsyncSSHSession:
+    """
+    Interactive CLI session driven by asyncssh on the shared event loop.
+
+    Blocking methods mirror the Netmiko API so pools and endpoints can use
+    either backend; the *_async coroutines can be awaited directly from
+    code already running on the loop.
+    """
+
+    def __init__(self, device, host_key=None):
+        self.device = device
+        self.host_key = host_key
+        self.device_type = device['device_type']
+        self.host = device['host']
+        self.port = device.get('port', 22)
+        self.username = device.get('username')
+        self.password = device.get('password')
+        self.secret = device.get('secret') or self.password
+        self.conn_timeout = device.get('conn_timeout', 10)
+        self.base_prompt = ""
+
+        self._conn = None
+        self._process = None
+        self._buffer = ""
+        self._data = None
+        self._reader = None
+        self._closed = False
+
+    @classmethod
+    def connect(cls, device, host_key=None):
+        """
+        Connect and prepare a session from a regular thread
+
+        :param device: Netmiko style connection parameters
+        :param host_key: Only accept this OpenSSH public key from the device
+        """
+        session = cls(device, host_key)
+        loop = _EventLoopThread.get()
+        loop.run(session.connect_async())
+        return session
+
+    def open_channel(self):
+        """
+        Open another prepared shell over this session's connection, skipping the handshake
+        """
+        session = AsyncSSHSession(self.device, self.host_key)
+        session._conn = self._conn
+        _EventLoopThread.get().run(session.open_shell_async())
+        return session
+
+    async def connect_async(self):
+        """
+        Open the SSH connection and an interactive shell, then prepare the terminal
+        """
+        # Trust only the pinned key once the device has been seen
+        known_hosts = None
+        if self.host_key:
+            known_hosts = ([asyncssh.import_public_key(self.host_key)], [], [])
+
+        try:
+            self._conn = await asyncio.wait_for(
+                asyncssh.connect(
+                    self.host,
+                    port=self.port,
+                    username=self.username,
+                    password=self.password,
+                    known_hosts=known_hosts,
+                    client_keys=None,
+                    agent_path=None,
+                    keepalive_interval=KEEPALIVE_INTERVAL or None
+                ),
+                self.conn_timeout
+            )
+        except asyncssh.PermissionDenied as e:
+            raise NetMikoAuthenticationException(f"Authentication to device failed: {self.host}") from e
+        except asyncssh.HostKeyNotVerifiable as e:
+            metrics.HOST_KEY_MISMATCHES.inc()
+            raise NetMikoAuthenticationException(
+                f"Host key of {self.host} changed since the first connection, refusing to connect"
+            ) from e
+        except (asyncio.TimeoutError, OSError, asyncssh.Error) as e:
+            raise NetMikoTimeoutException(f"TCP connection to device failed: {self.host}: {str(e)}") from e
+
+        await self.open_shell_async()
+
+    async def open_shell_async(self):
+        """
+        Start an interactive shell on the connection and prepare the terminal
+        """
+        self._closed = False
+        self._process = await self._conn.create_process(
+            term_type="vt100",
+            term_size=(TERMINAL_WIDTH, 24),
+            encoding="utf-8",
+            errors="replace"
+        )
+        self._data = asyncio.Event()
+        self._reader = asyncio.get_running_loop().create_task(self._read_forever())
+
+        await self.set_base_prompt_async()
+        await self._send_command_async(DISABLE_PAGING[self.device_type], read_timeout=self.conn_timeout)
+        if self.device_type in SET_WIDTH:
+            await self._send_command_async(SET_WIDTH[self.device_type], read_timeout=self.conn_timeout)
+
+    async def _read_forever(self):
+        """
+        Move everything the device sends into the session buffer
+        """
+        try:
+            while True:
+                data = await self._process.stdout.read(65536)
+                if not data:
+                    break
+                self._buffer += data.replace("\r\n", "\n").replace("\r", "")
+                self._data.set()
+        finally:
+            self._closed = True
+            self._data.set()
+
+    async def _read_until(self, pattern, read_timeout):
+        """
+        Wait until the buffer ends with pattern and return everything read so far
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + read_timeout
+
+        while True:
+            # Answer pagers in case paging could not be disabled
+            if _PAGER.search(self._buffer):
+                self._buffer = _PAGER.sub("", self._buffer)
+                self._process.stdin.write(" ")
+
+            if pattern.search(self._buffer):
+                output, self._buffer = self._buffer, ""
+                return output
+            if self._closed:
+                raise NetMikoTimeoutException(f"Connection to {self.host} closed")
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                # Like Netmiko, the device is still there but did not answer in time
+                raise ReadTimeout(
+                    f"Pattern not detected: {pattern.pattern!r} in output from {self.host}"
+                )
+            self._data.clear()
+            try:
+                await asyncio.wait_for(self._data.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def _prompt_pattern(self):
+        return re.compile(re.escape(self.base_prompt) + r"[^\n]*[>#$%]\s*$")
+
+    async def find_prompt_async(self, read_timeout=10):
+        """
+        Send an empty line and return the prompt the device answers with
+        """
+        self._buffer = ""
+        self._process.stdin.write("\n")
+        output = await self._read_until(_PROMPT_END, read_timeout)
+        return output.strip().splitlines()[-1].strip()
+
+    async def set_base_prompt_async(self):
+        prompt = await self.find_prompt_async(self.conn_timeout)
+        self.base_prompt = prompt[:-1]
+        return self.base_prompt
+
+    async def _send_command_async(self, command_string, expect_string=None, read_timeout=10.0,
+                                  strip_prompt=True, strip_command=True):
+        self._buffer = ""
+        self._process.stdin.write(command_string.rstrip("\n") + "\n")
+
+        pattern = re.compile(expect_string) if expect_string else self._prompt_pattern()
+        output = await self._read_until(pattern, read_timeout)
+
+        lines = output.split("\n")
+        if strip_command and lines and command_string.strip() in lines[0]:
+            lines = lines[1:]
+        if strip_prompt and lines and pattern.search(lines[-1]):
+            lines = lines[:-1]
+        return "\n".join(lines)
+
+    async def send_command_async(self, command_string, expect_string=None, read_timeout=10.0,
+                                 strip_prompt=True, strip_command=True, **kwargs):
+        """
+        Send a command and return its output once the prompt comes back
+        """
+        return await self._send_command_async(command_string, expect_string, read_timeout,
+                                              strip_prompt, strip_command)
+
+    async def enable_async(self):
+        """
+        Enter privileged mode unless the session already is in it
+        """
+        prompt = await self.find_prompt_async()
+        if prompt.endswith("#"):
+            return ""
+
+        self._buffer = ""
+        self._process.stdin.write("enable\n")
+        output = await self._read_until(re.compile(r"(assword:?|[>#])\s*$"), self.conn_timeout)
+        if "assword" in output.splitlines()[-1]:
+            self._process.stdin.write(f"{self.secret or ''}\n")
+            output += await self._read_until(_PROMPT_END, self.conn_timeout)
+
+        if not (await self.find_prompt_async()).endswith("#"):
+            raise ValueError("Failed to enter enable mode. Please ensure you pass the 'secret' argument to ConnectHandler.")
+        return output
+
+    async def close_channel_async(self):
+        if self._process and not self._closed:
+            self._process.stdin.write("exit\n")
+            self._process.close()
+        self._closed = True
+
+    async def disconnect_async(self):
+        await self.close_channel_async()
+        if self._conn:
+            self._conn.close()
+            await self._conn.wait_closed()
+
+    # Blocking Netmiko-compatible API
+
+    def send_command(self, command_string, expect_string=None, read_timeout=10.0,
+                     strip_prompt=True, strip_command=True, **kwargs):
+        return _EventLoopThread.get().run(self.send_command_async(
+            command_string, expect_string, read_timeout, strip_prompt, strip_command
+        ))
+
+    def enable(self, *args, **kwargs):
+        return _EventLoopThread.get().run(self.enable_async())
+
+    def check_enable_mode(self, *args, **kwargs):
+        return self.find_prompt().endswith("#")
+
+    def find_prompt(self, *args, **kwargs):
+        return _EventLoopThread.get().run(self.find_prompt_async())
+
+    def is_alive(self):
+        return self._conn is not None and not self._closed
+
+    def disconnect(self):
+        try:
+            _EventLoopThread.get().run(self.disconnect_async(), timeout=self.conn_timeout)
+        except Exception as e:
+            logger.debug(f"Error closing session to {self.host}: {str(e)}")
+
+    def close_channel(self):
+        try:
+            _EventLoopThread.get().run(self.close_channel_async(), timeout=self.conn_timeout)
+        except Exception as e:
+            logger.debug(f"Error closing channel to {self.host}: {str(e)}")
+
+    # Raw channel access, used to stream output line by line
+
+    def normalize_cmd(self, command):
+        return command.rstrip("\n") + "\n"
+
+    def write_channel(self, data):
+        _EventLoopThread.get().loop.call_soon_threadsafe(self._process.stdin.write, data)
+
+    def read_channel(self):
+        async def drain():
+            data, self._buffer = self._buffer, ""
+            return data
+        return _EventLoopThread.get().run(drain())
+
+    def clear_buffer(self, *args, **kwargs):
+        return self.read_channel()
+
+
+class _AsyncSSHTransport(_SharedTransport):
+    """
+    asyncssh connection of an asyncio session
+    """
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    def is_active(self):
+        # The connection is gone once its transport has been closed
+        conn = self.session._conn
+        return conn is not None and not conn.is_closed()
+
+    def open_channel(self):
+        return self.session.open_channel()
+
+    def close_channel(self, conn):
+        conn.close_channel()
+
+    def host_key(self):
+        key = self.session._conn.get_server_host_key()
+        if key is None:
+            return None
+        return " ".join(key.export_public_key("openssh").decode().split()[:2])
+
+    def close(self):
+        self.session.disconnect()